@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Accuracy of TfL bus arrival predictions, and ETAs corrected for it.
+
+`EtaTracker` follows every vehicle at every polled stop through the
+arrivals feed, keeping the times its `expectedArrival` changed. When a
+vehicle drops off a stop's list it has arrived, between the last poll
+that listed it and the first that didn't: at its last prediction if that
+falls in between, or else halfway. The prediction that was current HORIZONS
+seconds before the arrival (20, 10, 5, 3 and 1 minutes out) is then
+compared with it, and the errors are folded into running statistics per
+route and stop, and per route.
+
+Statistics are three floats per horizon (samples, mean error, mean
+absolute error) in one `array` per key, kept as exponentially weighted
+means so they follow drifts in TfL's predictions. `corrected` adds the
+mean error (the bias) for a bus's route and stop at its horizon to its
+ETA, falling back to the route's when the stop has too few samples.
+
+A listener call costs in proportion to the vehicles that changed in the
+poll. Tracks of stops that are no longer polled and statistics not
+updated for STATS_TTL are dropped oldest first, so memory stays bounded.
+
+@author: VK
+"""
+
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+import metrics
+
+
+# Seconds before the arrival at which predictions are scored
+HORIZONS = (60, 180, 300, 600, 1200)
+# Floor on the weight of a new error, so the means keep adapting
+ALPHA = 0.05
+MIN_SAMPLES = 5
+# Longest gap between the polls around an arrival for it to be scored
+MAX_GAP = 180.0
+# ETA changes kept per vehicle: enough to reach back the longest horizon
+# at the fastest bus stop polling, 15 s (see poller.py)
+MAX_CHANGES = max(HORIZONS) // 15 + 8
+TRACK_TTL = 600.0
+STATS_TTL = 14 * 24 * 3600.0
+
+ERRORS = metrics.Histogram(
+    'commute_eta_error_seconds',
+    'Absolute error of TfL bus arrival predictions, by minutes ahead.',
+    ['horizon'], buckets=(15, 30, 60, 120, 180, 300, 600))
+
+
+class Track:
+    """Predictions for one vehicle at one stop, as (time, ETA) changes"""
+
+    __slots__ = ('route', 'times', 'etas')
+
+    def __init__(self, route: str):
+        self.route = route
+        self.times = array('d')
+        self.etas = array('d')
+
+    def predict(self, when: float, eta: float):
+        if self.etas and self.etas[-1] == eta:
+            return
+        if len(self.times) >= MAX_CHANGES:
+            del self.times[0], self.etas[0]
+        self.times.append(when)
+        self.etas.append(eta)
+
+    def errors(self, actual: float):
+        """(horizon index, error) of the predictions current at HORIZONS"""
+        for h, ahead in enumerate(HORIZONS):
+            i = bisect_right(self.times, actual - ahead) - 1
+            if i < 0:
+                break  # not listed yet that far ahead
+            yield h, actual - self.etas[i]
+
+
+def _new_stats() -> array:
+    # [updated, (samples, mean error, mean absolute error) per horizon]
+    return array('d', bytes(8 * (1 + 3 * len(HORIZONS))))
+
+
+def _fold(stats: array, h: int, error: float, now: float):
+    i = 1 + 3 * h
+    n = stats[i] + 1
+    w = max(1 / n, ALPHA)
+    stats[0] = now
+    stats[i] = n
+    stats[i + 1] += w * (error - stats[i + 1])
+    stats[i + 2] += w * (abs(error) - stats[i + 2])
+
+
+class EtaTracker:
+    """
+    Learns the bias of bus arrival predictions from the arrivals feed
+
+    Feed it with `on_arrivals`, a keyed `snapshots.Feed` listener.
+    """
+
+    def __init__(self):
+        # stop -> (last poll, {vehicle: Track}), least recently polled first
+        self._tracks = OrderedDict()
+        self._stats = OrderedDict()     # (route, stop) -> stats
+        self._routes = OrderedDict()    # route -> stats
+        self._errors = [ERRORS.labels(str(ahead // 60)) for ahead in HORIZONS]
+        self._lock = threading.Lock()
+
+    def on_arrivals(self, stop, snapshot, previous, changed):
+        now = snapshot.fetched
+        with self._lock:
+            entry = self._tracks.pop(stop, None)
+            tracks = {} if entry is None else entry[1]
+            self._tracks[stop] = (now, tracks)
+            for vehicle in changed:
+                bus = snapshot.data.get(vehicle)
+                if bus is None:
+                    track = tracks.pop(vehicle, None)
+                    if track is not None \
+                            and now - previous.fetched <= MAX_GAP:
+                        self._arrived(stop, track, previous.fetched, now)
+                    continue
+                track = tracks.get(vehicle)
+                if track is None or track.route != bus.route:
+                    track = tracks[vehicle] = Track(bus.route)
+                track.predict(now, bus.eta.timestamp())
+            self._evict(now)
+
+    def _arrived(self, stop, track: Track, listed: float, gone: float):
+        if not track.etas:
+            return
+        actual = track.etas[-1]
+        if not listed <= actual <= gone:
+            actual = (listed + gone) / 2
+        key = (track.route, stop)
+        stats = self._stats.pop(key, None) or _new_stats()
+        self._stats[key] = stats
+        route = self._routes.pop(track.route, None) or _new_stats()
+        self._routes[track.route] = route
+        for h, error in track.errors(actual):
+            _fold(stats, h, error, gone)
+            _fold(route, h, error, gone)
+            self._errors[h].observe(abs(error))
+
+    def _evict(self, now: float):
+        tracks = self._tracks
+        while tracks and next(iter(tracks.values()))[0] < now - TRACK_TTL:
+            tracks.popitem(last=False)
+        for table in (self._stats, self._routes):
+            while table and next(iter(table.values()))[0] < now - STATS_TTL:
+                table.popitem(last=False)
+
+    def _bias(self, route: str, stop: str, h: int):
+        i = 1 + 3 * h
+        for stats in (self._stats.get((route, stop)),
+                      self._routes.get(route)):
+            if stats is not None and stats[i] >= MIN_SAMPLES:
+                return stats[i + 1]
+        return 0.0
+
+    def corrected(self, bus, now: float = None) -> float:
+        """A bus's ETA in epoch seconds, plus the learned bias"""
+        if now is None:
+            now = time.time()
+        eta = bus.eta.timestamp()
+        h = min(bisect_left(HORIZONS, eta - now), len(HORIZONS) - 1)
+        with self._lock:
+            return eta + self._bias(bus.route, bus.stop, h)
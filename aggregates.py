@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Network-wide and per-area bike availability.
+
+`DockAggregates` subscribes to the BikePoint feed and keeps running totals
+of bikes, eBikes, spaces and empty/full docks, for the whole network and
+per area (the part of the dock name after the comma, eg 'Soho'). Each new
+snapshot only touches the docks that changed: their old contribution is
+subtracted and the new one added.
+
+Docks reporting impossible counts are left out of the totals and counted
+in `excluded`, rather than silently filtered.
+
+@author: VK
+"""
+
+import threading
+from dataclasses import dataclass, fields
+from typing import NamedTuple
+
+import metrics
+
+
+class Dock(NamedTuple):
+    ident: str
+    name: str
+    lat: float
+    lon: float
+    bikes: int
+    ebikes: int
+    spaces: int
+    docks: int
+    modified: str
+
+    @property
+    def area(self) -> str:
+        return area_of(self.name)
+
+
+def area_of(name: str) -> str:
+    """'Chadwell Street, Angel' -> 'Angel'"""
+    return name.rsplit(',', 1)[-1].strip()
+
+
+def _count(props: dict, key: str) -> int:
+    try:
+        return int(props[key]['value'])
+    except (KeyError, TypeError, ValueError):
+        return -1
+
+
+def parse_dock(dockinfo: dict) -> Dock:
+    """Build a Dock from one BikePoint JSON record"""
+    props = {p['key']: p for p in dockinfo['additionalProperties']}
+    return Dock(ident=dockinfo['id'],
+                name=dockinfo['commonName'],
+                lat=dockinfo['lat'],
+                lon=dockinfo['lon'],
+                bikes=_count(props, 'NbBikes'),
+                ebikes=_count(props, 'NbEBikes'),
+                spaces=_count(props, 'NbEmptyDocks'),
+                docks=_count(props, 'NbDocks'),
+                modified=props.get('NbBikes', {}).get('modified', ''))
+
+
+def parse_docks(response) -> dict:
+    """Parse a BikePoint response (all docks, or one) into {dock ID: Dock}"""
+    data = response.json()
+    return {d['id']: parse_dock(d)
+            for d in (data if isinstance(data, list) else [data])}
+
+
+def plausible(dock: Dock) -> bool:
+    """Whether a dock's counts can be true"""
+    return (min(dock.bikes, dock.ebikes, dock.spaces) >= 0
+            and dock.ebikes <= dock.bikes
+            and dock.bikes + dock.spaces <= dock.docks)
+
+
+@dataclass
+class Totals:
+    docks: int = 0
+    bikes: int = 0
+    ebikes: int = 0
+    spaces: int = 0
+    empty: int = 0
+    full: int = 0
+
+    def add(self, dock: Dock, sign: int = 1):
+        self.docks += sign
+        self.bikes += sign * dock.bikes
+        self.ebikes += sign * dock.ebikes
+        self.spaces += sign * dock.spaces
+        self.empty += sign * (dock.bikes == 0)
+        self.full += sign * (dock.spaces == 0)
+
+    def to_dict(self) -> dict:
+        return {f.name: getattr(self, f.name) for f in fields(self)}
+
+
+class DockAggregates:
+    """
+    Incrementally maintained availability totals
+
+    Feed it with `on_snapshot` (a `snapshots.Feed` listener). `exclude`
+    is an optional predicate marking further docks to leave out of the
+    totals, on top of implausible counts.
+    """
+
+    def __init__(self, exclude=None):
+        self.exclude = exclude
+        self.network = Totals()
+        self.areas = {}
+        self.excluded = set()
+        self._counted = {}
+        self._lock = threading.Lock()
+
+    def _included(self, dock: Dock) -> bool:
+        return plausible(dock) and not (self.exclude and self.exclude(dock))
+
+    def _remove(self, ident: str):
+        dock = self._counted.pop(ident, None)
+        if dock is not None:
+            self.network.add(dock, -1)
+            self.areas[dock.area].add(dock, -1)
+
+    def _add(self, dock: Dock):
+        self._counted[dock.ident] = dock
+        self.network.add(dock)
+        self.areas.setdefault(dock.area, Totals()).add(dock)
+
+    def update(self, docks: dict, changed):
+        """Apply the docks in `changed` (IDs) from the mapping `docks`"""
+        with self._lock:
+            for ident in changed:
+                self._remove(ident)
+                dock = docks.get(ident)
+                if dock is None:
+                    self.excluded.discard(ident)
+                elif self._included(dock):
+                    self.excluded.discard(ident)
+                    self._add(dock)
+                else:
+                    self.excluded.add(ident)
+
+    def on_snapshot(self, key, snapshot, previous, changed):
+        self.update(snapshot.data, changed)
+
+    def totals(self) -> dict:
+        with self._lock:
+            return dict(self.network.to_dict(), excluded=len(self.excluded))
+
+    def by_area(self) -> dict:
+        with self._lock:
+            return {area: t.to_dict() for area, t in self.areas.items()
+                    if t.docks}
+
+
+AVAILABILITY = metrics.Gauge(
+    'commute_network_availability',
+    'Network-wide bike availability from the latest BikePoint snapshot.',
+    ['measure'])
+
+
+def export_metrics(aggregates: DockAggregates):
+    """Expose the network totals as gauges, read at scrape time"""
+    for measure in ('docks', 'bikes', 'ebikes', 'spaces', 'empty', 'full'):
+        AVAILABILITY.labels(measure).set_function(
+            lambda m=measure: getattr(aggregates.network, m))
+    AVAILABILITY.labels('excluded').set_function(
+        lambda: len(aggregates.excluded))
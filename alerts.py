@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Threshold alerts on dock availability and line status.
+
+Users subscribe to conditions written as
+
+    BikePoints_109 bikes < 3        one dock
+    eBikes > 0 near Bank            the total over an area's docks
+    Jubilee not Good Service        a line's status ('is' also works)
+
+and are notified when a condition becomes true. Rules are indexed by the
+entity they watch, so a new snapshot only looks at rules on the docks,
+areas and lines that changed. Numeric rules on one entity and field are
+kept sorted by threshold per operator, so the rules a change turns on or
+off are one bisected slice between the old and the new value: the cost
+is in the changed entities and the rules that flip, not in the number of
+rules.
+
+Rules are shared by all workers through an append-only file
+(COMMUTE_ALERTS_FILE, in COMMUTE_DATA_DIR by default). Every worker evaluates them against its own feeds
+and notifies the clients connected to it, through listeners such as the
+push hub. The rules already in the file when a worker starts, and the
+first snapshot of each feed, only set the state rules are compared with:
+a restart doesn't notify everyone of the conditions that already hold.
+Lines of the file that can't be read are logged and skipped.
+
+Docks flagged by the sanity checks (anomalies.py) count as having no
+value, as do implausible ones, so their rules neither hold nor fire.
+
+@author: VK
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, deque
+from typing import NamedTuple
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; rules stay per process there
+    fcntl = None
+
+import flask
+
+import metrics
+from aggregates import plausible
+
+
+DATA_DIR = os.environ.get(
+    'COMMUTE_DATA_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+ALERTS_FILE = os.environ.get(
+    'COMMUTE_ALERTS_FILE', os.path.join(DATA_DIR, 'alerts.jsonl'))
+FIELDS = ('bikes', 'ebikes', 'spaces', 'docks')
+HISTORY = 20
+
+log = logging.getLogger(__name__)
+
+RULES = metrics.Gauge(
+    'commute_alert_rules',
+    'Alert rules being evaluated in this worker.')
+FIRED = metrics.Counter(
+    'commute_alerts_fired_total',
+    'Alerts that went from false to true, by kind of rule.',
+    ['kind'])
+
+_NUMERIC = re.compile(
+    r'^\s*(?:(?P<dock>\S+)\s+)?(?P<field>[A-Za-z]+)\s*'
+    r'(?P<op><=|>=|<|>)\s*(?P<value>-?\d+(?:\.\d+)?)'
+    r'(?:\s+near\s+(?P<area>.+?))?\s*$')
+_STATUS = re.compile(
+    r'^\s*(?P<line>.+?)\s+(?P<op>is not|not|is)\s+(?P<status>.+?)\s*$',
+    re.IGNORECASE)
+
+
+class Rule(NamedTuple):
+    ident: str
+    condition: str
+    kind: str        # 'dock', 'area' or 'line'
+    entity: str      # dock ID, area or line name
+    field: str       # a dock count, or 'status'
+    op: str
+    value: object    # threshold, or status for line rules
+
+    def holds(self, value) -> bool:
+        if value is None:
+            return False
+        if self.kind == 'line':
+            same = value.lower() == self.value.lower()
+            return same if self.op == 'is' else not same
+        return {'<': value < self.value, '<=': value <= self.value,
+                '>': value > self.value, '>=': value >= self.value}[self.op]
+
+
+class Alert(NamedTuple):
+    rule: str
+    condition: str
+    value: object
+    time: float
+
+
+def parse(condition: str, ident: str = None) -> Rule:
+    """
+    Rule for a condition string
+
+    Raises
+    ------
+    ValueError
+        If the condition is not understood.
+
+    """
+    ident = ident or uuid.uuid4().hex[:12]
+    m = _NUMERIC.match(condition)
+    if m and m.group('field').lower() in FIELDS:
+        if bool(m.group('dock')) == bool(m.group('area')):
+            raise ValueError('give either a dock ID or "near <area>"')
+        kind, entity = (('dock', m.group('dock')) if m.group('dock')
+                        else ('area', m.group('area')))
+        return Rule(ident, condition, kind, entity, m.group('field').lower(),
+                    m.group('op'), float(m.group('value')))
+    m = _STATUS.match(condition)
+    if m and not _NUMERIC.match(condition):
+        return Rule(ident, condition, 'line', m.group('line'), 'status',
+                    'is' if m.group('op').lower() == 'is' else 'not',
+                    m.group('status'))
+    raise ValueError('cannot parse condition {!r}'.format(condition))
+
+
+class Thresholds:
+    """
+    Numeric rules on one entity and field, sorted by threshold per operator
+
+    For '<' and '<=' the rules that hold for a value are a suffix of the
+    sorted thresholds, for '>' and '>=' a prefix, so the rules that flip
+    between two values are the slice between their bisection points.
+    """
+
+    _CUT = {'<': bisect_right, '<=': bisect_left,
+            '>': bisect_left, '>=': bisect_right}
+
+    def __init__(self):
+        self.ops = {op: ([], []) for op in self._CUT}
+
+    def __bool__(self):
+        return any(ts for ts, _ in self.ops.values())
+
+    def add(self, rule: Rule):
+        thresholds, rules = self.ops[rule.op]
+        i = bisect_right(thresholds, rule.value)
+        thresholds.insert(i, rule.value)
+        rules.insert(i, rule)
+
+    def remove(self, rule: Rule):
+        thresholds, rules = self.ops[rule.op]
+        i = rules.index(rule)
+        del thresholds[i], rules[i]
+
+    def flipped(self, old, new) -> tuple:
+        """(rules that became true, rules that became false)"""
+        on, off = [], []
+        for op, (thresholds, rules) in self.ops.items():
+            if not rules:
+                continue
+            cut = self._CUT[op]
+            suffix = op in ('<', '<=')
+            # A missing value holds for no rule
+            none = len(rules) if suffix else 0
+            k_old = none if old is None else cut(thresholds, old)
+            k_new = none if new is None else cut(thresholds, new)
+            lo, hi = min(k_old, k_new), max(k_old, k_new)
+            gained = (k_new < k_old) if suffix else (k_new > k_old)
+            (on if gained else off).extend(rules[lo:hi])
+        return on, off
+
+
+class AlertEngine:
+    """
+    Evaluates alert rules against BikePoint and TrackerNet snapshots
+
+    Parameters
+    ----------
+    bike_feed, tube_feed : snapshots.Feed
+        {dock ID: aggregates.Dock} and {line: status}.
+    aggregates : aggregates.DockAggregates
+        Area totals for 'near' rules. It must be subscribed to the
+        BikePoint feed before this engine, so it is up to date when the
+        engine looks.
+    path : str
+        Shared rules file.
+    exclude : callable, optional
+        `exclude(dock) -> bool` for docks whose counts can't be trusted,
+        eg `anomalies.DockChecks.flagged`. Pass the docks whose flags
+        change to `update`.
+
+    Listeners subscribed with `subscribe(listener)` are called with each
+    `Alert`.
+    """
+
+    def __init__(self, bike_feed, tube_feed, aggregates,
+                 path: str = ALERTS_FILE, exclude=None):
+        self.bike_feed = bike_feed
+        self.tube_feed = tube_feed
+        self.aggregates = aggregates
+        self.path = path
+        self.exclude = exclude
+        self.rules = {}
+        self.history = defaultdict(lambda: deque(maxlen=HISTORY))
+        self._thresholds = defaultdict(Thresholds)
+        self._lines = defaultdict(list)
+        # Last value seen per (kind, entity, field) of the numeric rules
+        self._values = {}
+        self._listeners = []
+        self._offset = 0
+        self._lock = threading.RLock()
+        self._fired = {kind: FIRED.labels(kind)
+                       for kind in ('dock', 'area', 'line')}
+        RULES.labels().set_function(lambda: len(self.rules))
+        bike_feed.subscribe(self.on_docks)
+        tube_feed.subscribe(self.on_tube)
+        # Rules from before a restart have notified already
+        self.sync(fire=False)
+
+    def subscribe(self, listener):
+        self._listeners.append(listener)
+        return listener
+
+    # Shared rules file
+
+    def _append(self, record: dict):
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def sync(self, fire: bool = True):
+        """
+        Apply rules added or removed by any worker since the last sync
+
+        New rules that already hold fire, unless `fire` is False.
+        """
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        with self._lock:
+            if size == self._offset:
+                return
+            if size < self._offset:
+                # Rewritten; start over
+                for rule in list(self.rules.values()):
+                    self._unindex(rule)
+                self._offset = 0
+            try:
+                with open(self.path, 'rb') as f:
+                    f.seek(self._offset)
+                    data = f.read(size - self._offset)
+            except OSError:
+                return
+            # Only apply whole lines; a partial one is still being written
+            data = data[:data.rfind(b'\n') + 1]
+            self._offset += len(data)
+            for line in data.splitlines():
+                try:
+                    self._apply(json.loads(line), fire)
+                except (ValueError, KeyError, TypeError):
+                    log.warning('skipping unreadable line of %s: %.200r',
+                                self.path, line)
+
+    def _apply(self, record: dict, fire: bool):
+        if record['op'] == 'add' and record['id'] not in self.rules:
+            self._index(parse(record['condition'], record['id']), fire)
+        elif record['op'] == 'remove' and record['id'] in self.rules:
+            self._unindex(self.rules[record['id']])
+
+    def add(self, condition: str) -> Rule:
+        """
+        Subscribe to a condition; it fires at once if already true
+
+        Raises
+        ------
+        ValueError
+            If the condition is not understood.
+
+        """
+        rule = parse(condition)
+        self._append({'op': 'add', 'id': rule.ident, 'condition': condition})
+        self.sync()
+        return rule
+
+    def remove(self, ident: str) -> bool:
+        self.sync()
+        if ident not in self.rules:
+            return False
+        self._append({'op': 'remove', 'id': ident})
+        self.sync()
+        return True
+
+    # Indexes
+
+    def _index(self, rule: Rule, fire: bool = True):
+        self.rules[rule.ident] = rule
+        if rule.kind == 'line':
+            self._lines[rule.entity.lower()].append(rule)
+        else:
+            key = (rule.kind, rule.entity, rule.field)
+            self._thresholds[key].add(rule)
+            self._values[key] = self._value(key)
+        value = self._current(rule)
+        if fire and rule.holds(value):
+            self._fire(rule, value)
+
+    def _unindex(self, rule: Rule):
+        del self.rules[rule.ident]
+        self.history.pop(rule.ident, None)
+        if rule.kind == 'line':
+            self._lines[rule.entity.lower()].remove(rule)
+        else:
+            key = (rule.kind, rule.entity, rule.field)
+            self._thresholds[key].remove(rule)
+            if not self._thresholds[key]:
+                del self._thresholds[key]
+                self._values.pop(key, None)
+
+    def _dock_value(self, dock, field):
+        if dock is None or not plausible(dock) or (
+                self.exclude is not None and self.exclude(dock)):
+            return None
+        return getattr(dock, field)
+
+    def _value(self, key):
+        kind, entity, field = key
+        if kind == 'dock':
+            return self._dock_value(self.bike_feed.latest().data.get(entity),
+                                    field)
+        totals = self.aggregates.areas.get(entity)
+        return getattr(totals, field) if totals and totals.docks else None
+
+    def _current(self, rule: Rule):
+        if rule.kind == 'line':
+            status = {line.lower(): status for line, status
+                      in self.tube_feed.latest().data.items()}
+            return status.get(rule.entity.lower())
+        return self._value((rule.kind, rule.entity, rule.field))
+
+    def active(self, rule: Rule) -> bool:
+        return rule.holds(self._current(rule))
+
+    # Evaluation
+
+    def _fire(self, rule: Rule, value):
+        alert = Alert(rule.ident, rule.condition, value, time.time())
+        self.history[rule.ident].append(alert)
+        self._fired[rule.kind].inc()
+        for listener in self._listeners:
+            listener(alert)
+
+    def _move(self, key, new, fire: bool):
+        old = self._values.get(key)
+        self._values[key] = new
+        if fire:
+            on, _ = self._thresholds[key].flipped(old, new)
+            for rule in on:
+                self._fire(rule, new)
+
+    def update(self, snapshot, idents, previous):
+        """
+        Re-evaluate the rules on docks `idents` of a BikePoint snapshot,
+        and on their areas; eg for the docks whose flags changed
+
+        Nothing fires on the first snapshot (`previous` empty), which only
+        sets the values later ones are compared with.
+        """
+        fire = bool(previous.fetched)
+        with self._lock:
+            areas = set()
+            for ident in idents:
+                old, new = previous.data.get(ident), snapshot.data.get(ident)
+                areas.update(d.area for d in (old, new) if d is not None)
+                for field in FIELDS:
+                    key = ('dock', ident, field)
+                    if key in self._thresholds:
+                        self._move(key, self._dock_value(new, field), fire)
+            for area in areas:
+                for field in FIELDS:
+                    key = ('area', area, field)
+                    if key in self._thresholds:
+                        self._move(key, self._value(key), fire)
+
+    def on_docks(self, key, snapshot, previous, changed):
+        self.sync()
+        self.update(snapshot, changed, previous)
+
+    def on_tube(self, key, snapshot, previous, changed):
+        self.sync()
+        if not previous.fetched:
+            return  # the first statuses, from before any rule could see
+        with self._lock:
+            for line in changed:
+                rules = self._lines.get(line.lower())
+                if not rules:
+                    continue
+                old, new = previous.data.get(line), snapshot.data.get(line)
+                for rule in rules:
+                    if rule.holds(new) and not rule.holds(old):
+                        self._fire(rule, new)
+
+
+def create_blueprint(engine: AlertEngine) -> flask.Blueprint:
+    """
+    Blueprint managing alert rules under `/api/alerts`
+
+        POST   /api/alerts            {"condition": "BikePoints_109 bikes < 3"}
+        GET    /api/alerts?ids=a,b    rules, whether they hold, last alerts
+        DELETE /api/alerts/<id>
+
+    Alerts themselves are pushed on `/api/stream?alerts=<id>,...`.
+    """
+    from api import dumps, query_ids
+
+    bp = flask.Blueprint('alerts', __name__, url_prefix='/api/alerts')
+
+    def describe(rule: Rule) -> dict:
+        return {'id': rule.ident, 'condition': rule.condition,
+                'active': engine.active(rule),
+                'fired': [a.time for a in engine.history.get(rule.ident, ())]}
+
+    def respond(obj, status=200):
+        return flask.Response(dumps(obj), status=status,
+                              mimetype='application/json')
+
+    @bp.route('', methods=['POST'])
+    def add():
+        body = flask.request.get_json(silent=True) or flask.request.form
+        if not isinstance(body, dict):
+            flask.abort(400, 'send a JSON object')
+        condition = body.get('condition', '')
+        if not isinstance(condition, str):
+            flask.abort(400, 'condition must be a string')
+        try:
+            rule = engine.add(condition)
+        except ValueError as e:
+            flask.abort(400, str(e))
+        return respond(describe(rule), 201)
+
+    @bp.route('', methods=['GET'])
+    def list_rules():
+        engine.sync()
+        ids = query_ids('ids')
+        return respond({'alerts': [describe(engine.rules[i]) for i in ids
+                                   if i in engine.rules],
+                        'missing': [i for i in ids if i not in engine.rules]})
+
+    @bp.route('/<ident>', methods=['DELETE'])
+    def remove(ident):
+        if not engine.remove(ident):
+            flask.abort(404)
+        return flask.Response(status=204)
+
+    return bp
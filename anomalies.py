@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sanity checks on BikePoint dock counts.
+
+`DockChecks` flags docks whose reports can't be trusted:
+
+    implausible     negative or missing counts, or more eBikes than bikes
+    sentinel        a count of 99 or more, which TfL sends for bad readings
+    over capacity   bikes + spaces > docks
+    stale           no change for far longer than the rest of the network
+    stuck           the same counts for STUCK_AFTER, while TfL keeps
+                    updating the dock
+
+A dock's `modified` time is when TfL last changed its counts (as the
+poller reads it too, see poller.dock_changes), not a heartbeat: a quiet
+dock overnight is not a broken one. So a dock is stale when its silence
+exceeds MAX_SILENCE and SILENCE_FACTOR times the network's median
+silence; when the whole network is quiet, the bar rises with it.
+
+A snapshot costs in proportion to the docks that changed in it and the
+docks flagged, not to the whole network: count checks only run on the
+changed docks, and the time-based ones read `modified` and
+unchanged-since times kept in sorted (time, dock) lists, like the alert
+thresholds (see alerts.py). The median is the middle of one list, and the
+stale and stuck docks are the heads of the lists, found with `bisect`;
+only docks entering or leaving them are looked at. (numpy would do the
+same over arrays, but the layout's first BikePoint fetch runs the checks
+during `import app`, which must not load it; see bench_startup.py.)
+Flagged docks are marked in the dashboard and left out of the
+aggregates, which `update` is expected to drive with the docks whose
+flags changed.
+
+@author: VK
+"""
+
+import threading
+from bisect import bisect_left, insort
+
+import metrics
+import timeutil
+
+
+SENTINEL = 99
+MAX_SILENCE = 2 * 3600.0
+SILENCE_FACTOR = 4.0
+STUCK_AFTER = 12 * 3600.0
+REASONS = ('implausible', 'sentinel', 'over capacity', 'stale', 'stuck')
+
+FLAGGED = metrics.Gauge(
+    'commute_dock_anomalies',
+    'Docks currently flagged by the sanity checks, by reason.',
+    ['reason'])
+
+
+def count_checks(dock) -> set:
+    """Reasons to distrust a dock's counts, from the counts alone"""
+    reasons = set()
+    if min(dock.bikes, dock.ebikes, dock.spaces, dock.docks) < 0 \
+            or dock.ebikes > dock.bikes:
+        reasons.add('implausible')
+    if max(dock.bikes, dock.ebikes, dock.spaces) >= SENTINEL:
+        reasons.add('sentinel')
+    if dock.bikes + dock.spaces > dock.docks >= 0:
+        reasons.add('over capacity')
+    return reasons
+
+
+def _discard(times: list, item: tuple):
+    i = bisect_left(times, item)
+    if i < len(times) and times[i] == item:
+        del times[i]
+
+
+def _epoch(ts: str):
+    try:
+        return timeutil.epoch(ts)
+    except ValueError:
+        return None
+
+
+class DockChecks:
+    """
+    Flags for every dock in the BikePoint feed
+
+    Parameters
+    ----------
+    max_silence : float
+        Seconds without a new `modified` time before a dock can be stale.
+    silence_factor : float
+        How many times the network's median silence a dock must also
+        exceed to be stale.
+    stuck_after : float
+        Seconds with unchanged counts before a dock is stuck.
+
+    """
+
+    def __init__(self, max_silence: float = MAX_SILENCE,
+                 stuck_after: float = STUCK_AFTER,
+                 silence_factor: float = SILENCE_FACTOR):
+        self.max_silence = max_silence
+        self.silence_factor = silence_factor
+        self.stuck_after = stuck_after
+        self.flags = {}
+        self._counts = {}
+        self._static = {}       # dock -> reasons from its counts alone
+        self._modified = {}
+        self._since = {}
+        # Sorted (time, dock) of the parsed `modified` and since times
+        self._by_modified = []
+        self._by_since = []
+        self._timed = {'stale': set(), 'stuck': set()}
+        self._lock = threading.Lock()
+        for reason in REASONS:
+            FLAGGED.labels(reason).set_function(
+                lambda r=reason: self.count(r))
+
+    def count(self, reason: str) -> int:
+        """Docks flagged for `reason`"""
+        # Scrapes run in other threads than the poller updating the flags
+        with self._lock:
+            return sum(reason in f for f in self.flags.values())
+
+    def silence_limit(self, now: float) -> float:
+        """Seconds without a change after which a dock is stale, now"""
+        times = self._by_modified
+        # The median silence is that of the median `modified` time
+        median = now - times[len(times) - 1 - len(times) // 2][0] \
+            if times else 0.0
+        return max(self.max_silence, self.silence_factor * median)
+
+    def flagged(self, dock) -> bool:
+        """Whether a dock is flagged; `DockAggregates(exclude=...)`"""
+        return dock.ident in self.flags
+
+    def reasons(self, ident: str) -> list:
+        return sorted(self.flags.get(ident, ()))
+
+    def _forget(self, ident: str):
+        modified = self._modified.pop(ident, None)
+        if modified is not None:
+            _discard(self._by_modified, (modified, ident))
+        since = self._since.pop(ident, None)
+        if since is not None:
+            _discard(self._by_since, (since, ident))
+        self._counts.pop(ident, None)
+        self._static.pop(ident, None)
+
+    def _see(self, dock, now: float):
+        ident = dock.ident
+        counts = (dock.bikes, dock.ebikes, dock.spaces, dock.docks)
+        if self._counts.get(ident) != counts:
+            self._counts[ident] = counts
+            since = self._since.get(ident)
+            if since is not None:
+                _discard(self._by_since, (since, ident))
+            self._since[ident] = now
+            insort(self._by_since, (now, ident))
+        modified = _epoch(dock.modified)
+        before = self._modified.get(ident)
+        if modified != before:
+            if before is not None:
+                _discard(self._by_modified, (before, ident))
+            if modified is not None:
+                insort(self._by_modified, (modified, ident))
+        self._modified[ident] = modified
+        self._static[ident] = count_checks(dock)
+
+    def update(self, snapshot, changed) -> set:
+        """
+        Re-check a new snapshot; returns the docks whose flags changed
+
+        Parameters
+        ----------
+        snapshot : snapshots.Snapshot
+            {dock ID: aggregates.Dock}.
+        changed : set
+            Dock IDs that differ from the previous snapshot.
+
+        """
+        now = snapshot.fetched
+        docks = snapshot.data
+        flipped = set()
+        with self._lock:
+            for ident in changed:
+                dock = docks.get(ident)
+                if dock is None:
+                    self._forget(ident)
+                else:
+                    self._see(dock, now)
+            # Time-based checks can change for any dock, changed or not,
+            # but only those at the head of the sorted times hold
+            cut = bisect_left(self._by_modified,
+                              (now - self.silence_limit(now),))
+            stale = {ident for _, ident in self._by_modified[:cut]}
+            cut = bisect_left(self._by_since, (now - self.stuck_after,))
+            stuck = {ident for _, ident in self._by_since[:cut]} - stale
+            timed = {'stale': stale, 'stuck': stuck}
+            touched = set(changed)
+            for reason, idents in timed.items():
+                touched |= idents ^ self._timed[reason]
+            self._timed = timed
+            for ident in touched:
+                reasons = set(self._static.get(ident, ()))
+                for reason, idents in timed.items():
+                    if ident in idents:
+                        reasons.add(reason)
+                if reasons != self.flags.get(ident, set()):
+                    flipped.add(ident)
+                    if reasons:
+                        self.flags[ident] = reasons
+                    else:
+                        del self.flags[ident]
+        return flipped
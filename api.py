@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Headless JSON API over the snapshot caches.
+
+    GET /api/tube?lines=Central,Jubilee
+    GET /api/docks?ids=BikePoints_109,BikePoints_244
+    GET /api/arrivals?stops=490001180E,490000266G
+
+Every route takes a comma-separated batch of IDs (all lines or docks if
+omitted) and answers from the same feeds the dashboard uses, so polling
+the API costs no more TfL calls than the dashboard itself. Responses are
+compact JSON (orjson when installed) with a strong ETag; send it back in
+If-None-Match to get a bodyless 304 while nothing has changed. The body
+only holds data; how old the snapshot is, and whether it is being served
+stale because TfL is failing, is in the X-Snapshot-Age and
+X-Snapshot-Stale headers.
+
+Arrivals are answered from memory only: stops not yet cached are listed
+under "pending" and put on the background poller, so ask again shortly.
+Stop IDs are NaPTAN codes, letters and digits only.
+
+@author: VK
+"""
+
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+import flask
+
+from upstream import UpstreamError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    import json
+
+
+MAX_IDS = 100
+MEMO_SIZE = 512
+STOP_ID = re.compile(r'[0-9A-Za-z]{1,20}')
+DOCK_ID = re.compile(r'BikePoints_[0-9]{1,6}')
+
+
+def dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def query_ids(name: str, pattern=None) -> list:
+    raw = flask.request.args.get(name, '')
+    ids = list(dict.fromkeys(i.strip() for i in raw.split(',') if i.strip()))
+    if len(ids) > MAX_IDS:
+        flask.abort(400, 'at most {} {} per request'.format(MAX_IDS, name))
+    if pattern is not None:
+        bad = [i for i in ids if not pattern.fullmatch(i)]
+        if bad:
+            flask.abort(400, 'invalid {}: {}'.format(name, ', '.join(bad)))
+    return ids
+
+
+class _Memo:
+    """
+    Serialised bodies keyed by query and snapshot versions
+
+    Versions are per process, so they only key this process-local memo;
+    ETags are content hashes and hold across workers.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        item = self._items.get(key)
+        if item is None:
+            body = dumps(build())
+            etag = hashlib.blake2b(body, digest_size=12).hexdigest()
+            item = (body, etag)
+            with self._lock:
+                self._items[key] = item
+                if len(self._items) > self.size:
+                    self._items.popitem(last=False)
+        return item
+
+
+def _respond(memo: _Memo, key, build, snapshots):
+    body, etag = memo.get(key, build)
+    headers = {'ETag': '"{}"'.format(etag),
+               'Cache-Control': 'no-cache',
+               'X-Snapshot-Age': '{:.0f}'.format(
+                   max((s.age for s in snapshots), default=0.0)),
+               'X-Snapshot-Stale': str(int(any(s.stale for s in snapshots)))}
+    if etag in flask.request.if_none_match:
+        return flask.Response(status=304, headers=headers)
+    return flask.Response(body, mimetype='application/json', headers=headers)
+
+
+def create_blueprint(tube_feed, bike_feed, arrivals_feed,
+                     watch=None) -> flask.Blueprint:
+    """
+    Blueprint serving the API from the given `snapshots.Feed`s
+
+    Parameters
+    ----------
+    tube_feed : snapshots.Feed
+        {line: status}.
+    bike_feed : snapshots.Feed
+        {dock ID: aggregates.Dock}.
+    arrivals_feed : snapshots.Feed
+        Keyed by stop ID, each {vehicle ID: Bus}.
+    watch : callable, optional
+        `watch(stop, fetched)` keeps a stop polled in the background (see
+        `poller.Scheduler.watch`). Without it, stops not in memory are
+        fetched from TfL during the request.
+
+    """
+    bp = flask.Blueprint('api', __name__, url_prefix='/api')
+    memo = _Memo(MEMO_SIZE)
+
+    def current(feed, key=None):
+        try:
+            return feed.get(key)
+        except UpstreamError as e:
+            flask.abort(503, str(e))
+
+    @bp.route('/tube')
+    def tube():
+        lines = query_ids('lines')
+        snapshot = current(tube_feed)
+
+        def build():
+            wanted = lines or list(snapshot.data)
+            return {
+                'lines': [{'line': line, 'status': snapshot.data[line]}
+                          for line in wanted if line in snapshot.data],
+                'missing': [line for line in wanted
+                            if line not in snapshot.data]}
+
+        return _respond(memo, ('tube', snapshot.version, tuple(lines)),
+                        build, [snapshot])
+
+    @bp.route('/docks')
+    def docks():
+        ids = query_ids('ids')
+        snapshot = current(bike_feed)
+
+        def build():
+            wanted = ids or list(snapshot.data)
+            return {
+                'docks': [snapshot.data[i]._asdict()
+                          for i in wanted if i in snapshot.data],
+                'missing': [i for i in wanted if i not in snapshot.data]}
+
+        return _respond(memo, ('docks', snapshot.version, tuple(ids)),
+                        build, [snapshot])
+
+    @bp.route('/arrivals')
+    def arrivals():
+        stops = query_ids('stops', STOP_ID)
+        if not stops:
+            flask.abort(400, 'stops is required')
+        snapshots, errors, pending = {}, {}, []
+        for stop in stops:
+            snapshot = arrivals_feed.latest(stop)
+            if watch is not None:
+                watch(stop, bool(snapshot.fetched))
+                if snapshot.fetched:
+                    snapshots[stop] = snapshot
+                else:
+                    pending.append(stop)
+                continue
+            try:
+                snapshots[stop] = arrivals_feed.get(stop)
+            except UpstreamError as e:
+                errors[stop] = str(e)
+
+        def build():
+            return {
+                'stops': {
+                    stop: [{'route': b.route, 'destination': b.dest,
+                            'towards': b.towards, 'reg': b.reg,
+                            'eta': b.eta.timestamp()}
+                           for b in sorted(snap.data.values(),
+                                           key=lambda b: b.eta)]
+                    for stop, snap in snapshots.items()},
+                'pending': pending,
+                'errors': errors}
+
+        key = ('arrivals',
+               tuple((s, snap.version) for s, snap in snapshots.items()),
+               tuple(pending), tuple(sorted(errors)))
+        return _respond(memo, key, build, list(snapshots.values()))
+
+    return bp
@@ -6,11 +6,16 @@ Created on Wed Jun  8 14:24:58 2022
 @author: VK
 """
 
+import csv
+import hashlib
+import os
+import time
+import urllib.parse
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
-import requests
-
-import pandas as pd
+from datetime import datetime
+import flask
 
 
 import dash
@@ -18,20 +23,36 @@ from dash import dcc
 from dash import html
 from dash import dash_table
 from dash import ctx
-from dash.dependencies import Output, Input, State
+from dash.dependencies import ClientsideFunction, Output, Input, State
 from dash.exceptions import PreventUpdate
-import plotly.express as px
-import plotly.io as pio
-
-pio.renderers.default = "browser"
-
 
-BIKE_URL = "https://api.tfl.gov.uk/BikePoint/"
-TUBE_URL = "http://cloud.tfl.gov.uk/TrackerNet/LineStatus"
-BUS_URL = "https://api.tfl.gov.uk/StopPoint/{stopid}/arrivals"
-
-
-def static_data(fname: str) -> pd.DataFrame:
+import accuracy
+import aggregates
+import alerts
+import anomalies
+import api
+import metrics
+import planner
+import poller
+import profiles
+import push
+import routes
+import snapshots
+import staticdata
+import statuslog
+import tablediff
+import timeutil
+import tracing
+import upstream
+import walkgraph
+from upstream import UpstreamError
+from upstream import BIKE_URL, TUBE_URL, BUS_URL, ROUTE_URL
+
+
+bike_probe = upstream.client.probe('bikepoint')
+
+
+def static_data(fname: str) -> list[dict]:
     """
     Read static dock data from CSV file
 
@@ -42,16 +63,30 @@ def static_data(fname: str) -> pd.DataFrame:
 
     Returns
     -------
-    stations_static : pd.DataFrame
-        A DataFrame containing the dock info.
+    stations_static : List[Dict]
+        The dock info, one {'Name': name, 'ID': ident} per dock.
 
     """
-    stations_static = pd.read_csv(fname)
+    with open(fname, newline='') as f:
+        stations_static = list(csv.DictReader(f))
     
     return stations_static
 
 
-stations_df = static_data('stations_static.csv').sort_values('Name')
+stations = sorted(static_data('stations_static.csv'), key=lambda d: d['Name'])
+
+def parse_tube(r) -> dict:
+    """
+    Parse a TrackerNet LineStatus response into {line name: status}
+    """
+    with tracing.span('decode'):
+        root = ET.fromstring(r.content[3:])  # skip the BOM
+    return {child[1].attrib['Name']: child[2].attrib['Description']
+            for child in root}
+
+
+tube_feed = snapshots.Feed('tube', 'tube', TUBE_URL, parse_tube)
+
 
 def tube_status():
     """
@@ -64,21 +99,40 @@ def tube_status():
 
     """
 
-    r = requests.get(TUBE_URL)    
-    root = ET.fromstring(r.text[3:])    
-    result = []
-    
-    for child in root:
-        d = {
-            'Line': child[1].attrib['Name'],
-            'Status': child[2].attrib['Description']
-            }
-        
-        result.append(d)
-        
+    result = [{'Line': line, 'Status': status}
+              for line, status in tube_feed.get().data.items()]
+
     return result
 
-tubes = tube_status()
+try:
+    tubes = tube_status()
+except UpstreamError:
+    tubes = []
+
+
+def content_etag(obj) -> str:
+    """Hash of what a store holds, the same on every worker"""
+    return hashlib.blake2b(api.dumps(obj), digest_size=12).hexdigest()
+
+
+_tube_store = (None, None)
+
+
+def tube_store_data(snapshot) -> dict:
+    """
+    The full status list for the browser's `tube-store`
+
+    The etag is a content hash rather than the snapshot version, as
+    versions are per worker and the browser may talk to any of them.
+    """
+    global _tube_store
+    version, data = _tube_store
+    if version != snapshot.version:
+        rows = [{'Line': line, 'Status': status}
+                for line, status in snapshot.data.items()]
+        data = {'etag': content_etag(rows), 'rows': rows}
+        _tube_store = (snapshot.version, data)
+    return data
 
 
 @dataclass
@@ -89,22 +143,26 @@ class Station:
     lon: float = field(init=False)
     nbikes: int = field(init=False)
     nempty: int = field(init=False)
-    ts: pd.Timestamp = field(init=False)
+    ts: datetime = field(init=False)
     
     def __post_init__(self):
-        r = requests.get(BIKE_URL + str(self.ident))
-        dockinfo = r.json()
-        self.name = dockinfo['commonName']
-        self.lat = dockinfo['lat']
-        self.lon = dockinfo['lon']
-        self.nbikes = dockinfo['additionalProperties'][6]['value']
-        self.nebikes = dockinfo['additionalProperties'][10]['value']
-        self.nempty = dockinfo['additionalProperties'][7]['value']
-        self.ts = (pd.Timestamp(
-            dockinfo['additionalProperties'][7]['modified'])
-            .tz_convert('Europe/London'))
+        r = upstream.fetch('bikepoint', BIKE_URL + str(self.ident))
+        with bike_probe.parse():
+            with tracing.span('decode'):
+                dockinfo = r.json()
+            with tracing.span('parse'):
+                self.name = dockinfo['commonName']
+                self.lat = dockinfo['lat']
+                self.lon = dockinfo['lon']
+                self.nbikes = dockinfo['additionalProperties'][6]['value']
+                self.nebikes = dockinfo['additionalProperties'][10]['value']
+                self.nempty = dockinfo['additionalProperties'][7]['value']
+                self.ts = timeutil.london(
+                    dockinfo['additionalProperties'][7]['modified'])
         
     def to_dataframe(self):
+        import pandas as pd
+
         df = pd.DataFrame(columns=[
             'ID', 'Name', 'Bikes', 'eBikes', 'Spaces', 'Lat', 'Lon', 'Date', 'Time',
             'hover'])
@@ -146,7 +204,7 @@ class Bus:
     route: str = field(init=False)
     dest: str = field(init=False)
     towards: str = field(init=False)
-    eta: pd.Timestamp = field(init=False)
+    eta: datetime = field(init=False)
     reg: str = field(init=False)
     
     def __post_init__(self):
@@ -154,29 +212,51 @@ class Bus:
         self.route = self.busdict['lineId']
         self.dest = self.busdict['destinationName']
         self.towards = self.busdict['towards']
-        self.eta = (pd.Timestamp(self.busdict['expectedArrival'])
-                    .tz_convert('Europe/London'))
+        self.eta = timeutil.london(self.busdict['expectedArrival'])
         self.reg = self.busdict['vehicleId']
     
     
+def parse_arrivals(r) -> dict:
+    """
+    Parse a StopPoint arrivals response into {vehicle ID: Bus}
+    """
+    with tracing.span('decode'):
+        stopinfo = r.json()
+    return {bus['vehicleId']: Bus(bus) for bus in stopinfo}
+
+
+arrivals_feed = snapshots.Feed(
+    'arrivals', 'arrivals', lambda stopid: BUS_URL.format(stopid=stopid),
+    parse_arrivals)
+# Learns how far off TfL's predictions run, to correct the ETAs shown
+eta_tracker = accuracy.EtaTracker()
+arrivals_feed.subscribe(eta_tracker.on_arrivals)
+
+
 def GetStopBuses(stopid: str) -> list[dict]:
-    r = requests.get(BUS_URL.format(stopid=stopid))
-    stopinfo = r.json()
-    buses = []
-    for bus in stopinfo:
-        bus_dict = dict(Route=bus['lineId'],
-                        Destination=bus['destinationName'],
-                        ETA=(pd.Timestamp(bus['expectedArrival'])
-                                    .tz_convert('Europe/London')
-                                    .strftime('%H:%M:%S')),
-                        Reg=bus['vehicleId']
-                        )
-        buses.append(bus_dict)
-        buses.sort(key=lambda x: x['ETA'])
-        
+    """
+    Arrivals at a stop, soonest first, with ETA in epoch seconds
+
+    ETAs are corrected for the bias learned by `eta_tracker`. The browser
+    turns them into a countdown (see assets/clientside.js).
+    """
+    arrivals = arrivals_feed.get(stopid).data
+    scheduler.watch('arrivals', stopid)
+    with tracing.span('transform'):
+        now = time.time()
+        buses = []
+        for bus in arrivals.values():
+            bus_dict = dict(Route=bus.route,
+                            Destination=bus.dest,
+                            ETA=eta_tracker.corrected(bus, now),
+                            Reg=bus.reg
+                            )
+            buses.append(bus_dict)
+        buses.sort(key=lambda b: b['ETA'])
+
     return buses
 
-bus_stops = pd.read_csv('BusStops.csv')
+stop_index = staticdata.read_stops('BusStops.csv')
 
 """
 Dash section
@@ -193,40 +273,118 @@ external_stylesheets = [
 
 
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
-## server = app.server  ## Comment out this line if you're running locally
+server = app.server
 
 
 app.title = "VK Commute Status"
 
-bike_tblcols = ['Name', 'Bikes', 'eBikes', 'Spaces', 'Date', 'Time']
+bike_tblcols = ['Name', 'Bikes', 'eBikes', 'Spaces', 'Date', 'Time', 'Check']
 ebike_locs = ['Name', 'eBikes']
 tube_tblcols = ['Line', 'Status']
+history_tblcols = ['Line', 'Status', 'Since', 'For']
+commute_tblcols = ['Option', 'Arrive', 'Minutes', 'Notes']
 bus_tblcols = ['Route', 'Destination', 'ETA', 'Reg']
 
 dock_options = [
-    {"label": dock[0], "value": dock[1]}
-    for _, dock in stations_df.iterrows()]
+    {"label": dock['Name'], "value": dock['ID']}
+    for dock in stations]
 
 lines = [t['Line'] for t in tubes]
 tube_options = [
     {"label": line, "value": line}
     for line in lines]
 
-busstop_options = [
-    {"label": stop[1], "value": stop[0]}
-    for _, stop in bus_stops.iterrows()]
-
 # busstop_options_lower = [
 #     {bs['label'].lower(): bs['value']}
 #     for bs in busstop_options]
 
-all_docks = pd.DataFrame(requests.get(BIKE_URL).json())
-ebikes = pd.DataFrame(pd.DataFrame(all_docks['additionalProperties'].to_list(), index=all_docks.index).iloc[:, 10].to_dict()).T
-ebikes = ebikes['value'].astype(int)
-total_ebikes = ebikes[ebikes < 99].sum()
+bike_feed = snapshots.Feed('bikepoint', 'bikepoint', BIKE_URL,
+                           aggregates.parse_docks)
+dock_checks = anomalies.DockChecks()
+dock_totals = aggregates.DockAggregates(exclude=dock_checks.flagged)
+
+
+def check_docks(key, snapshot, previous, changed):
+    # Docks whose flags changed are re-counted too, so a dock that goes
+    # stale leaves the totals (and alerts) even if its counts didn't change
+    flipped = dock_checks.update(snapshot, changed)
+    dock_totals.update(snapshot.data, changed | flipped)
+    alert_engine.update(snapshot, flipped - changed, previous)
+
+
+bike_feed.subscribe(check_docks)
+aggregates.export_metrics(dock_totals)
+alert_engine = alerts.AlertEngine(bike_feed, tube_feed, dock_totals,
+                                  exclude=dock_checks.flagged)
+status_log = statuslog.StatusLog(tube_feed)
+
+# Keep the feeds warm in the background, polling each as often as it
+# changes. Started per worker (gunicorn.conf.py), not at import; one
+# worker polls TfL and the others take its responses.
+scheduler = poller.Scheduler(lock_path=poller.LOCK_FILE)
+scheduler.add(poller.FeedJob(bike_feed, None, poller.dock_changes,
+                             bounds=(30, 300), target=20))
+scheduler.add(poller.FeedJob(tube_feed, None, poller.status_changes,
+                             bounds=(30, 300)))
+scheduler.keyed(arrivals_feed, poller.arrival_churn, bounds=(15, 90),
+                target=2)
+
+# Single docks, as the dock table fetches them; only polled for the plan
+# of the saved dashboards, which keeps their responses warm for it
+dock_feed = snapshots.Feed('dock', 'bikepoint', lambda ident: BIKE_URL + ident,
+                           aggregates.parse_docks)
+scheduler.keyed(dock_feed, poller.dock_changes, bounds=(30, 300), target=1)
+# Whole bus routes, one call each, polled while /api/routes asks for them
+route_feed = snapshots.Feed('routes', 'routes',
+                            lambda route: ROUTE_URL.format(route=route),
+                            routes.parse_route)
+scheduler.keyed(route_feed, poller.route_churn, bounds=(15, 90), target=2)
+profile_store = profiles.ProfileStore(
+    docks=lambda: bike_feed.latest().data)
+
+
+# Keyed feeds holding a plan's entities; lines need none, as TrackerNet
+# serves all of them in one always-polled call
+PLAN_FEEDS = {'stops': 'arrivals', 'docks': 'dock'}
+
+
+@profile_store.subscribe
+def follow_plan(plan):
+    for kind, feed_name in PLAN_FEEDS.items():
+        scheduler.pin(feed_name, getattr(plan, kind))
+
+
+def warm(kind: str, key: str):
+    """Keep an entity of an ad-hoc plan polled while it is asked for"""
+    feed_name = PLAN_FEEDS.get(kind)
+    if feed_name is not None:
+        scheduler.watch(feed_name, key)
+
+
+follow_plan(profile_store.plan)
+# Picks up dashboards saved in other workers, and lets idle ones expire
+scheduler.add(poller.Task('profiles', profile_store.sync, 60))
+# Built offline (walkgraph.py); mapped on first use, or in the gunicorn
+# master
+walk_graph = walkgraph.WalkGraph()
+commute_planner = planner.Planner(tube_feed, bike_feed, arrivals_feed,
+                                  correct=eta_tracker.corrected,
+                                  exclude=dock_checks.flagged,
+                                  walking=walk_graph.seconds_between)
+
+
+def ebikes_text() -> str:
+    try:
+        bike_feed.get()
+    except UpstreamError:
+        if not bike_feed.latest().version:
+            return "Total eBikes Available: unavailable"
+    return "Total eBikes Available: {}".format(dock_totals.network.ebikes)
+
 
 app.layout = html.Div(
     children=[
+        dcc.Location(id='url', refresh=False),
         html.Div(
             children=[
                 html.P(children="🚲", className="header-emoji"),
@@ -241,6 +399,48 @@ app.layout = html.Div(
                 ],
             className="header"
             ),
+
+        html.Div(
+            children=[
+                dcc.Input(id='profile-name', type='text',
+                          placeholder='Name this dashboard'),
+                html.Button('Save', id='save-profile'),
+                html.Span(id='profile-link'),
+                ],
+            className="button"
+            ),
+
+        html.Div(
+            children=[
+                dash_table.DataTable(
+                    id='commute-table',
+                    columns=[
+                        {"name": k, "id": k} for k in commute_tblcols],
+                    style_as_list_view=True,
+                    style_cell={
+                        'padding': '5px',
+                        'textAlign': 'center'
+                        },
+                    style_header={
+                        'backgroundColor': 'white',
+                        'fontWeight': 'bold',
+                        'textAlign': 'center'
+                        },
+                    style_data_conditional=[
+                        {
+                            'if': {'filter_query': "{Arrive} = '-'"},
+                            'color': 'grey',
+                            'fontStyle': 'italic'
+                            }
+                        ]
+                    ),
+                # Not switched off by the stream: bus waits change by the
+                # minute whether or not anything is pushed
+                dcc.Interval(id='commute-interval', interval=30 * 1000,
+                             disabled=True),
+                ],
+            className="table"
+            ),
         
         html.Div(
             children=html.P(
@@ -269,7 +469,11 @@ app.layout = html.Div(
             ),
         
         html.Div(
-            children=html.Button('Refresh', id='refresh_line'),
+            children=[
+                html.Button('Refresh', id='refresh_line'),
+                dcc.Store(id='tube-store'),
+                dcc.Interval(id='tube-interval', interval=60 * 1000),
+                ],
             className="button"
             ),
         
@@ -304,6 +508,31 @@ app.layout = html.Div(
                 ],
             className="table"
             ),
+
+        html.Div(
+            children=[
+                html.P(children="Changes in the last day",
+                       className="menu-title"),
+                dash_table.DataTable(
+                    id='tube-history',
+                    columns=[
+                        {"name": k, "id": k} for k in history_tblcols],
+                    style_as_list_view=True,
+                    style_cell={
+                        'padding': '5px',
+                        'textAlign': 'center'
+                        },
+                    style_header={
+                        'backgroundColor': 'white',
+                        'fontWeight': 'bold',
+                        'textAlign': 'center'
+                        },
+                    ),
+                dcc.Store(id='history-store'),
+                dcc.Interval(id='history-interval', interval=5 * 60 * 1000),
+                ],
+            className="table"
+            ),
         
         
         
@@ -335,10 +564,14 @@ app.layout = html.Div(
             ),
 
         html.Div(
-            children=html.P(
-                children="Total eBikes Available: {}".format(total_ebikes),
-                className="menu"),
-
+            children=[
+                html.P(
+                    id="total-ebikes",
+                    children=ebikes_text(),
+                    className="menu"),
+                dcc.Store(id='totals-store'),
+                dcc.Interval(id="totals-interval", interval=60 * 1000),
+                ],
         ),
 
         html.Div(
@@ -363,10 +596,19 @@ app.layout = html.Div(
                         'fontWeight': 'bold',
                         'textAlign': 'center'
                         },
+                    style_data_conditional=[
+                        {
+                            # Counts flagged by the sanity checks
+                            'if': {'filter_query': "{Check} != ''"},
+                            'color': 'grey',
+                            'fontStyle': 'italic'
+                            }
+                        ]
                     )
                 ],
             className="table"
             ),
+        dcc.Store(id='stations-rows'),
         
         html.Div(
             children=[
@@ -398,7 +640,14 @@ app.layout = html.Div(
             ),
         
         html.Div(
-            children=html.Button('Refresh', id='refresh_buses'),
+            children=[
+                html.Button('Refresh', id='refresh_buses'),
+                dcc.Store(id='bus-store'),
+                # Arrivals are refetched every minute; the countdown
+                # ticks every second in the browser
+                dcc.Interval(id='bus-interval', interval=60 * 1000),
+                dcc.Interval(id='bus-clock', interval=1000),
+                ],
             className="button"
             ),
            
@@ -424,6 +673,13 @@ app.layout = html.Div(
             className="table"
             ),
         
+        dcc.Store(id='push-store'),
+        dcc.Interval(id='push-clock', interval=500),
+        # Counts of pushed tube and dock changes, which refresh the tables
+        # rendered here
+        dcc.Store(id='tube-pushed'),
+        dcc.Store(id='docks-pushed'),
+
         html.Div(
             html.Footer(
                 children=[html.Br(),
@@ -443,66 +699,308 @@ app.layout = html.Div(
     )
 
 
+@app.callback(
+    Output('totals-store', 'data'),
+    Input('totals-interval', 'n_intervals'),
+    Input('refresh_dock', 'n_clicks'))
+@metrics.timed_callback
+@tracing.traced
+def refresh_totals(n_intervals, clicks):
+    return ebikes_text()
+
+
+# Polled totals, or those pushed while the stream is connected
+app.clientside_callback(
+    ClientsideFunction(namespace='totals', function_name='text'),
+    Output('total-ebikes', 'children'),
+    Input('totals-store', 'data'),
+    Input('push-store', 'data'))
+
+
+# Docks are fetched concurrently so one slow dock can't hold up the table
+dock_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='dock')
+
+
+def _dock_row(ident):
+    try:
+        row = Station(ident).to_dict()
+    except UpstreamError:
+        return None
+    row['Check'] = ', '.join(dock_checks.reasons(ident))
+    return row
+
+
+def dock_rows(docks: list) -> list[dict]:
+    """
+    Table rows for the given dock IDs, fetched in parallel
+
+    Docks that can't be fetched (and have no earlier snapshot) are left out.
+    """
+    return [row for row in dock_pool.map(_dock_row, docks)
+            if row is not None]
+
+
+@app.callback(
+    Output('lines', 'value'),
+    Output('docks', 'value'),
+    Output('busstop', 'value'),
+    Input('url', 'search'))
+@metrics.timed_callback
+@tracing.traced
+def open_profile(search):
+    query = urllib.parse.parse_qs((search or '').lstrip('?'))
+    profile = profile_store.open(query.get('profile', [''])[0])
+    if profile is None:
+        raise PreventUpdate
+    return (list(profile.lines), list(profile.docks),
+            profile.stops[0] if profile.stops else None)
+
+
+@app.callback(
+    Output('commute-table', 'data'),
+    Output('commute-interval', 'disabled'),
+    Input('url', 'search'),
+    Input('commute-interval', 'n_intervals'),
+    Input('tube-pushed', 'data'))
+@metrics.timed_callback
+@tracing.traced
+def refresh_commute(search, n_intervals, pushed):
+    query = urllib.parse.parse_qs((search or '').lstrip('?'))
+    profile = profile_store.get(query.get('profile', [''])[0])
+    if profile is None or not profile.commute:
+        return [], True
+    rows = []
+    for plan in commute_planner.rank(profile.commute):
+        notes = [leg['note'] for leg in plan['legs'] if leg['note']]
+        if plan['feasible']:
+            arrive = datetime.fromtimestamp(
+                plan['arrive'], timeutil.LONDON).strftime('%H:%M')
+            minutes = plan['minutes']
+        else:
+            arrive, minutes = '-', '-'
+            notes.append(plan['reason'])
+        rows.append({'Option': plan['name'], 'Arrive': arrive,
+                     'Minutes': minutes, 'Notes': '; '.join(notes)})
+    return rows, False
+
+
+@app.callback(
+    Output('profile-link', 'children'),
+    Input('save-profile', 'n_clicks'),
+    State('profile-name', 'value'),
+    State('lines', 'value'),
+    State('docks', 'value'),
+    State('busstop', 'value'),
+    prevent_initial_call=True)
+@metrics.timed_callback
+@tracing.traced
+def save_profile(clicks, name, lines, docks, busstop):
+    try:
+        profile = profile_store.save(name or 'My dashboard', lines or [],
+                                     docks or [], [busstop] if busstop else [])
+    except ValueError as e:
+        return str(e)
+    return html.A('Link to ' + profile.name,
+                  href='?profile=' + profile.ident)
+
+
 @app.callback(
     Output('busstop', 'options'),
     Input('busstop', 'search_value'))
+@metrics.timed_callback
+@tracing.traced
 def update_bus_dropdown(search_value):
     if not search_value:
         raise PreventUpdate
-    return [o for o in busstop_options
-            if search_value.lower() in o["label"].lower()]
+    # The dropdown filters options again in the browser, by its own match
+    # against `search`; give the fuzzy matches the typed text so they show
+    return [dict(option, search=search_value)
+            for option in stop_index.search(search_value)]
                           
 
 @app.callback(
-    Output('lines-table', 'data'),
-    # Output('refresh_dock', 'n_clicks'),
+    Output('tube-store', 'data'),
     Input('refresh_line', 'n_clicks'),
+    Input('tube-interval', 'n_intervals'),
+    State('tube-store', 'data'))
+@metrics.timed_callback
+@tracing.traced
+def refresh_tube_store(clicks, n_intervals, stored):
+    try:
+        snapshot = tube_feed.get()
+    except UpstreamError:
+        # Keep the browser's snapshot rather than blanking the table
+        raise PreventUpdate
+    data = tube_store_data(snapshot)
+    if stored and stored.get('etag') == data['etag']:
+        raise PreventUpdate
+    return data
+
+
+def _duration(seconds: float) -> str:
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return '{} min'.format(minutes)
+    return '{} h {} min'.format(minutes // 60, minutes % 60)
+
+
+@app.callback(
+    Output('history-store', 'data'),
+    Input('tube-store', 'data'),
+    Input('tube-pushed', 'data'),
+    Input('history-interval', 'n_intervals'),
+    State('history-store', 'data'))
+@metrics.timed_callback
+@tracing.traced
+def refresh_tube_history(stored, pushed, n_intervals, history):
+    now = time.time()
+    status_log.sync()
+    changes = sorted(
+        ((since, until, line, status) for line in list(status_log.lines)
+         for status, since, until in status_log.timeline(
+             line, now - statuslog.DAY, now)),
+        key=lambda change: (change[0], change[2]), reverse=True)
+    rows = [{'Line': line, 'Status': status,
+             'Since': datetime.fromtimestamp(
+                 since, timeutil.LONDON).strftime('%a %H:%M'),
+             'For': _duration((until or now) - since)
+             + ('' if until else ' so far')}
+            for since, until, line, status in changes]
+    etag = content_etag(rows)
+    if history and history.get('etag') == etag:
+        raise PreventUpdate
+    return {'etag': etag, 'rows': rows}
+
+
+# Every line's changes are stored; picking lines filters them in the browser
+app.clientside_callback(
+    ClientsideFunction(namespace='tube', function_name='filter_history'),
+    Output('tube-history', 'data'),
+    Input('history-store', 'data'),
     Input('lines', 'value'))
-def refresh_tube_table(clicks, lines):
-    if ctx.triggered is not None:
-        # clicks = 0
-        if isinstance(lines, list):
-            data = [t for t in tube_status() if t['Line'] in lines]
-        elif isinstance(lines, str):
-            data = [t for t in tube_status() if t['Line']==lines]
-        else:
-            data = []
-    
-    return data #, clicks
+
+
+# Picking lines only filters the stored snapshot, in the browser
+app.clientside_callback(
+    ClientsideFunction(namespace='tube', function_name='filter_lines'),
+    Output('lines-table', 'data'),
+    Input('tube-store', 'data'),
+    Input('lines', 'value'),
+    Input('push-store', 'data'))
 
    
 @app.callback(
     Output('stations-table', 'data'),
-    # Output('refresh_dock', 'n_clicks'),
+    Output('stations-rows', 'data'),
     Input('refresh_dock', 'n_clicks'),
-    Input('docks', 'value'))
-def refresh_dock_table(clicks, docks):
+    Input('docks', 'value'),
+    Input('docks-pushed', 'data'),
+    State('stations-rows', 'data'))
+@metrics.timed_callback
+@tracing.traced
+def refresh_dock_table(clicks, docks, pushed, shown):
     if ctx.triggered is not None:
         # clicks = 0
         if isinstance(docks, list):
-            data = [Station(s).to_dict() for s in docks]
+            data = dock_rows(docks)
         elif isinstance(docks, str):
-            data = [Station(docks).to_dict()]
+            data = dock_rows([docks])
         else:
             data = []
-    
-    return data #, 
+
+    # Only send the rows that changed since the table was last filled
+    with tracing.span('transform'):
+        return tablediff.patch_rows(shown, data, 'ID')
+
 
 @app.callback(
-    Output('buses-table', 'data'),
-    # Output('refresh_dock', 'n_clicks'),
+    Output('bus-store', 'data'),
     Input('refresh_buses', 'n_clicks'),
-    Input('busstop', 'value'))
-def refresh_busstop_table(clicks, busstop):
-    data = []
-    if ctx.triggered is not None:
-        # clicks = 0
-        if isinstance(busstop, str):
-            data = GetStopBuses(busstop)
-        
-    
-    return data #, clicks
+    Input('bus-interval', 'n_intervals'),
+    Input('busstop', 'value'),
+    State('bus-store', 'data'))
+@metrics.timed_callback
+@tracing.traced
+def refresh_bus_store(clicks, n_intervals, busstop, stored):
+    if not isinstance(busstop, str):
+        return None
+    try:
+        rows = GetStopBuses(busstop)
+    except UpstreamError:
+        # Keep counting down the last arrivals rather than blanking them
+        raise PreventUpdate
+    etag = content_etag([busstop, rows])
+    if stored and stored.get('etag') == etag:
+        raise PreventUpdate
+    return {'etag': etag, 'stop': busstop, 'now': time.time(), 'rows': rows}
+
+
+app.clientside_callback(
+    ClientsideFunction(namespace='buses', function_name='countdown'),
+    Output('buses-table', 'data'),
+    Input('bus-store', 'data'),
+    Input('bus-clock', 'n_intervals'),
+    Input('push-store', 'data'))
+
+
+# Selected lines, docks and stop, and the network totals, follow the
+# server-sent event stream; while it is connected, the polling intervals
+# above are switched off, and the server-rendered tables refresh on pushed
+# changes only
+app.clientside_callback(
+    ClientsideFunction(namespace='push', function_name='drain'),
+    Output('push-store', 'data'),
+    Output('tube-interval', 'disabled'),
+    Output('bus-interval', 'disabled'),
+    Output('history-interval', 'disabled'),
+    Output('totals-interval', 'disabled'),
+    Output('tube-pushed', 'data'),
+    Output('docks-pushed', 'data'),
+    Input('push-clock', 'n_intervals'),
+    Input('lines', 'value'),
+    Input('busstop', 'value'),
+    Input('docks', 'value'))
+
+
+tracing.install(app.server)
+app.server.register_blueprint(api.create_blueprint(
+    tube_feed, bike_feed, arrivals_feed,
+    watch=lambda stop, fetched: scheduler.watch('arrivals', stop, fetched)))
+hub = push.Hub(tube_feed, bike_feed, arrivals_feed,
+               watch=lambda stop, fetched: scheduler.watch(
+                   'arrivals', stop, fetched),
+               correct=eta_tracker.corrected, totals=dock_totals.totals)
+app.server.register_blueprint(push.create_blueprint(hub))
+alert_engine.subscribe(hub.on_alert)
+app.server.register_blueprint(alerts.create_blueprint(alert_engine))
+app.server.register_blueprint(statuslog.create_blueprint(status_log))
+app.server.register_blueprint(profiles.create_blueprint(profile_store))
+app.server.register_blueprint(planner.create_blueprint(
+    commute_planner, profile_store, watch=warm))
+app.server.register_blueprint(
+    walkgraph.create_blueprint(walk_graph, bike_feed))
+app.server.register_blueprint(routes.create_blueprint(
+    route_feed, watch=lambda route: scheduler.watch('routes', route)))
+
+
+@app.server.route('/metrics')
+def metrics_endpoint():
+    return flask.Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
+
+@app.server.after_request
+def record_response_size(response):
+    # Only label the dynamic routes; assets would blow up the cardinality
+    if (flask.request.path == '/_dash-update-component'
+            and not response.direct_passthrough):
+        metrics.RESPONSE_BYTES.labels(flask.request.path).observe(
+            response.calculate_content_length() or 0)
+    return response
+
 
 if __name__ == "__main__":
+    # The reloader's parent process only watches files; poll in the child
+    if os.environ.get('WERKZEUG_RUN_MAIN'):
+        scheduler.start()
     app.run_server(debug=True)
         
@@ -0,0 +1,249 @@
+/*
+ * Clientside callbacks, run in the browser without a server round-trip.
+ */
+(function() {
+    var no_update = function() {
+        return window.dash_clientside.no_update;
+    };
+
+    /*
+     * The server-sent event stream for the selected lines, docks and stop.
+     * `tube_changes` and `dock_changes` count the diffs after the initial
+     * state, for the tables rendered on the server to follow.
+     */
+    var stream = {source: null, query: null, connected: false,
+                  dirty: false, tube: {}, arrivals: {}, totals: null,
+                  tube_changes: 0, dock_changes: 0, seen: {}, sent: {},
+                  retry: null, backoff: 0};
+    /* Reconnection backoff after a refused or failed stream, ms */
+    var MIN_BACKOFF = 5000;
+    var MAX_BACKOFF = 300000;
+
+    function apply(target, diff) {
+        Object.keys(diff.changed).forEach(function(key) {
+            target[key] = diff.changed[key];
+        });
+        diff.removed.forEach(function(key) {
+            delete target[key];
+        });
+        stream.dirty = true;
+    }
+
+    /* Whether an event follows the initial state of its kind */
+    function later(kind) {
+        var seen = stream.seen[kind];
+        stream.seen[kind] = true;
+        return seen;
+    }
+
+    /* A change count for Dash, if it moved since last handed over */
+    function changes(kind, count) {
+        if (!count || stream.sent[kind] === count) {
+            return no_update();
+        }
+        stream.sent[kind] = count;
+        return count;
+    }
+
+    function connect() {
+        stream.retry = null;
+        var source = new EventSource('/api/stream?' + stream.query);
+        source.onopen = function() {
+            // Each connection starts with the full state again
+            stream.tube = {};
+            stream.arrivals = {};
+            stream.totals = null;
+            stream.seen = {};
+            stream.backoff = 0;
+            stream.connected = true;
+            stream.dirty = true;
+        };
+        source.onerror = function() {
+            stream.connected = false;
+            stream.dirty = true;
+            if (source.readyState !== EventSource.CLOSED ||
+                    stream.source !== source) {
+                return;  // the browser reconnects by itself
+            }
+            // Refused (eg the worker's streams are all taken): keep
+            // polling, and try again later, backing off
+            stream.backoff = Math.min(MAX_BACKOFF,
+                                      (stream.backoff || MIN_BACKOFF / 2) * 2);
+            stream.retry = setTimeout(
+                connect, stream.backoff * (0.5 + Math.random() / 2));
+        };
+        source.addEventListener('tube', function(e) {
+            apply(stream.tube, JSON.parse(e.data));
+            if (later('tube')) {
+                stream.tube_changes += 1;
+            }
+        });
+        source.addEventListener('docks', function() {
+            if (later('docks')) {
+                stream.dock_changes += 1;
+                stream.dirty = true;
+            }
+        });
+        source.addEventListener('totals', function(e) {
+            stream.totals = JSON.parse(e.data).totals;
+            stream.dirty = true;
+        });
+        source.addEventListener('arrivals', function(e) {
+            var diff = JSON.parse(e.data);
+            stream.arrivals[diff.stop] = stream.arrivals[diff.stop] || {};
+            apply(stream.arrivals[diff.stop], diff);
+        });
+        stream.source = source;
+    }
+
+    function subscribe(lines, stop, docks) {
+        if (typeof EventSource === 'undefined') {
+            return;
+        }
+        lines = lines ? [].concat(lines) : [];
+        docks = docks ? [].concat(docks) : [];
+        var query = 'totals=1&lines=' +
+            lines.map(encodeURIComponent).join(',') +
+            '&docks=' + docks.map(encodeURIComponent).join(',') +
+            '&stops=' + (stop ? encodeURIComponent(stop) : '');
+        if (query === stream.query) {
+            return;
+        }
+        if (stream.source) {
+            stream.source.close();
+        }
+        if (stream.retry) {
+            clearTimeout(stream.retry);
+        }
+        stream.source = null;
+        stream.retry = null;
+        stream.backoff = 0;
+        stream.query = query;
+        stream.connected = false;
+        stream.tube = {};
+        stream.arrivals = {};
+        stream.totals = null;
+        stream.dirty = true;
+        connect();
+    }
+
+    var bus_clock = {etag: null, offset: 0};
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        push: {
+            /*
+             * Hand pushed updates to Dash, switch the polling intervals
+             * off while the stream is connected, and count the tube and
+             * dock changes for the server-rendered tables
+             */
+            drain: function(n, lines, stop, docks) {
+                subscribe(lines, stop, docks);
+                if (!stream.dirty) {
+                    return [no_update(), no_update(), no_update(),
+                            no_update(), no_update(), no_update(),
+                            no_update()];
+                }
+                stream.dirty = false;
+                var data = {connected: stream.connected,
+                            tube: Object.assign({}, stream.tube),
+                            totals: stream.totals,
+                            arrivals: JSON.parse(
+                                JSON.stringify(stream.arrivals))};
+                var on = stream.connected;
+                return [data, on, on, on, on,
+                        changes('tube', stream.tube_changes),
+                        changes('docks', stream.dock_changes)];
+            }
+        },
+
+        totals: {
+            /* Network-wide eBikes, pushed while the stream is connected */
+            text: function(polled, pushed) {
+                if (pushed && pushed.connected && pushed.totals) {
+                    return 'Total eBikes Available: ' + pushed.totals.ebikes;
+                }
+                return polled || no_update();
+            }
+        },
+
+        tube: {
+            /* Rows of the status snapshot for the selected line(s) */
+            filter_lines: function(store, lines, pushed) {
+                if (!store) {
+                    return no_update();
+                }
+                if (typeof lines === 'string') {
+                    lines = [lines];
+                }
+                if (!lines) {
+                    return [];
+                }
+                var live = (pushed && pushed.tube) || {};
+                return store.rows.filter(function(row) {
+                    return lines.indexOf(row.Line) !== -1;
+                }).map(function(row) {
+                    return row.Line in live ?
+                        {Line: row.Line, Status: live[row.Line]} : row;
+                });
+            },
+
+            /* The last day's status changes of the selected line(s) */
+            filter_history: function(store, lines) {
+                if (!store) {
+                    return no_update();
+                }
+                if (typeof lines === 'string') {
+                    lines = [lines];
+                }
+                return store.rows.filter(function(row) {
+                    return (lines || []).indexOf(row.Line) !== -1;
+                });
+            }
+        },
+
+        buses: {
+            /*
+             * Arrivals table with ETAs counted down from the browser's
+             * clock, corrected by its offset from the server's when the
+             * data came. Pushed arrivals replace the stored ones.
+             */
+            countdown: function(store, n, pushed) {
+                if (!store) {
+                    return [];
+                }
+                if (store.etag !== bus_clock.etag) {
+                    bus_clock.etag = store.etag;
+                    bus_clock.offset = store.now - Date.now() / 1000;
+                }
+                var rows = store.rows;
+                var live = pushed && pushed.arrivals &&
+                    pushed.arrivals[store.stop];
+                if (live) {
+                    rows = Object.keys(live).map(function(reg) {
+                        var bus = live[reg];
+                        return {Route: bus.route,
+                                Destination: bus.destination,
+                                ETA: bus.eta, Reg: reg};
+                    }).sort(function(a, b) {
+                        return a.ETA - b.ETA;
+                    });
+                }
+                var now = Date.now() / 1000 + bus_clock.offset;
+                var table = [];
+                rows.forEach(function(row) {
+                    var wait = Math.floor((row.ETA - now) / 60);
+                    if (row.ETA - now < -30) {
+                        return;  // left the stop
+                    }
+                    table.push({
+                        Route: row.Route,
+                        Destination: row.Destination,
+                        ETA: wait < 1 ? 'due now' : 'due in ' + wait + ' min',
+                        Reg: row.Reg
+                    });
+                });
+                return table;
+            }
+        }
+    });
+})();
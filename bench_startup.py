@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Startup budget check for worker cold starts.
+
+Imports the app in a fresh interpreter under `python -X importtime`, with
+TfL replaced by the synthetic upstream from loadtest.py so the network is
+not measured, and reports the slowest top-level imports. Exits non-zero
+if the import takes longer than the budget or pulls in a module that
+should stay off the startup path:
+
+    python bench_startup.py --budget-ms 600
+
+@author: VK
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+from collections import namedtuple
+
+
+BUDGET_MS = 600
+# Heavy modules that only specific, lazily loaded features may import
+FORBIDDEN = ('pandas', 'plotly.express', 'plotly.io', 'numpy', 'IPython')
+
+PRELUDE = """
+import csv, time
+import loadtest, upstream
+with open('stations_static.csv') as f:
+    docks = {row['ID']: row['Name'] for row in csv.DictReader(f)}
+upstream.client.transport = loadtest.SyntheticTfL(docks)
+upstream.client.limiter = None
+start = time.perf_counter()
+import app
+print('wall_us', int((time.perf_counter() - start) * 1e6))
+"""
+
+Entry = namedtuple('Entry', 'module self_us cumulative_us depth')
+
+
+def parse_importtime(stderr: str):
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        entries.append(Entry(name.strip(), int(self_us), int(cumulative_us),
+                             depth))
+    return entries
+
+
+def measure():
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', PRELUDE],
+        cwd=here, capture_output=True, text=True, check=True)
+    wall_us = int(proc.stdout.split('wall_us')[-1])
+    return wall_us, parse_importtime(proc.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--budget-ms', type=float, default=BUDGET_MS)
+    parser.add_argument('--top', type=int, default=15)
+    opts = parser.parse_args()
+
+    wall_us, entries = measure()
+    # importtime lists a module after everything it imports, so app's
+    # direct imports are the depth-1 entries just before it
+    end = next(i for i, e in enumerate(entries) if e.module == 'app')
+    start = end
+    while start > 0 and entries[start - 1].depth > 0:
+        start -= 1
+    children = [e for e in entries[start:end] if e.depth == 1]
+    top = sorted(children, key=lambda e: e.cumulative_us, reverse=True)
+    print('{:>10} {:>10}  module'.format('self ms', 'total ms'))
+    for e in top[:opts.top]:
+        print('{:>10.1f} {:>10.1f}  {}'.format(
+            e.self_us / 1000, e.cumulative_us / 1000, e.module))
+    print()
+    print('import app: {:.0f} ms, budget {:.0f} ms'.format(
+        wall_us / 1000, opts.budget_ms))
+
+    failures = []
+    if wall_us / 1000 > opts.budget_ms:
+        failures.append('over budget')
+    loaded = {e.module for e in entries}
+    heavy = sorted(m for m in FORBIDDEN if m in loaded)
+    if heavy:
+        failures.append('imported at startup: ' + ', '.join(heavy))
+    if failures:
+        print('FAIL: ' + '; '.join(failures))
+        sys.exit(1)
+    print('OK')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn settings
+
+The app is imported once in the master (preload) so the static data (dock
+and bus stop lists, layout) is built once and shared copy-on-write with
+every worker. The collector is kept off while it is built and then
+frozen, so neither collections in the master nor in the workers write to
+those pages.
+"""
+
+import gc
+import os
+import shutil
+import tempfile
+
+
+preload_app = True
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+# Threaded workers, as each open /api/stream holds a thread (see push.py)
+threads = int(os.environ.get('GUNICORN_THREADS', 40))
+bind = '0.0.0.0:' + os.environ.get('PORT', '8000')
+# Workers write their metrics here, and each /metrics scrape merges them
+metrics_dir = os.environ.get('COMMUTE_METRICS_DIR') or os.path.join(
+    tempfile.gettempdir(), 'vk-commute-metrics')
+# The polling worker leaves its TfL responses here for the others
+responses_dir = os.environ.get('COMMUTE_RESPONSES_DIR') or os.path.join(
+    tempfile.gettempdir(), 'vk-commute-responses')
+
+# Building the static data allocates lots of long-lived objects; collecting
+# meanwhile would only touch (and later unshare) them.
+gc.disable()
+
+
+def on_starting(server):
+    # Counters of a previous run's workers would be summed in
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    shutil.rmtree(responses_dir, ignore_errors=True)
+
+
+def when_ready(server):
+    # The stop search index is built on first use; build it here instead,
+    # so it is shared too. Likewise the walking graph's ID index.
+    import app
+    app.stop_index.prepare()
+    app.walk_graph.prepare()
+
+
+def pre_fork(server, worker):
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    gc.enable()
+
+    import metrics
+    metrics.share(metrics_dir)
+
+    # Fresh connections and locks; a record or replay archive is opened by
+    # the worker itself on its first request
+    import upstream
+    upstream.client.after_fork()
+    upstream.client.share(responses_dir)
+
+    import app
+    app.scheduler.start()
+
+
+def child_exit(server, worker):
+    # Keep the exited worker's counters in the totals, drop its gauges
+    import metrics
+    metrics.retire(metrics_dir, worker.pid)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Historical datasets of dock availability, line status and bus arrivals.
+
+Recorded archives (see replay.py) are exported to Parquet, one dataset per
+kind of entity, partitioned by (UTC) date:
+
+    history/docks/date=2022-06-08/<archive>.parquet
+    history/tube/date=2022-06-08/<archive>.parquet
+    history/arrivals/date=2022-06-08/<archive>.parquet
+
+Rows in each file are sorted by entity (dock ID, line, stop) and then
+time, and written in row groups of ROW_GROUP rows, so the min/max
+statistics of a row group cover a narrow range of entities. `query`
+passes its predicates down to pyarrow: a date range skips whole
+partitions, and an ID list or time range skips row groups whose
+statistics rule them out, so months of history are not read to answer a
+question about a few docks.
+
+    python history.py export history/ tfl-*.zip
+    python history.py query history/ docks --ids BikePoints_109 \\
+        --start 2022-06-01 --end 2022-07-01
+
+pyarrow is only needed here, and is not a dependency of the app:
+
+    pip install pyarrow
+
+@author: VK
+"""
+
+import argparse
+import codecs
+import json
+import os
+import xml.etree.ElementTree as ET
+import zipfile
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+import timeutil
+from aggregates import parse_dock
+from replay import INDEX, META
+from upstream import BIKE_URL, BUS_URL, TUBE_URL
+
+
+ROW_GROUP = 64 * 1024
+KINDS = ('docks', 'tube', 'arrivals')
+ENTITY = {'docks': 'ident', 'tube': 'line', 'arrivals': 'stop'}
+STOP_PREFIX, STOP_SUFFIX = BUS_URL.split('{stopid}')
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('history datasets need pyarrow: '
+                          'pip install pyarrow') from None
+    return pyarrow
+
+
+def _schemas(pa):
+    ts = pa.timestamp('ms', tz='UTC')
+    return {
+        'docks': pa.schema([
+            ('time', ts), ('ident', pa.string()), ('bikes', pa.int16()),
+            ('ebikes', pa.int16()), ('spaces', pa.int16()),
+            ('docks', pa.int16()), ('modified', ts)]),
+        'tube': pa.schema([
+            ('time', ts), ('line', pa.string()), ('status', pa.string())]),
+        'arrivals': pa.schema([
+            ('time', ts), ('stop', pa.string()), ('vehicle', pa.string()),
+            ('route', pa.string()), ('destination', pa.string()),
+            ('towards', pa.string()), ('expected', ts)]),
+        }
+
+
+def _parsed(ts: str):
+    try:
+        return timeutil.parse_iso(ts)
+    except ValueError:
+        return None
+
+
+def dock_rows(when, content: bytes):
+    data = json.loads(content)
+    for dockinfo in data if isinstance(data, list) else [data]:
+        dock = parse_dock(dockinfo)
+        yield {'time': when, 'ident': dock.ident, 'bikes': dock.bikes,
+               'ebikes': dock.ebikes, 'spaces': dock.spaces,
+               'docks': dock.docks, 'modified': _parsed(dock.modified)}
+
+
+def tube_rows(when, content: bytes):
+    if content.startswith(codecs.BOM_UTF8):
+        content = content[len(codecs.BOM_UTF8):]
+    for child in ET.fromstring(content):
+        yield {'time': when, 'line': child[1].attrib['Name'],
+               'status': child[2].attrib['Description']}
+
+
+def arrival_rows(when, content: bytes):
+    for bus in json.loads(content):
+        yield {'time': when, 'stop': bus['naptanId'],
+               'vehicle': bus['vehicleId'], 'route': bus['lineId'],
+               'destination': bus['destinationName'],
+               'towards': bus['towards'],
+               'expected': _parsed(bus['expectedArrival'])}
+
+
+def classify(url: str):
+    """(kind, row parser) for a recorded URL, or None"""
+    if url == TUBE_URL:
+        return 'tube', tube_rows
+    if url.startswith(BIKE_URL):
+        return 'docks', dock_rows
+    if url.startswith(STOP_PREFIX) and url.endswith(STOP_SUFFIX):
+        return 'arrivals', arrival_rows
+    return None
+
+
+def _started(archive: zipfile.ZipFile, index: dict) -> float:
+    try:
+        return json.loads(archive.read(META))['started']
+    except KeyError:
+        # Older archives: the index is written when recording stops
+        stamp = datetime(*archive.getinfo(INDEX).date_time).timestamp()
+        return stamp - max((e['offset'] for entries in index.values()
+                            for e in entries), default=0.0)
+
+
+def read_archive(path: str) -> dict:
+    """{kind: [row, ...]} for every good response in an archive"""
+    rows = defaultdict(list)
+    with zipfile.ZipFile(path) as archive:
+        index = json.loads(archive.read(INDEX))
+        started = _started(archive, index)
+        for url, entries in index.items():
+            found = classify(url)
+            if found is None:
+                continue
+            kind, parse = found
+            for entry in entries:
+                if entry['status'] != 200:
+                    continue
+                when = datetime.fromtimestamp(started + entry['offset'],
+                                              timezone.utc)
+                content = archive.read(entry['entry'])
+                try:
+                    rows[kind].extend(parse(when, content))
+                except (ValueError, KeyError, IndexError, ET.ParseError):
+                    pass  # a malformed response; skip it
+    return rows
+
+
+def export(root: str, archives) -> dict:
+    """
+    Write the archives' rows into the datasets under `root`
+
+    Each archive becomes one file per kind and date, named after it, so
+    exporting an archive again replaces its files.
+
+    Returns
+    -------
+    written : {kind: rows}
+
+    """
+    pa = _pyarrow()
+    schemas = _schemas(pa)
+    written = defaultdict(int)
+    for path in archives:
+        name = os.path.splitext(os.path.basename(path))[0]
+        for kind, rows in read_archive(path).items():
+            by_date = defaultdict(list)
+            for row in rows:
+                by_date[row['time'].date().isoformat()].append(row)
+            for date, day in by_date.items():
+                table = pa.Table.from_pylist(day, schema=schemas[kind])
+                table = table.sort_by([(ENTITY[kind], 'ascending'),
+                                       ('time', 'ascending')])
+                folder = os.path.join(root, kind, 'date=' + date)
+                os.makedirs(folder, exist_ok=True)
+                pa.parquet.write_table(
+                    table, os.path.join(folder, name + '.parquet'),
+                    row_group_size=ROW_GROUP, compression='zstd')
+                written[kind] += len(day)
+    return dict(written)
+
+
+def query(root: str, kind: str, ids=None, start: datetime = None,
+          end: datetime = None, columns=None):
+    """
+    Rows of one dataset, reading only what the predicates allow
+
+    Parameters
+    ----------
+    root : str
+        Directory given to `export`.
+    kind : str
+        'docks', 'tube' or 'arrivals'.
+    ids : list of str, optional
+        Dock IDs, lines or stops to keep.
+    start, end : datetime, optional
+        Half-open time range [start, end). Naive datetimes are UTC.
+    columns : list of str, optional
+
+    Returns
+    -------
+    table : pyarrow.Table
+        Call `.to_pandas()` on it for a DataFrame.
+
+    """
+    pa = _pyarrow()
+    ds = pa.dataset
+    partitioning = ds.partitioning(pa.schema([('date', pa.string())]),
+                                   flavor='hive')
+    dataset = ds.dataset(os.path.join(root, kind), format='parquet',
+                         partitioning=partitioning)
+    ts = pa.timestamp('ms', tz='UTC')
+    predicate = None
+
+    def both(a, b):
+        return b if a is None else a & b
+
+    if ids:
+        predicate = both(predicate, ds.field(ENTITY[kind]).isin(list(ids)))
+    # Date bounds prune whole partitions without opening them; time
+    # bounds prune row groups by their statistics
+    if start is not None:
+        start = _utc(start)
+        predicate = both(predicate,
+                         (ds.field('date') >= start.date().isoformat())
+                         & (ds.field('time') >= pa.scalar(start, type=ts)))
+    if end is not None:
+        end = _utc(end)
+        last = (end - timedelta(microseconds=1)).date().isoformat()
+        predicate = both(predicate,
+                         (ds.field('date') <= last)
+                         & (ds.field('time') < pa.scalar(end, type=ts)))
+    return dataset.to_table(columns=columns, filter=predicate)
+
+
+def _utc(when: datetime) -> datetime:
+    if when.tzinfo is None:
+        return when.replace(tzinfo=timezone.utc)
+    return when.astimezone(timezone.utc)
+
+
+def _when(text: str) -> datetime:
+    return datetime.fromisoformat(text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+    exp = sub.add_parser('export', help='write archives to Parquet')
+    exp.add_argument('root')
+    exp.add_argument('archives', nargs='+')
+    qry = sub.add_parser('query', help='print rows of a dataset')
+    qry.add_argument('root')
+    qry.add_argument('kind', choices=KINDS)
+    qry.add_argument('--ids', nargs='*')
+    qry.add_argument('--start', type=_when)
+    qry.add_argument('--end', type=_when)
+    qry.add_argument('--columns', nargs='*')
+    opts = parser.parse_args()
+
+    if opts.command == 'export':
+        for kind, count in sorted(export(opts.root, opts.archives).items()):
+            print('{:>9} {:>10d} rows'.format(kind, count))
+    else:
+        table = query(opts.root, opts.kind, opts.ids, opts.start, opts.end,
+                      opts.columns)
+        print(table.to_pandas().to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
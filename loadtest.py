@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic multi-user load test for the Dash callback endpoints.
+
+Virtual users run realistic dashboard sessions against `app.server`
+in-process: the initial page load, dock selection, refreshes, periodic
+store updates, and typing a bus stop name into the `busstop` search one
+keystroke at a time before picking a stop. Each action is the same
+`_dash-update-component` POST the browser sends.
+
+TfL is replaced by a synthetic upstream (or a recorded archive, see
+replay.py), so no network is needed. Requests are funnelled through
+`--workers` slots to model a pool of sync gunicorn workers, which gives the
+worker saturation and queueing delay at the chosen concurrency:
+
+    python loadtest.py --users 50 --workers 4 --duration 60
+
+With `--streams N`, N dashboards' server-sent event streams (push.py) are
+held open for the run as well. One process stands for one gunicorn worker
+here, so at most COMMUTE_MAX_STREAMS (32) are accepted and the rest are
+refused with a 503, as the 33rd tab on a worker would be; under gunicorn
+each accepted stream also holds one of the worker's GUNICORN_THREADS.
+
+@author: VK
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+
+def _iso(dt: datetime) -> str:
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+class SyntheticTfL:
+    """
+    Stub transport producing plausible TfL responses
+
+    Responses change every `period` seconds and are cached per period, so
+    generating them costs little next to the app's own work. `latency`
+    (seconds) is slept on every call to stand in for TfL's response time.
+    """
+
+    LINES = ['Bakerloo', 'Central', 'Circle', 'District', 'DLR', 'Elizabeth',
+             'Hammersmith and City', 'Jubilee', 'Metropolitan', 'Northern',
+             'Piccadilly', 'Victoria', 'Waterloo and City',
+             'London Overground', 'Tram']
+    ROUTES = ['8', '25', '55', '205', 'N25', 'N55']
+
+    def __init__(self, docks, latency: float = 0.0, period: float = 30.0):
+        self.docks = docks
+        self.latency = latency
+        self.period = period
+        self._cache = {}
+
+    def _tube(self, rnd):
+        rows = ''.join(
+            '<LineStatus ID="{0}"><BranchDisruptions />'
+            '<Line ID="{0}" Name="{1}" />'
+            '<Status ID="GS" Description="{2}" IsActive="true" />'
+            '</LineStatus>'.format(
+                i, line, 'Good Service' if rnd.random() < 0.8
+                else 'Minor Delays')
+            for i, line in enumerate(self.LINES))
+        return ('\ufeff<?xml version="1.0" encoding="utf-8"?>'
+                '<ArrayOfLineStatus>' + rows + '</ArrayOfLineStatus>'
+                ).encode('utf-8')
+
+    def _dock(self, rnd, ident, name):
+        capacity = rnd.randint(10, 40)
+        bikes = rnd.randint(0, capacity)
+        ebikes = rnd.randint(0, bikes)
+        modified = _iso(datetime.now(timezone.utc)
+                        - timedelta(seconds=rnd.randint(0, 900)))
+        values = [('TerminalName', ident), ('Installed', 'true'),
+                  ('Locked', 'false'), ('InstallDate', ''),
+                  ('RemovalDate', ''), ('Temporary', 'false'),
+                  ('NbBikes', bikes), ('NbEmptyDocks', capacity - bikes),
+                  ('NbDocks', capacity), ('NbStandardBikes', bikes - ebikes),
+                  ('NbEBikes', ebikes)]
+        return {'id': ident, 'commonName': name,
+                'lat': 51.5 + rnd.random() / 10, 'lon': -0.2 + rnd.random() / 5,
+                'additionalProperties': [
+                    {'key': k, 'value': str(v), 'modified': modified}
+                    for k, v in values]}
+
+    def _arrivals(self, rnd, stopid):
+        now = datetime.now(timezone.utc)
+        return [{'vehicleId': 'LX{:02d}BUS'.format(rnd.randint(0, 99)),
+                 'naptanId': stopid,
+                 'lineId': route,
+                 'lineName': route,
+                 'destinationName': rnd.choice(['Ilford', 'Oxford Circus',
+                                                'Holborn']),
+                 'towards': 'Bank',
+                 'direction': 'outbound',
+                 'timeToStation': eta,
+                 'expectedArrival': _iso(now + timedelta(seconds=eta))}
+                for route, eta in ((rnd.choice(self.ROUTES),
+                                    rnd.randint(30, 1800))
+                                   for _ in range(rnd.randint(2, 12)))]
+
+    def _build(self, url, rnd):
+        import upstream
+
+        if url == upstream.TUBE_URL:
+            return 200, self._tube(rnd)
+        if url == upstream.BIKE_URL:
+            return 200, json.dumps(
+                [self._dock(rnd, ident, name)
+                 for ident, name in self.docks.items()]).encode()
+        if url.startswith(upstream.BIKE_URL):
+            ident = url[len(upstream.BIKE_URL):]
+            if ident not in self.docks:
+                return 404, b'{}'
+            return 200, json.dumps(
+                self._dock(rnd, ident, self.docks[ident])).encode()
+        if url.endswith('/arrivals'):
+            stopid = url.rsplit('/', 2)[-2]
+            return 200, json.dumps(self._arrivals(rnd, stopid)).encode()
+        return 404, b'{}'
+
+    def __call__(self, url, timeout):
+        if self.latency:
+            time.sleep(self.latency)
+        bucket = int(time.time() // self.period)
+        key = (url, bucket)
+        response = self._cache.get(key)
+        if response is None:
+            response = self._build(url, random.Random(hash(key)))
+            if len(self._cache) > 10000:
+                self._cache.clear()
+            self._cache[key] = response
+        return response
+
+
+def dash_request(outputs, inputs, changed, state=()):
+    """
+    Body of a `_dash-update-component` POST, as Dash's renderer sends it
+
+    `outputs`, `inputs` and `state` are lists of 'id.property' strings;
+    inputs and state are paired with their values.
+    """
+    def prop(spec, value=None, with_value=False):
+        ident, attr = spec.split('.', 1)
+        d = {'id': ident, 'property': attr}
+        if with_value:
+            d['value'] = value
+        return d
+
+    outs = [prop(o) for o in outputs]
+    return {
+        'output': (outputs[0] if len(outputs) == 1
+                   else '..' + '...'.join(outputs) + '..'),
+        'outputs': outs[0] if len(outs) == 1 else outs,
+        'inputs': [prop(spec, value, True) for spec, value in inputs],
+        'changedPropIds': list(changed),
+        'state': [prop(spec, value, True) for spec, value in state],
+        }
+
+
+class Session:
+    """One virtual user's dashboard session"""
+
+    def __init__(self, rnd, docks, stops):
+        self.rnd = rnd
+        self.docks = docks
+        self.stops = stops
+        self.clicks = defaultdict(int)
+        self.stored = {}
+
+    def received(self, kind, response):
+        """Keep what the browser would store from a response"""
+        if response.status_code != 200:
+            return
+        if kind == 'tube':
+            self.stored['tube'] = (
+                response.get_json()['response']['tube-store']['data'])
+        elif kind == 'busstop':
+            self.stored['bus'] = (
+                response.get_json()['response']['bus-store']['data'])
+        elif kind == 'docks':
+            self.stored['docks'] = (
+                response.get_json()['response']['stations-rows']['data'])
+
+    def pick_docks(self):
+        return self.rnd.sample(list(self.docks), self.rnd.randint(1, 8))
+
+    def tube_store(self, changed='refresh_line.n_clicks'):
+        return ('tube', dash_request(
+            ['tube-store.data'],
+            [('refresh_line.n_clicks', self.clicks['line'] or None),
+             ('tube-interval.n_intervals', self.clicks['tube'] or None)],
+            [changed],
+            [('tube-store.data', self.stored.get('tube'))]))
+
+    def docks_table(self, docks, changed='docks.value'):
+        return ('docks', dash_request(
+            ['stations-table.data', 'stations-rows.data'],
+            [('refresh_dock.n_clicks', self.clicks['dock'] or None),
+             ('docks.value', docks),
+             ('docks-pushed.data', None)],
+            [changed],
+            [('stations-rows.data', self.stored.get('docks'))]))
+
+    def totals(self):
+        return ('totals', dash_request(
+            ['totals-store.data'],
+            [('totals-interval.n_intervals', self.clicks['totals']),
+             ('refresh_dock.n_clicks', self.clicks['dock'] or None)],
+            ['totals-interval.n_intervals']))
+
+    def bus_store(self, stop, changed='busstop.value'):
+        return ('busstop', dash_request(
+            ['bus-store.data'],
+            [('refresh_buses.n_clicks', self.clicks['bus'] or None),
+             ('bus-interval.n_intervals', self.clicks['buses'] or None),
+             ('busstop.value', stop)],
+            [changed],
+            [('bus-store.data', self.stored.get('bus'))]))
+
+    def typing(self):
+        """Keystrokes of a search for a real stop, then the selection"""
+        stopid, label = self.rnd.choice(self.stops)
+        word = max(label.split(), key=len).lower()
+        for n in range(2, min(len(word), 8) + 1):
+            yield ('search', dash_request(
+                ['busstop.options'],
+                [('busstop.search_value', word[:n])],
+                ['busstop.search_value']))
+        yield self.bus_store(stopid)
+
+    def actions(self):
+        """Endless stream of (kind, payload) the user sends"""
+        docks = self.pick_docks()
+        stop = self.rnd.choice(self.stops)[0]
+        # Initial page load fires every callback once. Picking lines is
+        # filtered in the browser, so costs no request.
+        yield self.tube_store()
+        yield self.docks_table(docks)
+        yield self.totals()
+        yield self.bus_store(stop)
+        while True:
+            roll = self.rnd.random()
+            if roll < 0.25:
+                self.clicks['tube'] += 1
+                yield self.tube_store('tube-interval.n_intervals')
+            elif roll < 0.45:
+                self.clicks['line'] += 1
+                yield self.tube_store()
+            elif roll < 0.6:
+                docks = self.pick_docks()
+                yield self.docks_table(docks)
+            elif roll < 0.75:
+                self.clicks['dock'] += 1
+                yield self.docks_table(docks, 'refresh_dock.n_clicks')
+            elif roll < 0.8:
+                self.clicks['totals'] += 1
+                yield self.totals()
+            elif roll < 0.9:
+                yield from self.typing()
+            elif roll < 0.95:
+                self.clicks['buses'] += 1
+                yield self.bus_store(stop, 'bus-interval.n_intervals')
+            else:
+                self.clicks['bus'] += 1
+                yield self.bus_store(stop, 'refresh_buses.n_clicks')
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return float('nan')
+    i = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[i]
+
+
+class Results:
+    def __init__(self):
+        self.latency = defaultdict(list)
+        self.queued = []
+        self.errors = defaultdict(int)
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, kind, queued, service, ok):
+        with self._lock:
+            self.latency[kind].append(queued + service)
+            self.queued.append(queued)
+            self.busy += service
+            if not ok:
+                self.errors[kind] += 1
+
+    def report(self, wall, workers):
+        total = sum(len(v) for v in self.latency.values())
+        print('{:>8} {:>7} {:>8} {:>8} {:>8} {:>7}'.format(
+            'callback', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+        rows = sorted(self.latency.items())
+        rows.append(('all', [x for v in self.latency.values() for x in v]))
+        for kind, values in rows:
+            values = sorted(values)
+            errors = (sum(self.errors.values()) if kind == 'all'
+                      else self.errors[kind])
+            print('{:>8} {:>7d} {:>8.1f} {:>8.1f} {:>8.1f} {:>7d}'.format(
+                kind, len(values),
+                percentile(values, 0.5) * 1000,
+                percentile(values, 0.95) * 1000,
+                percentile(values, 0.99) * 1000,
+                errors))
+        queued = sorted(self.queued)
+        print()
+        print('throughput        {:.1f} req/s'.format(total / wall))
+        print('worker saturation {:.0%} of {} workers'.format(
+            self.busy / (wall * workers), workers))
+        print('queueing p50/p95  {:.1f} / {:.1f} ms'.format(
+            percentile(queued, 0.5) * 1000, percentile(queued, 0.95) * 1000))
+
+
+def open_streams(server, sessions, count) -> tuple:
+    """
+    Open `count` event streams as the dashboards of `sessions` would;
+    the accepted responses, held open, and how many were refused
+    """
+    client = server.test_client()
+    held, refused = [], 0
+    for session in itertools.islice(itertools.cycle(sessions), count):
+        query = 'totals=1&lines=Central&docks={}'.format(
+            ','.join(session.pick_docks()))
+        response = client.get('/api/stream?' + query, buffered=False)
+        if response.status_code != 200:
+            refused += 1
+            continue
+        # Start the generator, so closing it unsubscribes
+        next(iter(response.response))
+        held.append(response)
+    return held, refused
+
+
+def run(server, sessions, workers, duration, think):
+    slots = threading.Semaphore(workers)
+    results = Results()
+    stop = time.monotonic() + duration
+
+    def user(session):
+        client = server.test_client()
+        for kind, payload in session.actions():
+            if time.monotonic() >= stop:
+                return
+            arrived = time.perf_counter()
+            with slots:
+                started = time.perf_counter()
+                response = client.post('/_dash-update-component',
+                                       json=payload)
+                finished = time.perf_counter()
+            # 204 is PreventUpdate, which is a normal answer
+            results.add(kind, started - arrived, finished - started,
+                        response.status_code in (200, 204))
+            session.received(kind, response)
+            if think:
+                time.sleep(session.rnd.expovariate(1.0 / think))
+
+    threads = [threading.Thread(target=user, args=(s,), daemon=True)
+               for s in sessions]
+    begin = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, time.monotonic() - begin
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=20,
+                        help='concurrent virtual users')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='request slots, ie sync gunicorn workers')
+    parser.add_argument('--duration', type=float, default=30.0,
+                        help='seconds to run for')
+    parser.add_argument('--think', type=float, default=1.0,
+                        help='mean pause between user actions, seconds')
+    parser.add_argument('--upstream-latency', type=float, default=0.0,
+                        help='simulated TfL response time, seconds')
+    parser.add_argument('--archive',
+                        help='replay this recorded archive instead of the '
+                        'synthetic upstream')
+    parser.add_argument('--streams', type=int, default=0,
+                        help='event streams to hold open meanwhile')
+    parser.add_argument('--seed', type=int, default=0)
+    opts = parser.parse_args()
+
+    with open('stations_static.csv') as f:
+        docks = {row['ID']: row['Name'] for row in csv.DictReader(f)}
+    with open('BusStops.csv') as f:
+        stops = [(row['Naptan_Atco'], row['Stop_Name'])
+                 for row in csv.DictReader(f)]
+
+    # The upstream has to be swapped before the app is imported, as the
+    # app fetches tube and dock data at import time.
+    import upstream
+    import replay
+
+    upstream.client.limiter = None
+    if opts.archive:
+        upstream.client.transport = replay.Replayer(opts.archive, speed=0)
+    else:
+        upstream.client.transport = SyntheticTfL(
+            docks, latency=opts.upstream_latency)
+
+    import app
+    # As gunicorn.conf.py does in the master before forking
+    app.stop_index.prepare()
+
+    rnd = random.Random(opts.seed)
+    sessions = [Session(random.Random(rnd.random()), docks, stops)
+                for _ in range(opts.users)]
+    held, refused = open_streams(app.app.server, sessions, opts.streams)
+    try:
+        results, wall = run(app.app.server, sessions, opts.workers,
+                            opts.duration, opts.think)
+    finally:
+        for response in held:
+            response.close()
+    results.report(wall, opts.workers)
+    if opts.streams:
+        import push
+        print('event streams     {} open, {} refused (503); a worker '
+              'holds at most {}'.format(len(held), refused,
+                                        push.MAX_STREAMS))
+
+
+if __name__ == "__main__":
+    main()
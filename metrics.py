@@ -0,0 +1,522 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Minimal Prometheus-style metrics for the commute app.
+
+Counters, gauges and histograms are kept in a process-local registry and
+rendered in the Prometheus text exposition format (version 0.0.4) by
+`render()`, which `app.py` serves at `/metrics`.
+
+Under gunicorn each worker has its own registry, so a scrape would only
+see the worker that answered it. After `share(directory)` (gunicorn.conf.py
+calls it in every worker) each worker writes its samples to a file in
+`directory` every SHARE_EVERY seconds and on each scrape, and `render()`
+merges the files: counters and histograms are summed over all workers,
+including ones that have exited, so they never go backwards; gauges are
+reported per live worker with a `worker` label. When a worker exits,
+`retire()` (gunicorn's `child_exit`) folds its counters and histograms
+into one file of retired totals and removes its own, dropping its
+gauges, so a new worker reusing the PID starts from zero without the sum
+going back. Files are merged and retired under an `fcntl` lock, so a
+scrape never counts a retiring worker twice or not at all.
+
+The hot path is a dictionary-free `observe`/`inc` on a pre-bound child, so
+callers should bind their label values once (at import) with `labels()`.
+
+@author: VK
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; retiring may race with a scrape
+    fcntl = None
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+SHARE_EVERY = 5.0
+RETIRED_FILE = 'retired.json'
+LOCK_FILE = 'metrics.lock'
+
+
+def _escape(value: str) -> str:
+    return (str(value).replace('\\', r'\\')
+            .replace('\n', r'\n')
+            .replace('"', r'\"'))
+
+
+def _format_labels(names, values, extra=()) -> str:
+    pairs = ['{}="{}"'.format(n, _escape(v))
+             for n, v in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Timer:
+    """
+    Context manager timing a block into a histogram child
+
+    Exceptions raised inside the block are counted on `errors` (if given)
+    and re-raised; the latency is recorded either way.
+    """
+
+    __slots__ = ('hist', 'errors', 'start')
+
+    def __init__(self, hist, errors=None):
+        self.hist = hist
+        self.errors = errors
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.hist.observe(time.perf_counter() - self.start)
+        if exc_type is not None and self.errors is not None:
+            self.errors.inc()
+        return False
+
+
+class _CounterChild:
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class _GaugeChild:
+    __slots__ = ('value', 'func')
+
+    def __init__(self):
+        self.value = 0.0
+        self.func = None
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+
+    def set_function(self, func):
+        """Compute the value lazily, at scrape time, by calling `func()`"""
+        self.func = func
+
+    def samples(self, name, labels):
+        value = self.func() if self.func is not None else self.value
+        if value is not None:
+            yield name, labels, value
+
+
+class _HistogramChild:
+    __slots__ = ('bounds', 'counts', 'sum', 'lock')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self, errors=None) -> _Timer:
+        return _Timer(self, errors)
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'),), counts):
+            cumulative += count
+            yield (name + '_bucket', labels + (('le', _format_value(bound)),),
+                   cumulative)
+        yield name + '_sum', labels, total
+        yield name + '_count', labels, cumulative
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames=(),
+                 registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        (REGISTRY if registry is None else registry).register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """
+        Return the child for the given label values, creating it if needed
+
+        Bind the child once and keep it around on hot paths.
+        """
+        values = tuple(str(v) for v in values)
+        if len(values) != len(self.labelnames):
+            raise ValueError('{} expects labels {}'.format(
+                self.name, self.labelnames))
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def remove(self, *values):
+        """Drop the child for the given label values, if any"""
+        with self._lock:
+            self._children.pop(tuple(str(v) for v in values), None)
+
+    def series(self):
+        """(sample name with labels, value) of every sample"""
+        # copy() is atomic, so children may come and go while rendering
+        for values, child in sorted(self._children.copy().items()):
+            for name, extra, value in child.samples(self.name, ()):
+                yield (name + _format_labels(self.labelnames, values, extra),
+                       value)
+
+    def header(self):
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} {}'.format(self.name, self.kind)
+
+    def collect(self, series=None):
+        yield from self.header()
+        for name, value in self.series() if series is None else series:
+            yield '{} {}'.format(name, _format_value(value))
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(),
+                 buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+
+def _with_label(series: str, name: str, value: str) -> str:
+    label = '{}="{}"'.format(name, _escape(value))
+    if series.endswith('}'):
+        return series[:-1] + ',' + label + '}'
+    return series + '{' + label + '}'
+
+
+def _pid_file(directory: str, pid) -> str:
+    return os.path.join(directory, 'metrics-{}.json'.format(pid))
+
+
+def _load(path: str):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write(path: str, data: dict):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+@contextmanager
+def _locked(directory: str, exclusive: bool):
+    fd = os.open(os.path.join(directory, LOCK_FILE),
+                 os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        os.close(fd)
+
+
+def retire(directory: str, pid):
+    """
+    Fold an exited process's counters and histograms into the retired
+    totals in `directory`, and drop its file (and so its gauges)
+    """
+    path = _pid_file(directory, pid)
+    if not os.path.exists(path):
+        return
+    with _locked(directory, exclusive=True):
+        data = _load(path)
+        if data is not None:
+            retired_path = os.path.join(directory, RETIRED_FILE)
+            retired = _load(retired_path) or {'metrics': {}}
+            gauges = set(data.get('gauges', ()))
+            for name, series in data['metrics'].items():
+                if name in gauges:
+                    continue
+                totals = dict(retired['metrics'].get(name, ()))
+                for sample, value in series:
+                    totals[sample] = totals.get(sample, 0.0) + value
+                retired['metrics'][name] = sorted(totals.items())
+            _write(retired_path, retired)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self.directory = None
+        self._path = None
+
+    def register(self, metric: _Metric):
+        self._metrics.append(metric)
+
+    def share(self, directory: str, every: float = SHARE_EVERY,
+              start: bool = True):
+        """
+        Merge the samples of every process sharing `directory` on render
+
+        Unless `start` is False, this process writes its samples there
+        every `every` seconds from a background thread, and at exit.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.every = every
+        self._path = _pid_file(directory, os.getpid())
+        # A file under this PID is an earlier worker's, not yet retired
+        retire(directory, os.getpid())
+        if start:
+            threading.Thread(target=self._dump_loop, name='metrics',
+                             daemon=True).start()
+            atexit.register(self.dump)
+
+    def dump(self):
+        """Write this process's samples for the others to merge"""
+        _write(self._path, {
+            'time': time.time(),
+            'metrics': {metric.name: list(metric.series())
+                        for metric in self._metrics},
+            'gauges': [metric.name for metric in self._metrics
+                       if metric.kind == 'gauge']})
+
+    def _dump_loop(self):
+        while True:
+            time.sleep(self.every)
+            try:
+                self.dump()
+            except OSError:
+                pass
+
+    def _shared(self):
+        """
+        ({pid: samples} of every process sharing the directory, retired
+        totals)
+        """
+        shared = {}
+        with _locked(self.directory, exclusive=False):
+            for fname in os.listdir(self.directory):
+                if fname.startswith('metrics-') and fname.endswith('.json'):
+                    data = _load(os.path.join(self.directory, fname))
+                    if data is not None:
+                        shared[fname[8:-5]] = data
+            retired = _load(os.path.join(self.directory, RETIRED_FILE))
+        return shared, (retired or {'metrics': {}})['metrics']
+
+    def render(self) -> str:
+        if self.directory is None:
+            lines = []
+            for metric in self._metrics:
+                lines.extend(metric.collect())
+            return '\n'.join(lines) + '\n'
+        self.dump()
+        shared, retired = self._shared()
+        live = time.time() - 3 * self.every
+        lines = []
+        for metric in self._metrics:
+            merged = {}
+            if metric.kind != 'gauge':
+                merged.update(retired.get(metric.name, ()))
+            for pid, data in sorted(shared.items()):
+                series = data['metrics'].get(metric.name, ())
+                if metric.kind == 'gauge':
+                    if data['time'] < live:
+                        continue    # the worker is gone
+                    for name, value in series:
+                        merged[_with_label(name, 'worker', pid)] = value
+                else:
+                    for name, value in series:
+                        merged[name] = merged.get(name, 0.0) + value
+            lines.extend(metric.collect(merged.items()))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def render() -> str:
+    """Render every registered metric in the Prometheus text format"""
+    return REGISTRY.render()
+
+
+def share(directory: str):
+    """Merge the metrics of all processes sharing `directory`"""
+    REGISTRY.share(directory)
+
+
+"""
+Metrics shared by the app
+"""
+
+
+UPSTREAM_LATENCY = Histogram(
+    'commute_upstream_request_seconds',
+    'Wall time of TfL API requests, including the body download.',
+    ['endpoint'])
+UPSTREAM_BYTES = Histogram(
+    'commute_upstream_response_bytes',
+    'Size of TfL API response bodies.',
+    ['endpoint'], buckets=SIZE_BUCKETS)
+UPSTREAM_PARSE = Histogram(
+    'commute_upstream_parse_seconds',
+    'Time spent decoding and parsing TfL API responses.',
+    ['endpoint'])
+UPSTREAM_ERRORS = Counter(
+    'commute_upstream_errors_total',
+    'TfL API requests or parses that raised.',
+    ['endpoint'])
+SNAPSHOT_AGE = Gauge(
+    'commute_snapshot_age_seconds',
+    'Seconds since the last successful TfL API response.',
+    ['endpoint'])
+
+CALLBACK_LATENCY = Histogram(
+    'commute_callback_seconds',
+    'Wall time of Dash callbacks.',
+    ['callback'])
+CALLBACK_ERRORS = Counter(
+    'commute_callback_errors_total',
+    'Dash callbacks that raised (PreventUpdate excluded).',
+    ['callback'])
+RESPONSE_BYTES = Histogram(
+    'commute_http_response_bytes',
+    'Size of HTTP response bodies served by the app.',
+    ['path'], buckets=SIZE_BUCKETS)
+
+
+class UpstreamProbe:
+    """
+    Pre-bound metrics for one upstream endpoint
+
+    Parameters
+    ----------
+    endpoint : str
+        Label value used for every upstream metric, eg 'tube'.
+
+    """
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.latency = UPSTREAM_LATENCY.labels(endpoint)
+        self.size = UPSTREAM_BYTES.labels(endpoint)
+        self.parse_time = UPSTREAM_PARSE.labels(endpoint)
+        self.errors = UPSTREAM_ERRORS.labels(endpoint)
+        self.last_success = None
+        SNAPSHOT_AGE.labels(endpoint).set_function(self.age)
+
+    def age(self):
+        if self.last_success is None:
+            return None
+        return time.time() - self.last_success
+
+    def fetch(self) -> _Timer:
+        """Time a request; errors are counted"""
+        return _Timer(self.latency, self.errors)
+
+    def parse(self) -> _Timer:
+        """Time decoding/parsing of a response; errors are counted"""
+        return _Timer(self.parse_time, self.errors)
+
+    def success(self, nbytes: int):
+        """Record a good response of `nbytes` bytes"""
+        self.size.observe(nbytes)
+        self.last_success = time.time()
+
+
+def timed_callback(func):
+    """
+    Decorator recording latency and errors of a Dash callback
+
+    Apply it below `@app.callback(...)` so Dash registers the wrapper.
+    """
+    # Imported here so this module stays usable without Dash installed
+    from dash.exceptions import PreventUpdate
+
+    latency = CALLBACK_LATENCY.labels(func.__name__)
+    errors = CALLBACK_ERRORS.labels(func.__name__)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except PreventUpdate:
+            raise
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            latency.observe(time.perf_counter() - start)
+
+    return wrapper
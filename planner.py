@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Door-to-door commute planner over the cached live feeds.
+
+A commute is a few predefined options, each a list of legs:
+
+    {"name": "Bike to Bank", "legs": [
+        {"mode": "walk", "minutes": 4},
+        {"mode": "bike", "start": "BikePoints_254",
+         "end": "BikePoints_340", "minutes": 14},
+        {"mode": "tube", "line": "Central", "minutes": 6},
+        {"mode": "bus", "stop": "490001180E", "route": "25",
+         "minutes": 12}]}
+
+`Planner.rank` walks each option through the legs from now: a walk takes
+its minutes; a bus leg waits for the next bus of the route due at the
+stop once there (ETAs corrected as on the dashboard); a tube leg takes
+its minutes stretched by the line's current delays; a bike leg needs a
+bike at the start dock and spaces at the end. Options that can't be done
+now (line suspended, empty dock, no bus due) come last with the reason,
+the rest by arrival time.
+
+Only snapshots already in memory are read, never TfL, so ranking takes
+well under a millisecond per option. Commutes saved with a dashboard (see
+profiles.py) have their docks and stops kept warm by the poller, and
+those POSTed are watched by it while they are asked for, like bus stops.
+
+A walk leg either gives its minutes, or names the dock, bus stop or tube
+station (NaPTAN '940G...' ID) it starts and ends at ("start", "end") to
+take the time from the precomputed walking graph (see walkgraph.py).
+Docks are BikePoint IDs and stops NaPTAN codes; legs naming anything else
+are refused, and of a POSTed option only the docks BikePoint lists are
+watched.
+
+    GET  /api/commute/<profile id>
+    POST /api/commute {"options": [...]}
+
+@author: VK
+"""
+
+import time
+from typing import NamedTuple
+
+import flask
+
+from api import DOCK_ID, STOP_ID, dumps
+
+
+MODES = ('walk', 'bike', 'tube', 'bus')
+MAX_OPTIONS = 8
+MAX_LEGS = 8
+# Ride time multipliers by line status; statuses not listed stop the line
+DELAYS = {
+    'Good Service': 1.0,
+    'Minor Delays': 1.5,
+    'Severe Delays': 2.5,
+    'Reduced Service': 1.5,
+    'Special Service': 1.25,
+    }
+# Undocking and docking a bike, seconds
+BIKE_HANDLING = 60.0
+# Spaces to want at the end dock, as others may take them on the way
+MIN_SPACES = 2
+
+
+class Leg(NamedTuple):
+    mode: str
+    minutes: float
+    line: str = ''      # tube
+    stop: str = ''      # bus
+    route: str = ''     # bus
+    start: str = ''     # bike: dock IDs; walk: dock or stop IDs
+    end: str = ''
+
+
+class Option(NamedTuple):
+    name: str
+    legs: tuple
+
+    def entities(self, kind: str) -> set:
+        """Lines, docks or stops the option depends on"""
+        if kind == 'lines':
+            return {leg.line for leg in self.legs if leg.mode == 'tube'}
+        if kind == 'docks':
+            return {dock for leg in self.legs if leg.mode == 'bike'
+                    for dock in (leg.start, leg.end)}
+        if kind == 'stops':
+            return {leg.stop for leg in self.legs if leg.mode == 'bus'}
+        raise ValueError(kind)
+
+
+class Infeasible(Exception):
+    """Raised by a leg that can't be done now"""
+
+
+_NEEDS = {'walk': (), 'bike': ('start', 'end'), 'tube': ('line',),
+          'bus': ('stop', 'route')}
+# Patterns of the fields naming a place; walks go between docks or stops
+_PLACES = {'bike': (DOCK_ID,), 'bus': (STOP_ID,),
+           'walk': (DOCK_ID, STOP_ID)}
+
+
+def parse_leg(spec: dict) -> Leg:
+    """
+    Raises
+    ------
+    ValueError
+        If the leg is not a valid spec.
+
+    """
+    if not isinstance(spec, dict) or spec.get('mode') not in MODES:
+        raise ValueError('each leg needs a mode, one of ' + ', '.join(MODES))
+    mode = spec['mode']
+    # A walk between two places is timed from the walking graph
+    places = mode == 'walk' and ('start' in spec or 'end' in spec)
+    minutes = spec.get('minutes', 0.0 if places else None)
+    if isinstance(minutes, bool) or not isinstance(minutes, (int, float)) \
+            or not 0 <= minutes <= 600:
+        raise ValueError('each leg needs its minutes')
+    fields = {}
+    for name in ('start', 'end') if places else _NEEDS[mode]:
+        value = spec.get(name)
+        if not isinstance(value, str) or not value:
+            raise ValueError('{} legs need a {}'.format(mode, name))
+        if name in ('start', 'end', 'stop') and not any(
+                p.fullmatch(value) for p in _PLACES[mode]):
+            raise ValueError('invalid {} of a {} leg: {:.40}'.format(
+                name, mode, value))
+        fields[name] = value
+    return Leg(mode, float(minutes), **fields)
+
+
+def parse_option(spec: dict) -> Option:
+    """
+    Raises
+    ------
+    ValueError
+        If the option is not a valid spec.
+
+    """
+    if not isinstance(spec, dict):
+        raise ValueError('each option needs a name and legs')
+    name, legs = spec.get('name'), spec.get('legs')
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError('each option needs a name')
+    if not isinstance(legs, list) or not 0 < len(legs) <= MAX_LEGS:
+        raise ValueError('each option needs 1 to {} legs'.format(MAX_LEGS))
+    return Option(name.strip()[:80], tuple(parse_leg(leg) for leg in legs))
+
+
+def parse_options(specs) -> tuple:
+    if not isinstance(specs, (list, tuple)) or len(specs) > MAX_OPTIONS:
+        raise ValueError('at most {} options'.format(MAX_OPTIONS))
+    return tuple(parse_option(spec) for spec in specs)
+
+
+def describe_option(option: Option) -> dict:
+    """The spec of an option, as parsed by `parse_option`"""
+    legs = []
+    for leg in option.legs:
+        spec = {'mode': leg.mode, 'minutes': leg.minutes}
+        names = ('start', 'end') if leg.start else _NEEDS[leg.mode]
+        spec.update((name, getattr(leg, name)) for name in names)
+        legs.append(spec)
+    return {'name': option.name, 'legs': legs}
+
+
+class Planner:
+    """
+    Ranks commute options from the feeds' latest snapshots
+
+    Parameters
+    ----------
+    tube_feed, bike_feed, arrivals_feed : snapshots.Feed
+    correct : callable, optional
+        `correct(bus) -> ETA` in epoch seconds, eg
+        `accuracy.EtaTracker.corrected`.
+    exclude : callable, optional
+        `exclude(dock) -> bool` for docks whose counts can't be trusted.
+    walking : callable, optional
+        `walking(a, b) -> seconds or None` between two docks or stops,
+        eg `walkgraph.WalkGraph.seconds_between`.
+
+    """
+
+    def __init__(self, tube_feed, bike_feed, arrivals_feed, correct=None,
+                 exclude=None, walking=None):
+        self.tube_feed = tube_feed
+        self.bike_feed = bike_feed
+        self.arrivals_feed = arrivals_feed
+        self.correct = correct
+        self.exclude = exclude
+        self.walking = walking
+
+    def _walk(self, leg: Leg, t: float):
+        if not leg.start:
+            return t + 60 * leg.minutes, ''
+        seconds = None
+        if self.walking is not None:
+            seconds = self.walking(leg.start, leg.end)
+        if seconds is None:
+            raise Infeasible('no walking time from {} to {}'.format(
+                leg.start, leg.end))
+        return t + seconds, ''
+
+    def _tube(self, leg: Leg, t: float):
+        status = self.tube_feed.latest().data.get(leg.line)
+        if status is None:
+            raise Infeasible('no live status for ' + leg.line)
+        factor = DELAYS.get(status)
+        if factor is None:
+            raise Infeasible('{}: {}'.format(leg.line, status))
+        return t + 60 * leg.minutes * factor, '' if factor == 1 else status
+
+    def _bike(self, leg: Leg, t: float):
+        docks = self.bike_feed.latest().data
+        start, end = docks.get(leg.start), docks.get(leg.end)
+        for ident, dock in ((leg.start, start), (leg.end, end)):
+            if dock is None or self.exclude is not None \
+                    and self.exclude(dock):
+                raise Infeasible('no reliable counts for ' + ident)
+        if start.bikes < 1:
+            raise Infeasible('no bikes at ' + start.name)
+        if end.spaces < MIN_SPACES:
+            raise Infeasible('no spaces at ' + end.name)
+        note = '{} bikes, {} spaces'.format(start.bikes, end.spaces)
+        return t + 60 * leg.minutes + BIKE_HANDLING, note
+
+    def _bus(self, leg: Leg, t: float):
+        snapshot = self.arrivals_feed.latest(leg.stop)
+        if not snapshot.fetched:
+            raise Infeasible('no live arrivals at ' + leg.stop)
+        etas = [self.correct(bus) if self.correct is not None
+                else bus.eta.timestamp()
+                for bus in snapshot.data.values() if bus.route == leg.route]
+        etas = [eta for eta in etas if eta >= t]
+        if not etas:
+            raise Infeasible('no {} due at {}'.format(leg.route, leg.stop))
+        eta = min(etas)
+        wait = round((eta - t) / 60)
+        return eta + 60 * leg.minutes, '{} min wait'.format(wait)
+
+    def plan(self, option: Option, now: float) -> dict:
+        """When `option` gets there setting off at `now`, leg by leg"""
+        t = now
+        legs = []
+        try:
+            for leg in option.legs:
+                end, note = getattr(self, '_' + leg.mode)(leg, t)
+                legs.append({'mode': leg.mode, 'depart': t, 'arrive': end,
+                             'note': note})
+                t = end
+        except Infeasible as e:
+            return {'name': option.name, 'feasible': False,
+                    'reason': str(e), 'arrive': None, 'minutes': None,
+                    'legs': legs}
+        return {'name': option.name, 'feasible': True, 'reason': '',
+                'arrive': t, 'minutes': round((t - now) / 60, 1),
+                'legs': legs}
+
+    def rank(self, options, now: float = None) -> list:
+        """Plans of `options`, those possible now first, soonest first"""
+        if now is None:
+            now = time.time()
+        plans = [self.plan(option, now) for option in options]
+        plans.sort(key=lambda p: (not p['feasible'], p['arrive'] or 0.0))
+        return plans
+
+
+def create_blueprint(planner: Planner, store, watch=None) -> flask.Blueprint:
+    """
+    Blueprint ranking commutes under `/api/commute`
+
+        GET  /api/commute/<profile id>
+        POST /api/commute {"options": [...]}
+
+    `watch(kind, key)` is called for the lines, docks and stops of the
+    options (kinds as in `Option.entities`), eg to keep them polled;
+    docks only if the planner's BikePoint snapshot lists them.
+    """
+    bp = flask.Blueprint('planner', __name__, url_prefix='/api/commute')
+
+    def respond(options):
+        if watch is not None:
+            docks = planner.bike_feed.latest().data
+            for kind in ('lines', 'docks', 'stops'):
+                for key in set().union(*(o.entities(kind) for o in options)):
+                    if kind != 'docks' or key in docks:
+                        watch(kind, key)
+        return flask.Response(dumps({'plans': planner.rank(options)}),
+                              mimetype='application/json')
+
+    @bp.route('', methods=['POST'])
+    def rank():
+        body = flask.request.get_json(silent=True) or {}
+        if not isinstance(body, dict):
+            flask.abort(400, 'send a JSON object')
+        try:
+            options = parse_options(body.get('options'))
+        except ValueError as e:
+            flask.abort(400, str(e))
+        return respond(options)
+
+    @bp.route('/<ident>', methods=['GET'])
+    def saved(ident):
+        profile = store.open(ident)
+        if profile is None:
+            flask.abort(404)
+        return respond(profile.commute)
+
+    return bp
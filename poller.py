@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Background polling of the TfL feeds at a rate that follows their changes.
+
+Each `FeedJob` keeps one feed (or one key of a keyed feed, eg one bus stop)
+warm. After every poll it counts how much changed since the previous one,
+using the feed's own evidence where there is some: BikePoint `modified`
+timestamps, line status changes, or arrival churn at a stop. It folds that
+into an exponentially weighted change rate, and sets the next interval so
+that about `target` changes are expected per poll, within the job's
+bounds. Quiet feeds (eg docks overnight) back off to the upper bound, and
+busy ones (rush hour) tighten to the lower bound.
+
+Bus stops are only polled while someone is looking at them: `watch()`
+registers or refreshes a stop, and stops not watched for IDLE_TTL seconds
+are dropped. Keys passed to `pin()` (eg those of saved dashboards, see
+profiles.py) are polled until unpinned instead, up to MAX_PINNED per
+feed, by the polling worker
+only (below): the others would only read its shared responses, so they
+leave them to expire, and take them over if they are elected.
+
+The scheduler runs in one daemon thread per worker, with background
+priority for the rate limiter. Call `start()` after forking.
+
+Workers on a host elect one poller through an `fcntl` lock on LOCK_FILE;
+it keeps the lock until it exits, when another worker takes over. The
+poller always polls TfL and shares each response (`Upstream.share`). The
+other workers run the same jobs but take the shared response when it is
+newer than their last and no older than the job's longest interval, and
+only poll TfL themselves otherwise, eg for a bus stop only they watch.
+So each URL is polled about once per host rather than once per worker.
+
+A job that raises is logged and retried with exponential backoff, up to
+MAX_BACKOFF seconds, without stopping the others.
+
+@author: VK
+"""
+
+import heapq
+import itertools
+import logging
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; every worker polls for itself
+    fcntl = None
+
+import metrics
+import ratelimit
+import timeutil
+from snapshots import changed_keys
+from upstream import UpstreamError
+
+
+IDLE_TTL = 600.0
+# Most keys of one feed kept warm by `pin()`, each a TfL call per interval
+MAX_PINNED = int(os.environ.get('COMMUTE_MAX_PINNED', 300))
+MAX_BACKOFF = 900.0
+LOCK_FILE = os.environ.get(
+    'COMMUTE_POLLER_LOCK',
+    os.path.join(tempfile.gettempdir(), 'vk-commute-poller.lock'))
+
+log = logging.getLogger(__name__)
+
+INTERVAL = metrics.Gauge(
+    'commute_poll_interval_seconds',
+    'Current polling interval chosen for a feed or stop.',
+    ['feed', 'key'])
+CHANGE_RATE = metrics.Gauge(
+    'commute_poll_change_rate',
+    'Smoothed rate of observed changes per second for a feed or stop.',
+    ['feed', 'key'])
+POLLS = metrics.Counter(
+    'commute_polls_total',
+    'Background polls, by feed and outcome.',
+    ['feed', 'outcome'])
+LEADING = metrics.Gauge(
+    'commute_poller_leading',
+    'Whether this worker polls TfL for the others (1) or not (0).')
+
+
+def dock_changes(previous, current, since: float) -> int:
+    """Docks whose TfL `modified` time is later than `since`"""
+    changes = 0
+    for dock in current.data.values():
+        try:
+            if timeutil.epoch(dock.modified) > since:
+                changes += 1
+        except ValueError:
+            pass
+    return changes
+
+
+def status_changes(previous, current, since: float) -> int:
+    """Lines whose status differs from the previous poll"""
+    return len(changed_keys(previous.data, current.data))
+
+
+def arrival_churn(previous, current, since: float, shift: float = 60.0) -> int:
+    """
+    Buses that appeared, left or moved their ETA by more than `shift` s
+    """
+    old, new = previous.data, current.data
+    churn = len(old.keys() ^ new.keys())
+    for reg in old.keys() & new.keys():
+        if abs((new[reg].eta - old[reg].eta).total_seconds()) > shift:
+            churn += 1
+    return churn
+
+
+def route_churn(previous, current, since: float, shift: float = 60.0) -> int:
+    """
+    Vehicles on a route that appeared, left, or moved their next ETA by
+    more than `shift` s
+    """
+    old, new = previous.data, current.data
+    churn = len(old.keys() ^ new.keys())
+    for vehicle in old.keys() & new.keys():
+        if abs(new[vehicle].calls[0].eta - old[vehicle].calls[0].eta) > shift:
+            churn += 1
+    return churn
+
+
+class FeedJob:
+    """
+    Keeps one feed key fresh at an adaptive interval
+
+    Parameters
+    ----------
+    feed : snapshots.Feed
+    key : str or None
+        Key of keyed feeds, eg a stop ID.
+    count_changes : callable
+        `count_changes(previous, current, since) -> int` changes between
+        two snapshots, `since` being the time of the previous poll.
+    bounds : (float, float)
+        Shortest and longest interval, seconds.
+    target : float
+        Changes to aim for per poll.
+    alpha : float
+        Weight of the newest observation in the change rate.
+
+    """
+
+    def __init__(self, feed, key, count_changes, bounds, target=1.0,
+                 alpha=0.3):
+        self.feed = feed
+        self.key = key
+        self.count_changes = count_changes
+        self.low, self.high = bounds
+        self.target = target
+        self.alpha = alpha
+        self.rate = None
+        self.interval = (self.low * self.high) ** 0.5
+        self.seen = None
+        self.last_poll = None
+        self.last_wanted = time.time()
+        label = '' if key is None else str(key)
+        INTERVAL.labels(feed.name, label).set_function(lambda: self.interval)
+        CHANGE_RATE.labels(feed.name, label).set_function(lambda: self.rate)
+        self._ok = POLLS.labels(feed.name, 'ok')
+        self._failed = POLLS.labels(feed.name, 'error')
+        self._shared = POLLS.labels(feed.name, 'shared')
+
+    @property
+    def name(self):
+        return (self.feed.name, self.key)
+
+    def observe(self, changes: int, elapsed: float):
+        """Fold a poll's change count into the rate and pick the interval"""
+        observed = changes / max(elapsed, 1e-3)
+        self.rate = (observed if self.rate is None
+                     else self.alpha * observed + (1 - self.alpha) * self.rate)
+        if self.rate <= 0:
+            self.interval = self.high
+        else:
+            self.interval = min(self.high,
+                                max(self.low, self.target / self.rate))
+
+    def _adopt(self):
+        snapshot = self.feed.adopt(self.key)
+        if snapshot is None or snapshot.age > self.high or (
+                self.seen is not None
+                and snapshot.fetched <= self.seen.fetched):
+            return None
+        return snapshot
+
+    def run(self, leading: bool = True) -> float:
+        """
+        Poll once; returns the delay until the next poll
+
+        Unless `leading`, a response shared by the polling worker is taken
+        instead of calling TfL when there is a recent one.
+        """
+        now = time.time()
+        current = None if leading else self._adopt()
+        if current is not None:
+            self._shared.inc()
+        else:
+            try:
+                current = self.feed.refresh(self.key)
+            except UpstreamError:
+                self._failed.inc()
+                return self.interval
+            self._ok.inc()
+        # Compare with what this job saw last, not feed.latest(): user
+        # requests may have refreshed the feed in between
+        if self.seen is not None:
+            changes = self.count_changes(self.seen, current, self.last_poll)
+            self.observe(changes, now - self.last_poll)
+        self.seen, self.last_poll = current, now
+        return self.interval
+
+    def forget(self):
+        """Stop exporting this job's metrics"""
+        label = '' if self.key is None else str(self.key)
+        INTERVAL.remove(self.feed.name, label)
+        CHANGE_RATE.remove(self.feed.name, label)
+
+
+class Task:
+    """A function the scheduler calls every `interval` seconds"""
+
+    key = None
+
+    def __init__(self, name: str, func, interval: float):
+        self.name = name
+        self.func = func
+        self.interval = interval
+
+    def run(self, leading: bool = True) -> float:
+        self.func()
+        return self.interval
+
+    def forget(self):
+        pass
+
+
+class Scheduler:
+    """
+    Runs FeedJobs in one thread, each at its own adaptive interval
+
+    With a `lock_path`, only the worker holding the lock polls TfL for
+    every job (see above); without one, this scheduler always does.
+    """
+
+    def __init__(self, idle_ttl: float = IDLE_TTL, lock_path: str = None):
+        self.idle_ttl = idle_ttl
+        self.lock_path = lock_path
+        self.leading = lock_path is None or fcntl is None
+        self.jobs = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._factories = {}
+        self._pinned = {}
+        self._failures = {}
+        self._lock_fd = None
+        LEADING.labels().set_function(lambda: int(self.leading))
+
+    def add(self, job: FeedJob, delay: float = 0.0):
+        with self._cond:
+            self.jobs[job.name] = job
+            heapq.heappush(self._heap,
+                           (time.monotonic() + delay, next(self._seq), job))
+            self._cond.notify()
+        return job
+
+    def keyed(self, feed, count_changes, bounds, target=1.0):
+        """Declare how to build jobs for keys of `feed` passed to watch()"""
+        self._factories[feed.name] = (feed, count_changes, bounds, target)
+
+    def watch(self, feed_name: str, key, fetched: bool = True):
+        """
+        Keep `key` of a keyed feed warm until it goes unwatched
+
+        Unless `fetched` is False, the caller is taken to have just
+        fetched it, so the first poll waits for the shortest interval.
+        """
+        with self._cond:
+            job = self.jobs.get((feed_name, key))
+            if job is not None:
+                job.last_wanted = time.time()
+                return
+            feed, count_changes, bounds, target = self._factories[feed_name]
+            self.add(FeedJob(feed, key, count_changes, bounds, target),
+                     delay=bounds[0] if fetched else 0.0)
+
+    def pin(self, feed_name: str, keys):
+        """
+        Keep exactly `keys` of a keyed feed warm, however long unwatched
+
+        Keys pinned before and not now go back to expiring when unwatched.
+        Beyond MAX_PINNED keys, the rest are left out.
+        """
+        keys = frozenset(keys)
+        if len(keys) > MAX_PINNED:
+            log.warning('pinning %d of %d keys of %s', MAX_PINNED,
+                        len(keys), feed_name)
+            keys = frozenset(sorted(keys)[:MAX_PINNED])
+        with self._cond:
+            before = self._pinned.get(feed_name, frozenset())
+            self._pinned[feed_name] = keys
+        if self.leading:
+            for key in keys - before:
+                self.watch(feed_name, key, fetched=False)
+
+    def _expired(self, job: FeedJob) -> bool:
+        return (job.key is not None
+                and not (self.leading and job.key in self._pinned.get(
+                    job.feed.name, ()))
+                and time.time() - job.last_wanted > self.idle_ttl)
+
+    def elect(self) -> bool:
+        """Whether this worker polls TfL; takes the lock if it is free"""
+        if self.leading:
+            return True
+        try:
+            if self._lock_fd is None:
+                self._lock_fd = os.open(self.lock_path,
+                                        os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        self.leading = True
+        with self._cond:
+            pinned = list(self._pinned.items())
+        for feed_name, keys in pinned:
+            for key in keys:
+                self.watch(feed_name, key, fetched=False)
+        return True
+
+    def run_once(self, job) -> float:
+        """Run `job`, returning the delay until it is due again"""
+        try:
+            delay = job.run(self.elect())
+        except Exception:
+            failures = self._failures.get(job.name, 0) + 1
+            self._failures[job.name] = failures
+            delay = min(MAX_BACKOFF, job.interval * 2 ** failures)
+            log.exception('poll of %s failed (%d in a row), next in %.0f s',
+                          job.name, failures, delay)
+            return delay
+        self._failures.pop(job.name, None)
+        return delay
+
+    def _next(self):
+        with self._cond:
+            while True:
+                if self._heap:
+                    due = self._heap[0][0] - time.monotonic()
+                    if due <= 0:
+                        return heapq.heappop(self._heap)[2]
+                    self._cond.wait(due)
+                else:
+                    self._cond.wait()
+
+    def loop(self):
+        with ratelimit.background():
+            while True:
+                job = self._next()
+                if self._expired(job):
+                    with self._cond:
+                        self.jobs.pop(job.name, None)
+                    self._failures.pop(job.name, None)
+                    job.forget()
+                    continue
+                delay = self.run_once(job)
+                with self._cond:
+                    heapq.heappush(self._heap, (time.monotonic() + delay,
+                                                next(self._seq), job))
+
+    def start(self):
+        """Start the polling thread (once per process)"""
+        if self._thread is None or not self._thread.is_alive():
+            # A lock file opened before a fork would be shared with the
+            # parent, and with it the lock
+            self._lock_fd = None
+            self.leading = self.lock_path is None or fcntl is None
+            self._cond = threading.Condition()
+            self._thread = threading.Thread(target=self.loop, name='poller',
+                                            daemon=True)
+            self._thread.start()
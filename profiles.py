@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Saved, shareable dashboards and the fetch plan they compile to.
+
+A profile is a named choice of lines, docks and bus stop, saved with
+
+    POST /api/profiles {"name": "Work", "lines": [...], "docks": [...],
+                        "stops": [...]}
+
+and opened as `/?profile=<id>`. A profile can also hold a commute, the
+options `planner.Planner` ranks ("commute": [...], see planner.py). Each
+profile compiles to a `Plan`, the sets of lines, docks and stops it shows
+or its commute needs. `ProfileStore.plan` is the union
+over the active profiles (opened in the last ACTIVE_TTL), kept with a
+reference count per entity, so profiles sharing a dock add it once and a
+profile going idle only drops what no other profile needs. Listeners get
+the plan whenever it changes; the app pins its docks and stops in the
+poller, so a saved dashboard opens from warm caches. Only the worker that
+polls for the others keeps pinned keys warm (see poller.py); the rest
+read its shared responses. Lines need nothing extra: TrackerNet serves
+all of them in one call, which is always polled.
+
+As any visitor can save a profile, each pinned dock or stop costs a TfL
+call per poll: stops have to be NaPTAN codes and docks have to be in the
+current BikePoint snapshot, and once the active profiles keep
+poller.MAX_PINNED docks or stops warm, new ones are refused with a 409
+until some go idle.
+
+Profiles are shared by all workers through an append-only file,
+COMMUTE_PROFILES_FILE, by default `profiles.jsonl` in COMMUTE_DATA_DIR
+(see statuslog.py), which has to be on persistent storage for saved
+links to survive a restart. Opens are written at most once per
+OPEN_EVERY per profile, which is all the activity timeout needs.
+
+@author: VK
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import NamedTuple
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; profiles stay per process there
+    fcntl = None
+
+import flask
+
+import metrics
+import planner
+from api import DOCK_ID, STOP_ID, dumps
+from poller import MAX_PINNED
+
+
+DATA_DIR = os.environ.get(
+    'COMMUTE_DATA_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+PROFILES_FILE = os.environ.get(
+    'COMMUTE_PROFILES_FILE', os.path.join(DATA_DIR, 'profiles.jsonl'))
+ACTIVE_TTL = float(os.environ.get('COMMUTE_PROFILE_TTL', 7 * 24 * 3600))
+OPEN_EVERY = 3600.0
+MAX_NAME = 80
+MAX_ITEMS = 20
+KINDS = ('lines', 'docks', 'stops')
+
+log = logging.getLogger(__name__)
+
+PLANNED = metrics.Gauge(
+    'commute_profile_plan_size',
+    'Entities kept warm for active saved dashboards, by kind.',
+    ['kind'])
+
+
+class PlanFull(ValueError):
+    """Raised when a new profile would pin more than MAX_PINNED keys"""
+
+
+class Profile(NamedTuple):
+    ident: str
+    name: str
+    lines: tuple
+    docks: tuple
+    stops: tuple
+    commute: tuple = ()     # planner.Option
+
+
+class Plan(NamedTuple):
+    lines: frozenset = frozenset()
+    docks: frozenset = frozenset()
+    stops: frozenset = frozenset()
+
+
+def compile_plan(profile: Profile) -> Plan:
+    return Plan(*(frozenset(getattr(profile, kind)).union(
+        *(option.entities(kind) for option in profile.commute))
+        for kind in KINDS))
+
+
+def _ids(values, kind: str) -> tuple:
+    if isinstance(values, str):
+        values = [values]
+    if not isinstance(values, (list, tuple)) \
+            or not all(isinstance(v, str) and v for v in values):
+        raise ValueError('{} must be a list of IDs'.format(kind))
+    if len(values) > MAX_ITEMS:
+        raise ValueError('at most {} {}'.format(MAX_ITEMS, kind))
+    return tuple(dict.fromkeys(values))
+
+
+class ProfileStore:
+    """
+    Saved dashboards, and the fetch plan of the active ones
+
+    Parameters
+    ----------
+    path : str
+        Shared profiles file.
+    active_ttl : float
+        Seconds after its last open that a profile stays in the plan.
+    docks : callable, optional
+        `docks()` gives the current dock IDs, eg the BikePoint snapshot's
+        data, that new profiles may use. Without it any well-formed ID
+        goes.
+
+    """
+
+    def __init__(self, path: str = PROFILES_FILE,
+                 active_ttl: float = ACTIVE_TTL, docks=None):
+        self.path = path
+        self.active_ttl = active_ttl
+        self.docks = docks
+        self.profiles = {}
+        self.opened = {}
+        self.plan = Plan()
+        self._active = set()
+        self._counts = {kind: Counter() for kind in KINDS}
+        self._offset = 0
+        self._lock = threading.Lock()
+        self._listeners = []
+        for kind in KINDS:
+            PLANNED.labels(kind).set_function(
+                lambda k=kind: len(getattr(self.plan, k)))
+        self.sync()
+
+    def subscribe(self, listener):
+        """Call `listener(plan)` whenever the plan changes"""
+        self._listeners.append(listener)
+        return listener
+
+    def _append(self, record: dict):
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def _read(self):
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if size == self._offset:
+            return
+        if size < self._offset:
+            # Rewritten; start over
+            self.profiles.clear()
+            self.opened.clear()
+            self._offset = 0
+        with open(self.path, 'rb') as f:
+            f.seek(self._offset)
+            data = f.read(size - self._offset)
+        # Only apply whole lines; a partial one is still being written
+        data = data[:data.rfind(b'\n') + 1]
+        self._offset += len(data)
+        for line in data.splitlines():
+            try:
+                self._apply(json.loads(line))
+            except (ValueError, KeyError, TypeError):
+                log.warning('skipping unreadable line of %s: %.200r',
+                            self.path, line)
+
+    def _apply(self, record: dict):
+        ident = record['id']
+        opened = float(record['time'])
+        if record['op'] == 'save':
+            self.profiles[ident] = Profile(
+                ident, record['name'], *(tuple(record[k]) for k in KINDS),
+                planner.parse_options(record.get('commute', [])))
+        self.opened[ident] = max(self.opened.get(ident, 0.0), opened)
+
+    def sync(self):
+        """
+        Pick up profiles saved or opened by any worker, and expire idle
+        ones; calls the listeners if that changes the plan
+        """
+        with self._lock:
+            self._read()
+            now = time.time()
+            active = {ident for ident, opened in self.opened.items()
+                      if ident in self.profiles
+                      and now - opened < self.active_ttl}
+            if active == self._active:
+                return
+            for ident, sign in ([(i, 1) for i in active - self._active]
+                                + [(i, -1) for i in self._active - active]):
+                plan = compile_plan(self.profiles[ident])
+                for kind in KINDS:
+                    counts = self._counts[kind]
+                    counts.update({key: sign for key in getattr(plan, kind)})
+                    for key in getattr(plan, kind):
+                        if counts[key] <= 0:
+                            del counts[key]
+            self._active = active
+            plan = Plan(*(frozenset(self._counts[kind]) for kind in KINDS))
+            changed = plan != self.plan
+            self.plan = plan
+        if changed:
+            for listener in self._listeners:
+                listener(plan)
+
+    def save(self, name: str, lines, docks, stops, commute=()) -> Profile:
+        """
+        Save a new profile; it is active until unused for `active_ttl`
+
+        Raises
+        ------
+        PlanFull
+            If the active profiles keep too many docks or stops warm to
+            add this one's.
+        ValueError
+            If the name, the ID lists or the commute options are not
+            valid.
+
+        """
+        if not isinstance(name, str) or not name.strip():
+            raise ValueError('name the dashboard')
+        name = name.strip()[:MAX_NAME]
+        lines, docks, stops = (_ids(lines, 'lines'), _ids(docks, 'docks'),
+                               _ids(stops, 'stops'))
+        commute = planner.parse_options(commute)
+        self._check(compile_plan(Profile('', name, lines, docks, stops,
+                                         commute)))
+        ident = uuid.uuid4().hex[:10]
+        self._append({'op': 'save', 'id': ident, 'name': name,
+                      'lines': lines, 'docks': docks, 'stops': stops,
+                      'commute': [planner.describe_option(option)
+                                  for option in commute],
+                      'time': time.time()})
+        self.sync()
+        return self.profiles[ident]
+
+    def _check(self, plan: Plan):
+        bad = [stop for stop in plan.stops if not STOP_ID.fullmatch(stop)]
+        if bad:
+            raise ValueError('invalid stops: ' + ', '.join(sorted(bad)))
+        known = self.docks() if self.docks is not None else None
+        bad = [dock for dock in plan.docks if not DOCK_ID.fullmatch(dock)
+               or known is not None and dock not in known]
+        if bad:
+            raise ValueError('unknown docks: ' + ', '.join(sorted(bad)))
+        self.sync()
+        for kind in ('docks', 'stops'):
+            if len(getattr(self.plan, kind) | getattr(plan, kind)) \
+                    > MAX_PINNED:
+                raise PlanFull('too many {} kept warm for saved dashboards; '
+                               'try again later'.format(kind))
+
+    def get(self, ident: str):
+        """The profile, or None"""
+        self.sync()
+        return self.profiles.get(ident)
+
+    def open(self, ident: str):
+        """The profile, marked as used so it stays in the plan; or None"""
+        profile = self.get(ident)
+        every = min(OPEN_EVERY, self.active_ttl / 2)
+        if profile is not None \
+                and time.time() - self.opened.get(ident, 0.0) > every:
+            self._append({'op': 'open', 'id': ident, 'time': time.time()})
+            self.sync()
+        return profile
+
+
+def describe(profile: Profile) -> dict:
+    return {'id': profile.ident, 'name': profile.name,
+            'lines': profile.lines, 'docks': profile.docks,
+            'stops': profile.stops,
+            'commute': [planner.describe_option(option)
+                        for option in profile.commute]}
+
+
+def create_blueprint(store: ProfileStore) -> flask.Blueprint:
+    """
+    Blueprint managing saved dashboards under `/api/profiles`
+
+        POST /api/profiles          {"name", "lines", "docks", "stops",
+                                     "commute"}
+        GET  /api/profiles/<id>
+
+    """
+    bp = flask.Blueprint('profiles', __name__, url_prefix='/api/profiles')
+
+    def respond(obj, status=200):
+        return flask.Response(dumps(obj), status=status,
+                              mimetype='application/json')
+
+    @bp.route('', methods=['POST'])
+    def save():
+        body = flask.request.get_json(silent=True) or {}
+        if not isinstance(body, dict):
+            flask.abort(400, 'send a JSON object')
+        try:
+            profile = store.save(body.get('name'), body.get('lines', []),
+                                 body.get('docks', []), body.get('stops', []),
+                                 body.get('commute', []))
+        except PlanFull as e:
+            flask.abort(409, str(e))
+        except ValueError as e:
+            flask.abort(400, str(e))
+        return respond(describe(profile), 201)
+
+    @bp.route('/<ident>', methods=['GET'])
+    def get(ident):
+        profile = store.get(ident)
+        if profile is None:
+            flask.abort(404)
+        return respond(describe(profile))
+
+    return bp
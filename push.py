@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Server-sent events with live diffs of the snapshot feeds.
+
+    GET /api/stream?lines=Central,Jubilee&docks=BikePoints_109&stops=490001180E
+
+A client subscribes to the lines, docks and bus stops it shows and gets an
+event whenever one of them changes:
+
+    event: tube
+    id: tube:42
+    data: {"version":42,"changed":{"Central":"Minor Delays"},"removed":[]}
+
+`docks` events look the same, and `arrivals` events carry the stop as
+well. With `alerts=<rule id>,...` (see alerts.py), `alert` events carry
+each alert as it fires, and with `totals=1`, `totals` events carry the
+network-wide availability whenever it changes. The first events after
+connecting hold the full current state of every subscription, so a client
+applies diffs from there; a bus stop no worker has polled yet starts
+empty and fills in with the first poll. Versions are per worker and a
+stream stays on one worker, so after a reconnect a client should start
+again from the new full state. An idle stream gets a comment line every
+HEARTBEAT seconds to keep proxies from closing it.
+
+The `Hub` subscribes to the feeds and finds a change's subscribers
+through a per-entity index, so a change costs in proportion to who
+watches it, not to the number of open streams. Each stream holds a
+server thread, so gunicorn runs threaded workers (gunicorn.conf.py) and a
+worker accepts at most MAX_STREAMS of them, leaving the rest of its
+threads for ordinary requests. Beyond that a stream is refused with a 503
+and a Retry-After; the dashboard then keeps polling and tries the stream
+again with exponential backoff (assets/clientside.js).
+
+@author: VK
+"""
+
+import itertools
+import os
+import threading
+from collections import defaultdict, deque
+
+import flask
+
+import metrics
+from api import STOP_ID, dumps, query_ids
+from upstream import UpstreamError
+
+
+HEARTBEAT = 15.0
+MAX_STREAMS = int(os.environ.get('COMMUTE_MAX_STREAMS', 32))
+# Seconds a refused client is asked to wait before trying again
+RETRY_AFTER = 60
+MAX_QUEUE = 256
+
+STREAMS = metrics.Gauge(
+    'commute_push_streams',
+    'Open server-sent event streams in this worker.')
+EVENTS = metrics.Counter(
+    'commute_push_events_total',
+    'Server-sent events queued for clients, by feed.',
+    ['feed'])
+
+
+def encode_dock(dock) -> dict:
+    return dock._asdict()
+
+
+def encode_bus(bus, correct=None) -> dict:
+    eta = bus.eta.timestamp() if correct is None else correct(bus)
+    return {'route': bus.route, 'destination': bus.dest,
+            'towards': bus.towards, 'eta': eta}
+
+
+def event(kind: str, version: int, payload: dict) -> bytes:
+    return b'event: %s\nid: %s:%d\ndata: %s\n\n' % (
+        kind.encode(), kind.encode(), version, dumps(payload))
+
+
+def diff(old, new, keys, encode=None) -> tuple:
+    """
+    ({key: encoded new value}, [removed keys]) for `keys` of two mappings
+
+    With `encode`, keys whose encoded values are equal are left out, eg
+    buses whose only change is a field the clients don't see.
+    """
+    changed, removed = {}, []
+    for key in keys:
+        if key not in new:
+            if key in old:
+                removed.append(key)
+            continue
+        value = new[key] if encode is None else encode(new[key])
+        if key in old and (old[key] if encode is None
+                           else encode(old[key])) == value:
+            continue
+        changed[key] = value
+    return changed, removed
+
+
+class Subscriber:
+    """One open stream: what it watches and the events waiting for it"""
+
+    def __init__(self, lines, docks, stops, alerts=(), totals=False):
+        self.lines = set(lines)
+        self.docks = set(docks)
+        self.stops = set(stops)
+        self.alerts = set(alerts)
+        self.totals = totals
+        self.queue = deque()
+        self.overflowed = False
+        self.cond = threading.Condition()
+
+    def put(self, data: bytes):
+        with self.cond:
+            if len(self.queue) >= MAX_QUEUE:
+                # Too slow to keep up; drop it and let it resync
+                self.overflowed = True
+            else:
+                self.queue.append(data)
+            self.cond.notify()
+
+    def take(self, timeout: float) -> list:
+        with self.cond:
+            if not self.queue and not self.overflowed:
+                self.cond.wait(timeout)
+            items = list(self.queue)
+            self.queue.clear()
+            return items
+
+
+class Hub:
+    """
+    Fans feed changes out to the streams subscribed to them
+
+    Parameters
+    ----------
+    tube_feed, bike_feed, arrivals_feed : snapshots.Feed
+        As for `api.create_blueprint`.
+    watch : callable, optional
+        `watch(stop, fetched)` is called while a stream follows a bus
+        stop, eg to keep it polled (see `poller.Scheduler.watch`). Stops
+        are never fetched during a request: a stream starts from what is
+        in memory and gets the rest as `arrivals` events once polled.
+    correct : callable, optional
+        `correct(bus)` gives the ETA to send for a bus, in epoch seconds,
+        eg `accuracy.EtaTracker.corrected`.
+    totals : callable, optional
+        `totals() -> dict` of network-wide availability, eg
+        `aggregates.DockAggregates.totals`, for `totals` events. It is
+        read after each BikePoint change, so subscribe it to the feed
+        first.
+
+    """
+
+    def __init__(self, tube_feed, bike_feed, arrivals_feed, watch=None,
+                 correct=None, totals=None):
+        self.feeds = {'tube': tube_feed, 'docks': bike_feed,
+                      'arrivals': arrivals_feed}
+        self.watch = watch
+        self.correct = correct
+        self.totals = totals
+        self._last_totals = None
+        self.subscribers = set()
+        self._index = {'tube': defaultdict(set), 'docks': defaultdict(set),
+                       'arrivals': defaultdict(set),
+                       'alerts': defaultdict(set)}
+        self._lock = threading.Lock()
+        self._events = {kind: EVENTS.labels(kind)
+                        for kind in ('tube', 'docks', 'arrivals', 'alert',
+                                     'totals')}
+        self._alert_seq = itertools.count(1)
+        STREAMS.labels().set_function(lambda: len(self.subscribers))
+        tube_feed.subscribe(self._on_tube)
+        bike_feed.subscribe(self._on_docks)
+        arrivals_feed.subscribe(self._on_arrivals)
+
+    def _entities(self, sub: Subscriber):
+        return (('tube', sub.lines), ('docks', sub.docks),
+                ('arrivals', sub.stops), ('alerts', sub.alerts))
+
+    def subscribe(self, sub: Subscriber) -> bool:
+        """Register `sub` and queue its initial state; False if full"""
+        with self._lock:
+            if len(self.subscribers) >= MAX_STREAMS:
+                return False
+            self.subscribers.add(sub)
+            for kind, keys in self._entities(sub):
+                for key in keys:
+                    self._index[kind][key].add(sub)
+        if sub.lines:
+            snap = self._current('tube')
+            changed, _ = diff({}, snap.data, sub.lines)
+            sub.put(event('tube', snap.version,
+                          {'version': snap.version, 'changed': changed,
+                           'removed': []}))
+        if sub.docks:
+            snap = self._current('docks')
+            changed, _ = diff({}, snap.data, sub.docks, encode_dock)
+            sub.put(event('docks', snap.version,
+                          {'version': snap.version, 'changed': changed,
+                           'removed': []}))
+        if sub.totals and self.totals is not None:
+            snap = self._current('docks')
+            sub.put(event('totals', snap.version,
+                          {'version': snap.version,
+                           'totals': self.totals()}))
+        for stop in sub.stops:
+            snap = self.feeds['arrivals'].latest(stop)
+            changed, _ = diff({}, snap.data, snap.data, self._encode_bus)
+            sub.put(event('arrivals', snap.version,
+                          {'stop': stop, 'version': snap.version,
+                           'changed': changed, 'removed': []}))
+        self.keep_warm(sub)
+        return True
+
+    def _current(self, kind: str):
+        feed = self.feeds[kind]
+        try:
+            return feed.get()
+        except UpstreamError:
+            return feed.latest()
+
+    def unsubscribe(self, sub: Subscriber):
+        with self._lock:
+            self.subscribers.discard(sub)
+            for kind, keys in self._entities(sub):
+                index = self._index[kind]
+                for key in keys:
+                    subs = index.get(key)
+                    if subs is not None:
+                        subs.discard(sub)
+                        if not subs:
+                            del index[key]
+
+    def keep_warm(self, sub: Subscriber):
+        if self.watch is not None:
+            arrivals = self.feeds['arrivals']
+            for stop in sub.stops:
+                self.watch(stop, bool(arrivals.latest(stop).fetched))
+
+    def _encode_bus(self, bus) -> dict:
+        return encode_bus(bus, self.correct)
+
+    def _interested(self, kind: str, keys) -> dict:
+        """{subscriber: keys it watches} among `keys`"""
+        index = self._index[kind]
+        found = defaultdict(set)
+        with self._lock:
+            for key in keys:
+                for sub in index.get(key, ()):
+                    found[sub].add(key)
+        return found
+
+    def _publish(self, kind, snapshot, previous, changed, encode=None):
+        for sub, keys in self._interested(kind, changed).items():
+            updates, removed = diff(previous.data, snapshot.data, keys,
+                                    encode)
+            if updates or removed:
+                sub.put(event(kind, snapshot.version,
+                              {'version': snapshot.version,
+                               'changed': updates, 'removed': removed}))
+                self._events[kind].inc()
+
+    def _on_tube(self, key, snapshot, previous, changed):
+        self._publish('tube', snapshot, previous, changed)
+
+    def _on_docks(self, key, snapshot, previous, changed):
+        self._publish('docks', snapshot, previous, changed, encode_dock)
+        if self.totals is None:
+            return
+        with self._lock:
+            subs = [sub for sub in self.subscribers if sub.totals]
+        if not subs:
+            return
+        totals = self.totals()
+        if totals == self._last_totals:
+            return
+        self._last_totals = totals
+        data = event('totals', snapshot.version,
+                     {'version': snapshot.version, 'totals': totals})
+        for sub in subs:
+            sub.put(data)
+            self._events['totals'].inc()
+
+    def _on_arrivals(self, stop, snapshot, previous, changed):
+        subs = self._interested('arrivals', [stop])
+        if not subs:
+            return
+        updates, removed = diff(previous.data, snapshot.data, changed,
+                                self._encode_bus)
+        if not (updates or removed):
+            return
+        data = event('arrivals', snapshot.version,
+                     {'stop': stop, 'version': snapshot.version,
+                      'changed': updates, 'removed': removed})
+        for sub in subs:
+            sub.put(data)
+            self._events['arrivals'].inc()
+
+    def on_alert(self, alert):
+        """`alerts.AlertEngine` listener"""
+        subs = self._interested('alerts', [alert.rule])
+        if not subs:
+            return
+        data = event('alert', next(self._alert_seq), alert._asdict())
+        for sub in subs:
+            sub.put(data)
+            self._events['alert'].inc()
+
+    def stream(self, sub: Subscriber):
+        """Generate the event stream for a subscribed `sub`"""
+        try:
+            yield b'retry: 5000\n\n'
+            while not sub.overflowed:
+                items = sub.take(HEARTBEAT)
+                if items:
+                    yield b''.join(items)
+                else:
+                    self.keep_warm(sub)
+                    yield b': keepalive\n\n'
+        finally:
+            self.unsubscribe(sub)
+
+
+def create_blueprint(hub: Hub) -> flask.Blueprint:
+    """Blueprint serving `/api/stream` from `hub`"""
+    bp = flask.Blueprint('push', __name__, url_prefix='/api')
+
+    @bp.route('/stream')
+    def stream():
+        sub = Subscriber(query_ids('lines'), query_ids('docks'),
+                         query_ids('stops', STOP_ID), query_ids('alerts'),
+                         flask.request.args.get('totals') == '1')
+        if not (sub.lines or sub.docks or sub.stops or sub.alerts
+                or sub.totals):
+            flask.abort(400, 'subscribe to some lines, docks, stops, '
+                        'alerts or totals')
+        if not hub.subscribe(sub):
+            return flask.Response(
+                'too many streams', status=503, mimetype='text/plain',
+                headers={'Retry-After': str(RETRY_AFTER)})
+        return flask.Response(
+            hub.stream(sub), mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache',
+                     'X-Accel-Buffering': 'no'})
+
+    return bp
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Token-bucket rate limiting of TfL calls, shared by all gunicorn workers.
+
+The bucket lives in a small file (COMMUTE_RATELIMIT_FILE) that every worker
+on the host updates under an exclusive `fcntl` lock, so the limit holds
+for the dyno as a whole rather than per worker.
+
+Callers queue by priority: within a process, interactive requests (user
+callbacks, API calls) are always served before background ones (polling,
+revalidation). Across processes, background requests may not take the
+last `reserve` share of the bucket, which is kept for interactive ones.
+
+Code running on behalf of a background job marks itself with
+
+    with ratelimit.background():
+        ...
+
+@author: VK
+"""
+
+import contextvars
+import heapq
+import itertools
+import os
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; fall back to one bucket per process
+    fcntl = None
+
+import metrics
+
+
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BACKGROUND: 'background'}
+
+# TfL allows 500 requests a minute with an app key
+RATE = float(os.environ.get('COMMUTE_RATE_LIMIT', 8.0))
+BURST = float(os.environ.get('COMMUTE_RATE_BURST', 40.0))
+RESERVE = 0.25
+STATE_FILE = os.environ.get(
+    'COMMUTE_RATELIMIT_FILE',
+    os.path.join(tempfile.gettempdir(), 'vk-commute-ratelimit'))
+TIMEOUTS = {INTERACTIVE: 2.0, BACKGROUND: 30.0}
+
+_priority = contextvars.ContextVar('priority', default=INTERACTIVE)
+
+QUEUE_DEPTH = metrics.Gauge(
+    'commute_ratelimit_queue_depth',
+    'Requests waiting for a TfL rate limit token in this worker.')
+WAIT = metrics.Histogram(
+    'commute_ratelimit_wait_seconds',
+    'Time spent waiting for a TfL rate limit token.',
+    ['priority'])
+THROTTLED = metrics.Counter(
+    'commute_ratelimit_throttled_total',
+    'Requests that had to wait for a TfL rate limit token.',
+    ['priority'])
+REJECTED = metrics.Counter(
+    'commute_ratelimit_rejected_total',
+    'Requests that gave up waiting for a TfL rate limit token.',
+    ['priority'])
+
+
+@contextmanager
+def background():
+    """Run the block with background priority"""
+    token = _priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> int:
+    return _priority.get()
+
+
+class FileBucket:
+    """
+    Token bucket whose state is shared through a locked file
+
+    The file holds two doubles: the token count and the time (epoch
+    seconds) it was last refilled.
+    """
+
+    _STATE = struct.Struct('<dd')
+
+    def __init__(self, rate: float, burst: float, path: str):
+        self.rate = rate
+        self.burst = burst
+        self.path = path
+        self._local = [burst, time.time()]
+        self._lock = threading.Lock()
+        self._fd = None
+
+    def _open(self):
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        return self._fd
+
+    def after_fork(self):
+        self._fd = None
+        self._lock = threading.Lock()
+
+    def _take(self, state, floor):
+        tokens, stamp = state
+        now = time.time()
+        tokens = min(self.burst, tokens + max(0.0, now - stamp) * self.rate)
+        if tokens >= floor + 1:
+            return (tokens - 1, now), 0.0
+        return (tokens, now), (floor + 1 - tokens) / self.rate
+
+    def try_take(self, floor: float = 0.0):
+        """
+        Take a token if more than `floor` + 1 are left
+
+        Returns the seconds to wait before trying again, 0 on success.
+        """
+        with self._lock:
+            if fcntl is None:
+                state, wait = self._take(self._local, floor)
+                self._local = list(state)
+                return wait
+            fd = self._open()
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                raw = os.pread(fd, self._STATE.size, 0)
+                state = (self._STATE.unpack(raw)
+                         if len(raw) == self._STATE.size
+                         else (self.burst, time.time()))
+                state, wait = self._take(state, floor)
+                os.pwrite(fd, self._STATE.pack(*state), 0)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            return wait
+
+
+class Limiter:
+    """
+    Priority queue in front of a shared token bucket
+
+    Only the caller at the head of the queue (lowest priority value, then
+    arrival order) tries the bucket, so interactive requests overtake any
+    background ones waiting in the same process.
+    """
+
+    def __init__(self, bucket: FileBucket, reserve: float = RESERVE):
+        self.bucket = bucket
+        self.reserve = reserve
+        self._waiters = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        QUEUE_DEPTH.labels().set_function(lambda: len(self._waiters))
+        self._wait = {p: WAIT.labels(n) for p, n in PRIORITY_NAMES.items()}
+        self._throttled = {p: THROTTLED.labels(n)
+                           for p, n in PRIORITY_NAMES.items()}
+        self._rejected = {p: REJECTED.labels(n)
+                          for p, n in PRIORITY_NAMES.items()}
+
+    def after_fork(self):
+        self._waiters = []
+        self._cond = threading.Condition()
+        self.bucket.after_fork()
+
+    def acquire(self, priority: int = None, timeout: float = None) -> bool:
+        """
+        Wait for a token; False if none came within `timeout` seconds
+
+        `priority` defaults to that of the calling context (see
+        `background()`), and `timeout` to the priority's default.
+        """
+        if priority is None:
+            priority = _priority.get()
+        if timeout is None:
+            timeout = TIMEOUTS[priority]
+        floor = self.reserve * self.bucket.burst if priority else 0.0
+        start = time.monotonic()
+        deadline = start + timeout
+        me = (priority, next(self._seq))
+        waited = False
+        with self._cond:
+            heapq.heappush(self._waiters, me)
+            try:
+                while True:
+                    if self._waiters[0] == me:
+                        wait = self.bucket.try_take(floor)
+                        if not wait:
+                            return True
+                    else:
+                        wait = 0.05
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._rejected[priority].inc()
+                        return False
+                    if not waited:
+                        waited = True
+                        self._throttled[priority].inc()
+                    self._cond.wait(min(wait, remaining))
+            finally:
+                self._waiters.remove(me)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+                self._wait[priority].observe(time.monotonic() - start)
+
+
+limiter = (Limiter(FileBucket(RATE, BURST, STATE_FILE)) if RATE > 0
+           else None)
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Record and replay TfL responses, for offline load tests and benchmarks.
+
+Both modes are transports for `upstream.Upstream`, so everything above the
+transport (timeouts, caching, parsing, callbacks) runs unchanged. They are
+switched on with the COMMUTE_UPSTREAM environment variable:
+
+    COMMUTE_UPSTREAM=record:tfl.zip python app.py
+    COMMUTE_UPSTREAM=replay:tfl.zip COMMUTE_REPLAY_SPEED=10 python app.py
+
+An archive is a zip file holding one deflated entry per response and an
+`index.json` listing, per URL, when each response arrived (seconds since
+the recording began), its status and how long TfL took to answer.
+`meta.json` holds the wall-clock time the recording began.
+
+On replay, a request for a URL gets the response that was current at the
+same point of the recording, with the clock running `speed` times faster
+than real time (speed 0 steps through the recorded responses one per
+request, ignoring time). The recording loops when it runs out. Set
+COMMUTE_REPLAY_LATENCY=1 to also sleep for the recorded response time.
+
+Under gunicorn each worker records to its own archive, `<path>-<pid>.zip`
+(or wherever `{pid}` is in the path), and opens the archive it replays
+itself.
+
+Archives can be recorded without running the app:
+
+    python replay.py record tfl.zip --stops 490001180E --duration 3600
+
+@author: VK
+"""
+
+import argparse
+import atexit
+import json
+import os
+import threading
+import time
+import zipfile
+from bisect import bisect_right
+from collections import defaultdict
+from functools import lru_cache
+
+
+INDEX = 'index.json'
+META = 'meta.json'
+
+
+class Recorder:
+    """
+    Transport that passes requests to `inner` and archives the responses
+
+    Each process writes its own archive, opened on its first request:
+    `{pid}` in the path is replaced by the process ID, and a forked process
+    (a gunicorn worker, with the recorder built in the master) gets
+    `-<pid>` added to a path without it. Call `close()` (also done at
+    exit) to write the index; until then the archive is not readable.
+    """
+
+    def __init__(self, inner, path: str):
+        self.inner = inner
+        self.template = path
+        self.path = None
+        self.index = defaultdict(list)
+        self._zip = None
+        self._pid = None
+        self._creator = os.getpid()
+        self._closed = False
+        # Archives inherited from the parent, which is still writing them;
+        # held so they are never closed (or collected) here
+        self._inherited = []
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def reset(self):
+        """Called in a forked worker (`Upstream.after_fork`)"""
+        self._lock = threading.Lock()
+
+    def _open(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        if self._zip is not None:
+            self._inherited.append(self._zip)
+        template = self.template
+        if pid != self._creator and '{pid}' not in template:
+            root, ext = os.path.splitext(template)
+            template = root + '-{pid}' + ext
+        self.path = template.format(pid=pid)
+        self.start = time.monotonic()
+        self.started = time.time()
+        self.index = defaultdict(list)
+        self._count = 0
+        self._zip = zipfile.ZipFile(self.path, 'w', zipfile.ZIP_DEFLATED)
+        self._pid = pid
+
+    def __call__(self, url, timeout):
+        sent = time.monotonic()
+        status, content = self.inner(url, timeout)
+        received = time.monotonic()
+        with self._lock:
+            if not self._closed:
+                self._open()
+                name = 'r/{:08d}'.format(self._count)
+                self._count += 1
+                self._zip.writestr(name, content)
+                self.index[url].append({
+                    'offset': round(received - self.start, 3),
+                    'latency': round(received - sent, 3),
+                    'status': status,
+                    'entry': name})
+        return status, content
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            if self._zip is None or self._pid != os.getpid():
+                return  # nothing recorded, or the parent's archive
+            self._zip.writestr(INDEX, json.dumps(self.index))
+            self._zip.writestr(META, json.dumps({'started': self.started}))
+            self._zip.close()
+            self._zip = None
+
+
+class Replayer:
+    """
+    Transport answering from a recorded archive
+
+    Parameters
+    ----------
+    path : str
+        Archive written by `Recorder`.
+    speed : float
+        Replay clock rate; 1 is the original timing, 10 is ten times
+        faster, 0 steps through responses one per request.
+    latency : bool
+        Sleep for the recorded response time (scaled by `speed`).
+
+    URLs that were never recorded get a 404. Each process opens the
+    archive itself, so forked workers don't share a file offset.
+    """
+
+    def __init__(self, path: str, speed: float = 1.0, latency: bool = False):
+        self.path = path
+        self.speed = speed
+        self.latency = latency
+        self._zip = None
+        self._pid = None
+        with zipfile.ZipFile(path) as archive:
+            index = json.loads(archive.read(INDEX))
+        self.index = {url: sorted(entries, key=lambda e: e['offset'])
+                      for url, entries in index.items()}
+        self._offsets = {url: [e['offset'] for e in entries]
+                         for url, entries in self.index.items()}
+        self.duration = max((e[-1]['offset'] for e in self.index.values()),
+                            default=0.0)
+        self.start = time.monotonic()
+        self._steps = defaultdict(int)
+        self._lock = threading.Lock()
+        # Decompressed bodies of the most recently served responses
+        self._body = lru_cache(maxsize=64)(self._read)
+
+    def _pick(self, url):
+        entries = self.index[url]
+        if not self.speed:
+            with self._lock:
+                step = self._steps[url]
+                self._steps[url] = step + 1
+            return entries[step % len(entries)]
+        elapsed = (time.monotonic() - self.start) * self.speed
+        if self.duration > 0:
+            elapsed %= self.duration
+        i = bisect_right(self._offsets[url], elapsed)
+        return entries[max(i - 1, 0)]
+
+    def reset(self):
+        """Called in a forked worker (`Upstream.after_fork`)"""
+        self._lock = threading.Lock()
+
+    def _read(self, name):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._zip = zipfile.ZipFile(self.path)
+                self._pid = os.getpid()
+            return self._zip.read(name)
+
+    def __call__(self, url, timeout):
+        if url not in self.index:
+            return 404, b'[]'
+        entry = self._pick(url)
+        if self.latency:
+            time.sleep(entry['latency'] / (self.speed or 1.0))
+        return entry['status'], self._body(entry['entry'])
+
+
+def configure(client, spec: str = None):
+    """
+    Install a recorder or replayer on an `upstream.Upstream` client
+
+    `spec` defaults to the COMMUTE_UPSTREAM environment variable and is
+    'record:<path>', 'replay:<path>' or empty for live TfL.
+    """
+    spec = os.environ.get('COMMUTE_UPSTREAM', '') if spec is None else spec
+    mode, _, path = spec.partition(':')
+    if mode == 'record':
+        client.transport = Recorder(client.transport, path)
+    elif mode == 'replay':
+        # Replays don't touch TfL, so its rate limit doesn't apply
+        client.limiter = None
+        client.transport = Replayer(
+            path,
+            speed=float(os.environ.get('COMMUTE_REPLAY_SPEED', 1.0)),
+            latency=os.environ.get('COMMUTE_REPLAY_LATENCY') == '1')
+    elif mode:
+        raise ValueError('COMMUTE_UPSTREAM must be record:<path> or '
+                         'replay:<path>, not {!r}'.format(spec))
+    return client.transport
+
+
+def record(path, urls, interval, duration):
+    """Poll `urls` every `interval` seconds into a new archive"""
+    import requests
+    import upstream
+
+    recorder = Recorder(upstream.HTTPTransport(), path)
+    end = time.monotonic() + duration
+    try:
+        while time.monotonic() < end:
+            for url in urls:
+                try:
+                    recorder(url, (3.05, 10.0))
+                except requests.RequestException as e:
+                    print('{}: {}'.format(url, e))
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        recorder.close()
+
+
+def main():
+    import upstream
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+    rec = sub.add_parser('record', help='poll TfL into an archive')
+    rec.add_argument('archive')
+    rec.add_argument('--stops', nargs='*', default=[])
+    rec.add_argument('--docks', nargs='*', default=[])
+    rec.add_argument('--interval', type=float, default=30.0)
+    rec.add_argument('--duration', type=float, default=600.0)
+    info = sub.add_parser('info', help='summarise an archive')
+    info.add_argument('archive')
+    opts = parser.parse_args()
+
+    if opts.command == 'record':
+        urls = ([upstream.TUBE_URL, upstream.BIKE_URL]
+                + [upstream.BIKE_URL + d for d in opts.docks]
+                + [upstream.BUS_URL.format(stopid=s) for s in opts.stops])
+        record(opts.archive, urls, opts.interval, opts.duration)
+    else:
+        replayer = Replayer(opts.archive)
+        print('{:.0f}s recorded'.format(replayer.duration))
+        for url, entries in sorted(replayer.index.items()):
+            print('{:5d}  {}'.format(len(entries), url))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Route-level bus tracking from TfL's line arrivals.
+
+    GET /api/routes/25?stop=490001180E&towards=Ilford
+
+One call to `Line/{route}/Arrivals` holds the predictions for every
+vehicle on a route at every stop ahead of it. `parse_route` turns it into
+{vehicle ID: Vehicle}, each with its upcoming calls sorted by ETA, and
+indexes the calls by stop as well. `next_at` then answers "where is the
+next 25 towards Ilford" for any stop on the route from that one
+response: the buses due at the stop, soonest first, each with the stop it
+reaches next and how many stops away it is.
+
+Routes are polled in the background while someone follows them, like bus
+stops (see poller.py). Route names go into the TfL URL and the poller, so
+only those shaped like a bus route (ROUTE: '25', 'N25', 'SL6', 'C10')
+are accepted, in TfL's lower case.
+
+@author: VK
+"""
+
+import re
+from collections import defaultdict
+from typing import NamedTuple
+
+import flask
+
+import timeutil
+from upstream import UpstreamError
+
+
+MAX_COUNT = 10
+# Up to two letters, up to three digits, and an optional suffix letter
+ROUTE = re.compile(r'[a-z]{0,2}[0-9]{1,3}[a-z]?')
+
+
+class Call(NamedTuple):
+    stop: str
+    name: str
+    eta: float
+
+
+class Vehicle(NamedTuple):
+    ident: str
+    route: str
+    destination: str
+    towards: str
+    direction: str
+    calls: tuple     # upcoming Calls, soonest first
+
+
+class RouteArrivals(dict):
+    """
+    {vehicle ID: Vehicle} for one route
+
+    `stops` maps each stop to [(ETA, vehicle ID, position)], soonest
+    first, where position is the index of the call in the vehicle's
+    `calls`, ie how many stops it has to go before this one.
+    """
+
+    __slots__ = ('stops',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stops = {}
+
+
+def parse_route(response) -> RouteArrivals:
+    """Parse a Line arrivals response into RouteArrivals"""
+    calls = defaultdict(list)
+    info = {}
+    for row in response.json():
+        try:
+            eta = timeutil.epoch(row['expectedArrival'])
+        except ValueError:
+            continue
+        vehicle = row['vehicleId']
+        calls[vehicle].append(Call(row['naptanId'], row['stationName'], eta))
+        info[vehicle] = (row['lineId'], row['destinationName'],
+                         row.get('towards', ''), row.get('direction', ''))
+
+    data = RouteArrivals()
+    stops = defaultdict(list)
+    for vehicle, upcoming in calls.items():
+        upcoming.sort(key=lambda call: call.eta)
+        data[vehicle] = Vehicle(vehicle, *info[vehicle], tuple(upcoming))
+        for position, call in enumerate(upcoming):
+            stops[call.stop].append((call.eta, vehicle, position))
+    for due in stops.values():
+        due.sort()
+    data.stops = dict(stops)
+    return data
+
+
+def _heading(vehicle: Vehicle, towards: str) -> bool:
+    return (towards in vehicle.destination.lower()
+            or towards in vehicle.towards.lower())
+
+
+def next_at(data: RouteArrivals, stop: str, towards: str = None,
+            count: int = 3) -> list:
+    """
+    The next `count` buses due at `stop`, and where they are now
+
+    Parameters
+    ----------
+    data : RouteArrivals
+    stop : str
+        NaPTAN ID of a stop on the route.
+    towards : str, optional
+        Only buses whose destination or 'towards' contains this,
+        ignoring case, eg 'Ilford'.
+    count : int
+
+    """
+    towards = towards.lower() if towards else None
+    found = []
+    for eta, ident, position in data.stops.get(stop, ()):
+        vehicle = data[ident]
+        if towards and not _heading(vehicle, towards):
+            continue
+        upcoming = vehicle.calls[0]
+        found.append({'vehicle': ident, 'route': vehicle.route,
+                      'destination': vehicle.destination,
+                      'towards': vehicle.towards, 'eta': eta,
+                      'stops_away': position,
+                      'next_stop': upcoming.name,
+                      'next_stop_id': upcoming.stop,
+                      'next_eta': upcoming.eta})
+        if len(found) >= count:
+            break
+    return found
+
+
+def create_blueprint(route_feed, watch=None) -> flask.Blueprint:
+    """
+    Blueprint serving `/api/routes/<route>` from a keyed feed of routes
+
+        GET /api/routes/<route>?stop=<NaPTAN ID>&towards=<text>&count=3
+
+    Without `stop`, lists every vehicle on the route with its calls.
+    `watch(route)` is called on each request, eg to keep it polled.
+    """
+    from api import dumps
+
+    bp = flask.Blueprint('routes', __name__, url_prefix='/api/routes')
+
+    @bp.route('/<route>')
+    def route(route):
+        route = route.lower()
+        if not ROUTE.fullmatch(route):
+            flask.abort(400, 'invalid route: {}'.format(route[:20]))
+        try:
+            snapshot = route_feed.get(route)
+        except UpstreamError as e:
+            flask.abort(503, str(e))
+        if watch is not None:
+            watch(route)
+        args = flask.request.args
+        stop = args.get('stop')
+        if stop:
+            count = min(args.get('count', 3, type=int), MAX_COUNT)
+            body = {'route': route, 'stop': stop,
+                    'buses': next_at(snapshot.data, stop,
+                                     args.get('towards'), count)}
+        else:
+            body = {'route': route, 'vehicles': [
+                dict(vehicle._asdict(),
+                     calls=[call._asdict() for call in vehicle.calls])
+                for vehicle in snapshot.data.values()]}
+        return flask.Response(dumps(body), mimetype='application/json')
+
+    return bp
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parsed, versioned snapshots of the TfL feeds.
+
+A `Feed` sits on top of `upstream.client`: it parses each new response
+once, keeps the result keyed by entity (dock ID, line name, ...), bumps a
+version number when the data actually changes, and tells its subscribers
+which entities changed. Consumers such as the aggregates only touch the
+changed entities instead of rebuilding from the whole feed.
+
+@author: VK
+"""
+
+import threading
+import time
+from typing import Any, Callable, Mapping, NamedTuple, Optional
+
+import tracing
+import upstream
+
+
+class Snapshot(NamedTuple):
+    data: Mapping[str, Any]
+    version: int
+    fetched: float
+    stale: bool = False
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.fetched
+
+
+EMPTY = Snapshot({}, 0, 0.0, True)
+
+
+def changed_keys(old: Mapping, new: Mapping) -> set:
+    """Keys added, removed or with a different value between two mappings"""
+    changed = {k for k, v in new.items() if old.get(k) != v}
+    changed.update(k for k in old if k not in new)
+    return changed
+
+
+class Feed:
+    """
+    One TfL endpoint, parsed into a mapping of entity -> record
+
+    Parameters
+    ----------
+    name : str
+        Feed name, eg 'bikepoint'.
+    endpoint : str
+        Upstream endpoint whose policy (timeouts, caching) applies.
+    url : str or callable
+        The URL, or a function of the key for keyed feeds (eg one URL per
+        bus stop).
+    parse : callable
+        `parse(response) -> Mapping`.
+
+    Subscribers are called as `listener(key, snapshot, previous, changed)`
+    whenever the parsed data changes, with `changed` the set of entity keys
+    that differ from `previous`.
+    """
+
+    def __init__(self, name: str, endpoint: str, url, parse: Callable):
+        self.name = name
+        self.endpoint = endpoint
+        self.url = url if callable(url) else (lambda key=None: url)
+        self.parse = parse
+        self.probe = upstream.client.probe(endpoint)
+        self._snapshots = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, listener: Callable):
+        self._listeners.append(listener)
+        return listener
+
+    def latest(self, key=None) -> Snapshot:
+        """The last parsed snapshot, without touching the network"""
+        return self._snapshots.get(key, EMPTY)
+
+    def get(self, key=None) -> Snapshot:
+        """
+        Current snapshot, parsing only if upstream has a newer response
+
+        Raises
+        ------
+        upstream.UpstreamError
+            If nothing has ever been fetched for this key and TfL fails.
+
+        """
+        response = upstream.fetch(self.endpoint, self.url(key))
+        current = self._snapshots.get(key)
+        if current is not None and current.fetched >= response.fetched:
+            if current.stale != response.stale:
+                current = current._replace(stale=response.stale)
+            return current
+        return self.update(key, response)
+
+    def refresh(self, key=None) -> Snapshot:
+        """Fetch from TfL now (see `Upstream.refresh`) and update"""
+        response = upstream.client.refresh(self.endpoint, self.url(key))
+        current = self._snapshots.get(key)
+        if current is not None and current.fetched >= response.fetched:
+            return current._replace(stale=response.stale)
+        return self.update(key, response)
+
+    def adopt(self, key=None) -> Optional[Snapshot]:
+        """
+        Update from the response another worker shared (see
+        `Upstream.adopt`); None if there is none
+        """
+        response = upstream.client.adopt(self.url(key))
+        if response is None:
+            return None
+        current = self._snapshots.get(key)
+        if current is not None and current.fetched >= response.fetched:
+            return current
+        return self.update(key, response)
+
+    def update(self, key, response: upstream.Response) -> Snapshot:
+        with self.probe.parse(), tracing.span('parse', feed=self.name):
+            data = self.parse(response)
+        with self._lock:
+            previous = self._snapshots.get(key, EMPTY)
+            if previous.fetched >= response.fetched:
+                # Another thread got here first with the same or newer data
+                return previous
+            changed = changed_keys(previous.data, data)
+            version = previous.version + 1 if changed else previous.version
+            snapshot = Snapshot(data if changed else previous.data, version,
+                                response.fetched, response.stale)
+            self._snapshots[key] = snapshot
+            if changed:
+                for listener in self._listeners:
+                    listener(key, snapshot, previous, changed)
+        return snapshot
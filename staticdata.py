@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Static data packed for sharing between forked gunicorn workers.
+
+Lists of small dicts and strings are a poor fit for copy-on-write: every
+time a worker reads one, the refcount update dirties the page it lives on,
+so after a few searches each worker holds a private copy of every page.
+`PackedStrings` keeps a whole column in one `str` plus an `array` of
+offsets, which is two objects however many rows there are, so reads only
+touch those two headers and the pages stay shared.
+
+`TrigramIndex` follows the same idea for fuzzy search: every trigram of
+the normalized alphabet has a fixed integer code, so the whole inverted
+index is a few `array`s (offsets by code, and stop numbers) rather than
+a dict of lists.
+
+@author: VK
+"""
+
+import heapq
+import re
+import threading
+from array import array
+from bisect import bisect_right
+from collections import Counter, defaultdict
+
+
+class PackedStrings:
+    """
+    Immutable sequence of strings stored as one newline-joined blob
+
+    Parameters
+    ----------
+    values : iterable of str
+        The strings; they must not contain newlines.
+
+    """
+
+    __slots__ = ('blob', 'starts')
+
+    def __init__(self, values):
+        values = list(values)
+        self.blob = '\n'.join(values) + '\n'
+        starts = array('q', [0])
+        for v in values:
+            starts.append(starts[-1] + len(v) + 1)
+        self.starts = starts
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def __getitem__(self, i: int) -> str:
+        if i < 0:
+            i += len(self)
+        return self.blob[self.starts[i]:self.starts[i + 1] - 1]
+
+    def __iter__(self):
+        return iter(self.blob[:-1].split('\n')) if len(self) else iter(())
+
+    def row_at(self, pos: int) -> int:
+        """Index of the string containing character position `pos`"""
+        return bisect_right(self.starts, pos) - 1
+
+    def find_all(self, needle: str, limit: int = None):
+        """
+        Indices of the strings containing `needle`, in order
+
+        The search runs over the blob in C (`str.find`), skipping to the
+        next string after each hit.
+        """
+        found = []
+        if not needle or '\n' in needle:
+            return found
+        blob, starts = self.blob, self.starts
+        pos = blob.find(needle)
+        while pos != -1:
+            i = bisect_right(starts, pos) - 1
+            found.append(i)
+            if limit is not None and len(found) >= limit:
+                break
+            pos = blob.find(needle, starts[i + 1])
+        return found
+
+
+ALPHABET = ' abcdefghijklmnopqrstuvwxyz0123456789'
+NGRAMS = len(ALPHABET) ** 3
+# Share of a query's trigrams a stop needs to be a candidate
+MIN_SHARE = 0.5
+
+_CODES = {c: i for i, c in enumerate(ALPHABET)}
+_SUFFIX = re.compile(r'_\w*$')
+_NON_ALNUM = re.compile(r'[^a-z0-9]+')
+
+
+def normalize(label: str) -> str:
+    """
+    Lowercase words of a stop name, without punctuation or stop letter
+
+    'HIGHBURY & ISLINGTON STATION <> #_B' -> 'highbury islington station'
+    """
+    label = _SUFFIX.sub('', label.lower()).replace("'", '')
+    return _NON_ALNUM.sub(' ', label).strip()
+
+
+def trigrams(text: str, prefix: bool = False) -> set:
+    """
+    Codes of the trigrams of normalized text, each word padded by spaces
+
+    With `prefix`, the last word is taken to be unfinished and gets no
+    closing space, so 'westm' matches 'westminster'.
+    """
+    codes = _CODES
+    padded = ' ' + text.replace(' ', '  ') + ('' if prefix else ' ')
+    return {(codes[a] * 37 + codes[b]) * 37 + codes[c]
+            for a, b, c in zip(padded, padded[1:], padded[2:])
+            if not (a == b == ' ' or b == c == ' ')}
+
+
+class TrigramIndex:
+    """
+    Inverted index from trigram codes to the strings containing them
+
+    Parameters
+    ----------
+    texts : iterable of str
+        Normalized strings.
+
+    """
+
+    __slots__ = ('offsets', 'postings', 'sizes')
+
+    def __init__(self, texts):
+        # Rows are visited in order, so each code's rows come out sorted
+        buckets = defaultdict(list)
+        sizes = array('H')
+        for i, text in enumerate(texts):
+            codes = trigrams(text)
+            sizes.append(len(codes))
+            for code in codes:
+                buckets[code].append(i)
+        postings = array('i')
+        offsets = array('i', bytes(4 * (NGRAMS + 1)))
+        for code in range(NGRAMS):
+            rows = buckets.get(code)
+            if rows:
+                postings.extend(rows)
+            offsets[code + 1] = len(postings)
+        self.offsets = offsets
+        self.postings = postings
+        self.sizes = sizes
+
+    def rows(self, code: int) -> array:
+        return self.postings[self.offsets[code]:self.offsets[code + 1]]
+
+    def shared(self, codes) -> Counter:
+        """{row: how many of `codes` it contains}"""
+        counts = Counter()
+        for code in codes:
+            counts.update(self.rows(code))
+        return counts
+
+
+class StopIndex:
+    """
+    Bus stop IDs and labels, with typo-tolerant search
+
+    Parameters
+    ----------
+    ids, labels : iterable of str
+        NaPTAN ATCO codes and stop names, in matching order.
+
+    """
+
+    def __init__(self, ids, labels):
+        labels = list(labels)
+        self.ids = PackedStrings(ids)
+        self.labels = PackedStrings(labels)
+        self.lower = PackedStrings(label.lower() for label in labels)
+        self.normal = None
+        self.grams = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def prepare(self):
+        """
+        Build the fuzzy search index, unless built already
+
+        This takes a few hundred milliseconds, so it is left out of
+        startup and done by the first search, or up front in the gunicorn
+        master so the workers share it.
+        """
+        with self._lock:
+            if self.grams is None:
+                self.normal = PackedStrings(normalize(label)
+                                            for label in self.labels)
+                self.grams = TrigramIndex(self.normal)
+
+    def option(self, i: int) -> dict:
+        """Dropdown option for stop `i`"""
+        return {"label": self.labels[i], "value": self.ids[i]}
+
+    def search(self, text: str, limit: int = 50) -> list[dict]:
+        """
+        Options for the stops best matching `text`, best first
+
+        Stops sharing at least MIN_SHARE of the query's trigrams are
+        candidates, so 'hiberry corner' finds 'HIGHBURY CORNER'. Stops
+        whose normalized name contains the query outright come first,
+        then the rest by trigram similarity (Dice coefficient). Queries
+        shorter than a trigram, eg 'lb', match anywhere in a name instead,
+        as they can't be told apart from a typo.
+        """
+        query = normalize(text)
+        codes = trigrams(query, prefix=not text.endswith(' '))
+        if not codes or len(query) < 3:
+            # Punctuation only, eg '<>', or one or two letters, which only
+            # make the trigram of a word start
+            return [self.option(i)
+                    for i in self.lower.find_all(text.lower(), limit)]
+        self.prepare()
+        full = len(codes)
+        need = max(1, round(MIN_SHARE * full))
+        shared = self.grams.shared(codes)
+        sizes, normal = self.grams.sizes, self.normal
+
+        def rank(i):
+            n = shared[i]
+            contains = n == full and query in normal[i]
+            return (not contains, -2 * n / (full + sizes[i]), sizes[i])
+
+        found = [i for i, n in shared.items() if n >= need]
+        if limit is None:
+            best = sorted(found, key=rank)
+        else:
+            best = heapq.nsmallest(limit, found, key=rank)
+        return [self.option(i) for i in best]
+
+
+def read_stops(fname: str) -> StopIndex:
+    """Load the bus stop CSV into a StopIndex"""
+    import csv
+
+    with open(fname, newline='') as f:
+        rows = [(row['Naptan_Atco'], row['Stop_Name'])
+                for row in csv.DictReader(f)]
+    return StopIndex((r[0] for r in rows), (r[1] for r in rows))
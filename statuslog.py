@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+History of tube line status changes.
+
+`StatusLog` listens to the TrackerNet feed and appends a record to
+COMMUTE_STATUS_LOG (by default `tube.jsonl` in COMMUTE_DATA_DIR) each
+time a line's status changes, and only then:
+
+    [1654697098.5, "Central", "Minor Delays"]
+
+A status lasts until the line's next record, so a quiet day costs nothing
+and a year of changes fits in a few hundred kilobytes. All workers append
+to the same file under an `fcntl` lock, and a worker first reads what the
+others wrote, so a change they all see is written once. Lines that can't
+be read (eg cut short by a full disk) are logged and skipped.
+
+The log is only as durable as the directory it is in: COMMUTE_DATA_DIR
+defaults to `data/` next to the app rather than a temporary directory,
+and should be a persistent volume where the app's own disk is reset on
+restart (eg a Heroku dyno).
+
+In memory, every line has its change times in an `array` with, next to
+each, the disrupted seconds up to then (statuses other than NORMAL,
+cumulative). Minutes of disruption between two times are the difference
+of two bisected lookups, and a timeline is the bisected slice of changes
+in its range, however long the history.
+
+    GET /api/tube/history?lines=Central&start=2022-06-01&end=2022-07-01
+
+@author: VK
+"""
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; the log is per process there
+    fcntl = None
+
+import flask
+
+import metrics
+
+
+DATA_DIR = os.environ.get(
+    'COMMUTE_DATA_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+STATUS_LOG_FILE = os.environ.get(
+    'COMMUTE_STATUS_LOG', os.path.join(DATA_DIR, 'tube.jsonl'))
+# Statuses that don't count as disruption; lines without a night service
+# are 'Service Closed' every night
+NORMAL = ('Good Service', 'Service Closed')
+DAY = 24 * 3600.0
+
+log = logging.getLogger(__name__)
+
+CHANGES = metrics.Counter(
+    'commute_tube_status_changes_total',
+    'Line status changes written to the status log by this worker.')
+
+
+class LineHistory:
+    """Status changes of one line, with cumulative disrupted seconds"""
+
+    __slots__ = ('times', 'statuses', 'disrupted')
+
+    def __init__(self):
+        self.times = array('d')
+        self.statuses = []
+        self.disrupted = array('d')
+
+    def append(self, when: float, status: str):
+        self.disrupted.append(self.disrupted_until(when))
+        self.times.append(when)
+        self.statuses.append(sys.intern(status))
+
+    def status(self):
+        return self.statuses[-1] if self.statuses else None
+
+    def disrupted_until(self, when: float) -> float:
+        """Disrupted seconds from the first change until `when`"""
+        i = bisect_right(self.times, when) - 1
+        if i < 0:
+            return 0.0
+        ongoing = self.statuses[i] not in NORMAL
+        return self.disrupted[i] + ongoing * (when - self.times[i])
+
+    def changes(self, start: float, end: float) -> list:
+        """[(status, since, until)] overlapping [start, end)"""
+        times = self.times
+        i = max(bisect_right(times, start) - 1, 0)
+        j = bisect_left(times, end)
+        return [(self.statuses[k], times[k],
+                 times[k + 1] if k + 1 < len(times) else None)
+                for k in range(i, j)]
+
+
+class StatusLog:
+    """
+    Append-only log of line status changes, shared by all workers
+
+    Parameters
+    ----------
+    tube_feed : snapshots.Feed
+        TrackerNet line statuses; the log subscribes to it, and records
+        its current snapshot if it has one.
+    path : str
+        The log file.
+
+    """
+
+    def __init__(self, tube_feed, path: str = STATUS_LOG_FILE):
+        self.path = path
+        self.lines = {}
+        self._offset = 0
+        self._lock = threading.Lock()
+        self.sync()
+        tube_feed.subscribe(self.on_tube)
+        current = tube_feed.latest()
+        if current.version:
+            self.on_tube(None, current, None, set(current.data))
+
+    def _read(self):
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if size == self._offset:
+            return
+        if size < self._offset:
+            # Rewritten; start over
+            self.lines.clear()
+            self._offset = 0
+        with open(self.path, 'rb') as f:
+            f.seek(self._offset)
+            data = f.read(size - self._offset)
+        # Only apply whole lines; a partial one is still being written
+        data = data[:data.rfind(b'\n') + 1]
+        self._offset += len(data)
+        for record in data.splitlines():
+            try:
+                when, line, status = json.loads(record)
+                self._apply(float(when), str(line), str(status))
+            except (ValueError, TypeError):
+                log.warning('skipping unreadable line of %s: %.200r',
+                            self.path, record)
+
+    def _apply(self, when: float, line: str, status: str):
+        history = self.lines.get(line)
+        if history is None:
+            history = self.lines[line] = LineHistory()
+        if history.times and when < history.times[-1]:
+            return  # out of order; keep the index sorted
+        history.append(when, status)
+
+    def sync(self):
+        """Pick up changes written by any worker since the last sync"""
+        with self._lock:
+            self._read()
+
+    def on_tube(self, key, snapshot, previous, changed):
+        when = round(snapshot.fetched, 3)
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                         0o600)
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                self._read()
+                records = []
+                for line in sorted(changed):
+                    status = snapshot.data.get(line)
+                    history = self.lines.get(line)
+                    if status is None or history is not None and (
+                            history.status() == status
+                            or history.times[-1] >= when):
+                        continue
+                    records.append([when, line, status])
+                if records:
+                    data = b''.join(json.dumps(r).encode('utf-8') + b'\n'
+                                    for r in records)
+                    os.write(fd, data)
+                    self._offset += len(data)
+                    for record in records:
+                        self._apply(*record)
+                    CHANGES.labels().inc(len(records))
+            finally:
+                os.close(fd)
+
+    def disruption(self, line: str, start: float, end: float) -> float:
+        """Minutes `line` was disrupted in [start, end), as far as logged"""
+        self.sync()
+        history = self.lines.get(line)
+        if history is None:
+            return 0.0
+        end = min(end, time.time())
+        if end <= start:
+            return 0.0
+        return (history.disrupted_until(end)
+                - history.disrupted_until(start)) / 60
+
+    def timeline(self, line: str, start: float, end: float) -> list:
+        """[(status, since, until)] of `line` over [start, end)"""
+        self.sync()
+        history = self.lines.get(line)
+        return [] if history is None else history.changes(start, end)
+
+
+def _timestamp(text: str, default: float) -> float:
+    if not text:
+        return default
+    try:
+        when = datetime.fromisoformat(text)
+    except ValueError:
+        flask.abort(400, 'times are ISO 8601, eg 2022-06-08T09:00')
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when.timestamp()
+
+
+def create_blueprint(log: StatusLog) -> flask.Blueprint:
+    """
+    Blueprint serving status history under `/api/tube/history`
+
+        GET /api/tube/history?lines=a,b&start=<ISO>&end=<ISO>
+
+    The range defaults to the last day; naive times are UTC.
+    """
+    from api import dumps, query_ids
+
+    bp = flask.Blueprint('statuslog', __name__, url_prefix='/api/tube')
+
+    @bp.route('/history')
+    def history():
+        end = _timestamp(flask.request.args.get('end'), time.time())
+        start = _timestamp(flask.request.args.get('start'), end - DAY)
+        log.sync()
+        lines = query_ids('lines') or sorted(log.lines)
+        body = {'start': start, 'end': end, 'lines': {
+            line: {'disrupted_minutes': log.disruption(line, start, end),
+                   'changes': [{'status': status, 'since': since,
+                                'until': until}
+                               for status, since, until
+                               in log.timeline(line, start, end)]}
+            for line in lines}}
+        return flask.Response(dumps(body), mimetype='application/json')
+
+    return bp
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Row-level updates of DataTable data with Dash `Patch`.
+
+Instead of sending a table's whole `data` list on every refresh, a
+callback keeps a short signature per row in a `dcc.Store` next to the
+table, as [[key, signature], ...] in table order. `patch_rows` compares
+the new rows with those signatures and returns a `Patch` that only
+deletes, replaces and appends the rows that differ, plus the new
+signatures. The browser holds the rows themselves, so neither direction
+carries unchanged rows.
+
+@author: VK
+"""
+
+import hashlib
+
+from dash import Patch, no_update
+
+from api import dumps
+
+
+def signature(row: dict) -> str:
+    return hashlib.blake2b(dumps(row), digest_size=8).hexdigest()
+
+
+def patch_rows(shown, rows: list, key: str):
+    """
+    (data, signatures) to return for a table now showing `rows`
+
+    Parameters
+    ----------
+    shown : list or None
+        The table's current [[key, signature], ...], from its store.
+    rows : list of dict
+        The full new data.
+    key : str
+        Column identifying a row, eg 'ID' or 'Line'.
+
+    Returns
+    -------
+    data : Patch, list or no_update
+        A Patch when the rows only changed in place, lost some rows or
+        gained some at the end; the full list when the table is new or
+        reordered; no_update when nothing changed.
+    signatures : list or no_update
+
+    """
+    sigs = [[row[key], signature(row)] for row in rows]
+    if not shown:
+        return rows, sigs
+    if sigs == shown:
+        return no_update, no_update
+
+    new_keys = [k for k, _ in sigs]
+    wanted = set(new_keys)
+    kept = [(i, k, s) for i, (k, s) in enumerate(shown) if k in wanted]
+    kept_keys = [k for _, k, _ in kept]
+    if new_keys[:len(kept_keys)] != kept_keys:
+        # Reordered, or rows inserted in the middle
+        return rows, sigs
+
+    patch = Patch()
+    # Delete from the end so earlier indices stay valid
+    for i in reversed(range(len(shown))):
+        if shown[i][0] not in wanted:
+            del patch[i]
+    for i, (_, _, sig) in enumerate(kept):
+        if sigs[i][1] != sig:
+            patch[i] = rows[i]
+    for row in rows[len(kept):]:
+        patch.append(row)
+    return patch, sigs
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""
+Test setup: the app's modules are imported from the repository root, and
+every file they share between workers goes to a scratch directory.
+"""
+
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_scratch = tempfile.mkdtemp(prefix='vk-commute-tests-')
+for var, name in (('COMMUTE_DATA_DIR', 'data'),
+                  ('COMMUTE_RATELIMIT_FILE', 'ratelimit'),
+                  ('COMMUTE_ALERTS_FILE', 'alerts.jsonl'),
+                  ('COMMUTE_PROFILES_FILE', 'profiles.jsonl'),
+                  ('COMMUTE_STATUS_LOG', 'tube.jsonl'),
+                  ('COMMUTE_TRACE_DIR', 'traces'),
+                  ('COMMUTE_WALKGRAPH', 'walkgraph.bin'),
+                  ('COMMUTE_POLLER_LOCK', 'poller.lock')):
+    os.environ.setdefault(var, os.path.join(_scratch, name))
+os.environ.setdefault('COMMUTE_RATE_LIMIT', '0')
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import accuracy
+from snapshots import EMPTY, Snapshot
+
+T0 = 1654678800.0   # 2022-06-08 09:00 UTC
+
+
+def bus(eta, route='25', stop='S'):
+    return SimpleNamespace(route=route, stop=stop, eta=datetime.fromtimestamp(
+        T0 + eta, timezone.utc))
+
+
+def follow(tracker, vehicles, polls, eta_at, stop='S', route='25'):
+    """Poll `stop` at `polls` (s after T0), `vehicles` listed until gone"""
+    previous = EMPTY
+    for n, t in enumerate(polls):
+        eta = eta_at(t)
+        data = {} if eta is None else {
+            v: bus(eta, route, stop) for v in vehicles}
+        snapshot = Snapshot(data, n + 1, T0 + t)
+        tracker.on_arrivals(stop, snapshot, previous,
+                            set(data) | set(previous.data))
+        previous = snapshot
+
+
+def optimistic(t):
+    # Says 940 s until 900 s, then 1000 s; gone by the 1020 s poll
+    if t >= 1020:
+        return None
+    return 940.0 if t < 900 else 1000.0
+
+
+def test_errors_are_scored_at_each_horizon():
+    tracker = accuracy.EtaTracker()
+    follow(tracker, ['v1'], range(0, 1050, 30), optimistic)
+    stats = tracker._stats[('25', 'S')]
+    # 1, 3, 5 and 10 minutes ahead; not listed 20 minutes ahead
+    assert [stats[1 + 3 * h] for h in range(5)] == [1, 1, 1, 1, 0]
+    assert [stats[2 + 3 * h] for h in range(4)] == [0.0, 60.0, 60.0, 60.0]
+
+
+def test_bias_corrects_etas_after_enough_samples():
+    tracker = accuracy.EtaTracker()
+    now = T0 + 2000
+    soon, later = bus(2000 + 30), bus(2000 + 250)
+    follow(tracker, ['v1', 'v2', 'v3', 'v4'], range(0, 1050, 30), optimistic)
+    # Not enough samples yet
+    assert tracker.corrected(later, now) == later.eta.timestamp()
+    follow(tracker, ['v5'], range(0, 1050, 30), optimistic)
+    assert tracker.corrected(later, now) == later.eta.timestamp() + 60
+    assert tracker.corrected(soon, now) == soon.eta.timestamp()
+    # Other stops of the route fall back to the route's bias, other
+    # routes have none
+    other_stop = bus(2000 + 250, stop='T')
+    assert tracker.corrected(other_stop, now) == \
+        other_stop.eta.timestamp() + 60
+    other_route = bus(2000 + 250, route='8')
+    assert tracker.corrected(other_route, now) == \
+        other_route.eta.timestamp()
+
+
+def test_arrivals_between_distant_polls_are_not_scored():
+    tracker = accuracy.EtaTracker()
+    follow(tracker, ['v1'], list(range(0, 600, 30)) + [900], lambda t:
+           None if t >= 900 else 700.0)
+    assert ('25', 'S') not in tracker._stats
+
+
+def test_unpolled_stops_are_forgotten():
+    tracker = accuracy.EtaTracker()
+    follow(tracker, ['v1'], [0, 30], lambda t: 500.0, stop='S')
+    follow(tracker, ['v2'], [accuracy.TRACK_TTL + 60], lambda t: 900.0,
+           stop='T')
+    assert list(tracker._tracks) == ['T']
+
+
+def test_far_horizons_are_scored_at_fast_polling():
+    tracker = accuracy.EtaTracker()
+
+    def steady(t):
+        # 1490 s until 1200 s, then 1500 s; gone by the 1500 s poll
+        if t >= 1500:
+            return None
+        return 1490.0 if t < 1200 else 1500.0
+
+    follow(tracker, ['v1'], range(0, 1515, 15), steady)
+    stats = tracker._stats[('25', 'S')]
+    assert [stats[1 + 3 * h] for h in range(5)] == [1, 1, 1, 1, 1]
+    assert [stats[2 + 3 * h] for h in range(5)] == [0, 0, 0, 10, 10]
+
+
+def test_only_eta_changes_are_kept():
+    track = accuracy.Track('25')
+    for when in range(0, 300, 15):
+        track.predict(T0 + when, T0 + 600)
+    track.predict(T0 + 300, T0 + 620)
+    assert list(track.times) == [T0, T0 + 300]
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import aggregates
+from aggregates import Dock
+
+
+def dock(ident, bikes, ebikes=0, spaces=5, docks=20, name='A St, Soho'):
+    return Dock(ident, name, 51.5, -0.1, bikes, ebikes, spaces, docks,
+                '2022-06-08T09:00:00.000Z')
+
+
+class Response:
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+def test_parse_docks_reads_counts():
+    record = {'id': 'BikePoints_1', 'commonName': 'A St, Soho',
+              'lat': 51.5, 'lon': -0.1, 'additionalProperties': [
+                  {'key': 'NbBikes', 'value': '4',
+                   'modified': '2022-06-08T09:00:00.000Z'},
+                  {'key': 'NbEBikes', 'value': '1'},
+                  {'key': 'NbEmptyDocks', 'value': 'x'},
+                  {'key': 'NbDocks', 'value': '10'}]}
+    parsed = aggregates.parse_docks(Response([record]))
+    d = parsed['BikePoints_1']
+    assert (d.bikes, d.ebikes, d.spaces, d.docks) == (4, 1, -1, 10)
+    assert d.area == 'Soho'
+    # A single dock, as BikePoint/<id> returns it
+    assert list(aggregates.parse_docks(Response(record))) == ['BikePoints_1']
+
+
+def test_totals_follow_changed_docks_only():
+    totals = aggregates.DockAggregates()
+    docks = {'a': dock('a', 3, 1), 'b': dock('b', 0, name='B Rd, Angel')}
+    totals.update(docks, set(docks))
+    assert totals.totals()['bikes'] == 3
+    assert totals.totals()['empty'] == 1
+    docks['a'] = dock('a', 5, 2)
+    del docks['b']
+    totals.update(docks, {'a', 'b'})
+    t = totals.totals()
+    assert (t['docks'], t['bikes'], t['ebikes'], t['empty']) == (1, 5, 2, 0)
+    assert list(totals.by_area()) == ['Soho']
+
+
+def test_implausible_and_excluded_docks_left_out():
+    flagged = {'c'}
+    totals = aggregates.DockAggregates(
+        exclude=lambda d: d.ident in flagged)
+    docks = {'a': dock('a', 2, ebikes=3), 'b': dock('b', 4),
+             'c': dock('c', 7)}
+    totals.update(docks, set(docks))
+    t = totals.totals()
+    assert t['bikes'] == 4 and t['excluded'] == 2
+    flagged.clear()
+    totals.update(docks, {'c'})
+    assert totals.totals()['bikes'] == 11
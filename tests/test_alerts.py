@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import json
+
+import flask
+
+import alerts
+from aggregates import Dock, DockAggregates
+from snapshots import EMPTY, Snapshot
+
+
+def dock(ident, bikes, name='A St, Soho'):
+    return Dock(ident, name, 51.5, -0.1, bikes, 0, 20 - bikes, 20,
+                '2022-06-08T09:00:00.000Z')
+
+
+class Feed:
+    """Publishes snapshots to its listeners, as snapshots.Feed does"""
+
+    def __init__(self):
+        self.snapshot = EMPTY
+        self.listeners = []
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def latest(self, key=None):
+        return self.snapshot
+
+    def publish(self, data):
+        previous = self.snapshot
+        self.snapshot = Snapshot(data, previous.version + 1,
+                                 previous.fetched + 1)
+        changed = {k for k in data.keys() | previous.data.keys()
+                   if data.get(k) != previous.data.get(k)}
+        for listener in self.listeners:
+            listener(None, self.snapshot, previous, changed)
+
+
+def engine(tmp_path, exclude=None):
+    bikes, tube = Feed(), Feed()
+    totals = DockAggregates()
+    bikes.subscribe(totals.on_snapshot)
+    e = alerts.AlertEngine(bikes, tube, totals,
+                           path=str(tmp_path / 'alerts.jsonl'),
+                           exclude=exclude)
+    fired = []
+    e.subscribe(lambda alert: fired.append((alert.rule, alert.value)))
+    return e, bikes, tube, fired
+
+
+def test_dock_rule_fires_on_each_crossing(tmp_path):
+    e, bikes, _, fired = engine(tmp_path)
+    bikes.publish({'a': dock('a', 5)})
+    rule = e.add('a bikes < 3')
+    assert fired == []
+    bikes.publish({'a': dock('a', 2)})
+    bikes.publish({'a': dock('a', 1)})
+    assert fired == [(rule.ident, 2)]
+    bikes.publish({'a': dock('a', 4)})
+    bikes.publish({'a': dock('a', 0)})
+    assert fired == [(rule.ident, 2), (rule.ident, 0)]
+
+
+def test_new_rule_fires_if_it_already_holds(tmp_path):
+    e, bikes, _, fired = engine(tmp_path)
+    bikes.publish({'a': dock('a', 1)})
+    rule = e.add('a bikes < 3')
+    assert fired == [(rule.ident, 1)]
+
+
+def test_restart_does_not_notify_again(tmp_path):
+    e, bikes, tube, fired = engine(tmp_path)
+    bikes.publish({'a': dock('a', 1)})
+    tube.publish({'Jubilee': 'Part Suspended'})
+    e.add('a bikes < 3')
+    e.add('eBikes >= 0 near Soho')
+    e.add('Jubilee not Good Service')
+    assert len(fired) == 3
+    # A new worker loads the same rules, and gets its first snapshots
+    _, bikes, tube, fired = engine(tmp_path)
+    bikes.publish({'a': dock('a', 1)})
+    tube.publish({'Jubilee': 'Part Suspended'})
+    assert fired == []
+    tube.publish({'Jubilee': 'Good Service'})
+    tube.publish({'Jubilee': 'Severe Delays'})
+    assert [value for _, value in fired] == ['Severe Delays']
+
+
+def test_unreadable_rules_are_skipped(tmp_path):
+    path = tmp_path / 'alerts.jsonl'
+    with open(str(path), 'w') as f:
+        f.write('{"op": "add", "id": "x", "condit\n')
+        f.write(json.dumps({'op': 'add', 'id': 'y',
+                            'condition': 'gibberish'}) + '\n')
+        f.write(json.dumps({'op': 'add', 'id': 'z',
+                            'condition': 'a bikes < 3'}) + '\n')
+    e, bikes, _, fired = engine(tmp_path)
+    assert list(e.rules) == ['z']
+    bikes.publish({'a': dock('a', 5)})
+    bikes.publish({'a': dock('a', 1)})
+    assert fired == [('z', 1)]
+
+
+def test_flagged_docks_do_not_fire(tmp_path):
+    flagged = set()
+    e, bikes, _, fired = engine(
+        tmp_path, exclude=lambda d: d.ident in flagged)
+    bikes.publish({'a': dock('a', 5)})
+    rule = e.add('a bikes < 3')
+    flagged.add('a')
+    bikes.publish({'a': dock('a', 1)})
+    assert fired == [] and not e.active(rule)
+    # Trusted again, and still low
+    flagged.clear()
+    e.update(bikes.snapshot, {'a'}, bikes.snapshot)
+    assert fired == [(rule.ident, 1)]
+
+
+def test_area_rule_follows_the_totals(tmp_path):
+    e, bikes, _, fired = engine(tmp_path)
+    bikes.publish({'a': dock('a', 5), 'b': dock('b', 5)})
+    rule = e.add('bikes < 8 near Soho')
+    bikes.publish({'a': dock('a', 5), 'b': dock('b', 2)})
+    assert fired == [(rule.ident, 7)]
+
+
+def test_bodies_that_are_not_objects_are_refused(tmp_path):
+    e, bikes, _, _ = engine(tmp_path)
+    bikes.publish({'a': dock('a', 5)})
+    server = flask.Flask(__name__)
+    server.register_blueprint(alerts.create_blueprint(e))
+    client = server.test_client()
+    for body in ([1], 'x', 3, {'condition': 3}):
+        assert client.post('/api/alerts', json=body).status_code == 400
+    assert client.post('/api/alerts', json={
+        'condition': 'a bikes < 3'}).status_code == 201
+    assert client.post('/api/alerts', data={
+        'condition': 'a bikes < 3'}).status_code == 201
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import threading
+from datetime import datetime, timedelta, timezone
+
+import anomalies
+from aggregates import Dock
+from snapshots import Snapshot
+
+T0 = datetime(2022, 6, 8, tzinfo=timezone.utc)
+HOUR = 3600.0
+
+
+def dock(ident, bikes=5, changed=0.0, ebikes=0, spaces=None, docks=20):
+    """A dock whose counts TfL last changed `changed` s after T0"""
+    spaces = docks - bikes if spaces is None else spaces
+    stamp = (T0 + timedelta(seconds=changed)).strftime(
+        '%Y-%m-%dT%H:%M:%S.000Z')
+    return Dock(ident, ident, 51.5, -0.1, bikes, ebikes, spaces, docks, stamp)
+
+
+def check(checks, docks, at, gone=()):
+    data = {d.ident: d for d in docks}
+    return checks.update(Snapshot(data, 1, T0.timestamp() + at),
+                         set(data) | set(gone))
+
+
+def test_count_checks():
+    assert anomalies.count_checks(dock('a')) == set()
+    assert anomalies.count_checks(dock('a', ebikes=6)) == {'implausible'}
+    assert anomalies.count_checks(
+        dock('a', bikes=99, spaces=0, docks=120)) == {'sentinel'}
+    assert anomalies.count_checks(dock('a', spaces=18)) == {'over capacity'}
+
+
+def test_silent_dock_is_stale_while_the_network_changes():
+    checks = anomalies.DockChecks()
+    busy = [dock(str(i), changed=10 * HOUR - 600) for i in range(9)]
+    flipped = check(checks, busy + [dock('quiet', changed=7 * HOUR)],
+                    10 * HOUR)
+    assert flipped == {'quiet'}
+    assert checks.reasons('quiet') == ['stale']
+    assert checks.count('stale') == 1
+
+
+def test_quiet_network_is_not_stale():
+    # Overnight nothing has changed for hours, and one dock a bit longer
+    checks = anomalies.DockChecks()
+    night = [dock(str(i), changed=0.0) for i in range(9)]
+    check(checks, night + [dock('quiet', changed=-2 * HOUR)], 5 * HOUR)
+    assert checks.flags == {}
+
+
+def test_stale_dock_clears_when_it_changes():
+    checks = anomalies.DockChecks()
+    busy = [dock(str(i), changed=10 * HOUR - 600) for i in range(9)]
+    check(checks, busy + [dock('quiet', changed=7 * HOUR)], 10 * HOUR)
+    flipped = check(checks, busy + [dock('quiet', bikes=4,
+                                         changed=10 * HOUR)], 10 * HOUR + 60)
+    assert flipped == {'quiet'} and checks.flags == {}
+
+
+def test_unchanged_counts_are_stuck():
+    checks = anomalies.DockChecks(stuck_after=HOUR)
+    check(checks, [dock('a', changed=0.0)], 0.0)
+    # TfL keeps touching the dock, but the counts never move
+    check(checks, [dock('a', changed=2 * HOUR)], 2 * HOUR)
+    assert checks.reasons('a') == ['stuck']
+
+
+def test_gauge_counts_under_the_lock():
+    checks = anomalies.DockChecks()
+    check(checks, [dock('a', ebikes=6), dock('b')], 0.0)
+    assert checks.count('implausible') == 1
+    with checks._lock:
+        counter = threading.Thread(target=checks.count, args=('stale',))
+        counter.start()
+        counter.join(0.1)
+        assert counter.is_alive()
+    counter.join()
+
+
+def test_docks_coming_and_going():
+    checks = anomalies.DockChecks(stuck_after=HOUR)
+    check(checks, [dock('a', ebikes=6), dock('b', changed=0.0)], 0.0)
+    assert checks.reasons('a') == ['implausible']
+    # 'a' leaves and 'c' arrives
+    flipped = check(checks, [dock('c', changed=2 * HOUR),
+                             dock('b', changed=2 * HOUR)], 2 * HOUR, ['a'])
+    assert flipped == {'a', 'b'}
+    assert checks.flags == {'b': {'stuck'}}
+    flipped = check(checks, [dock('c', changed=2 * HOUR),
+                             dock('b', bikes=4, changed=2 * HOUR)],
+                    2 * HOUR + 60)
+    assert flipped == {'b'} and checks.flags == {}
+
+
+def test_only_docks_entering_or_leaving_the_flags_are_looked_at():
+    checks = anomalies.DockChecks(stuck_after=HOUR)
+    fleet = {str(i): dock(str(i), changed=0.0) for i in range(50)}
+    check(checks, fleet.values(), 0.0)
+    # Nothing changes in the snapshot, but time makes every dock stuck
+    at = T0.timestamp() + 2 * HOUR
+    assert checks.update(Snapshot(fleet, 2, at), set()) == set(fleet)
+    assert checks.update(Snapshot(fleet, 3, at + 30), set()) == set()
+    assert checks.count('stuck') == 50
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import flask
+
+import api
+from snapshots import EMPTY, Snapshot
+from upstream import UpstreamError
+
+
+class Feed:
+    def __init__(self, data=None):
+        self.data = data or {}
+        self.fetched = []
+
+    def latest(self, key=None):
+        if key in self.data:
+            return Snapshot(self.data[key], 1, 1e9)
+        return EMPTY
+
+    def get(self, key=None):
+        self.fetched.append(key)
+        if key in self.data:
+            return self.latest(key)
+        raise UpstreamError('not found')
+
+
+def bus(route):
+    return SimpleNamespace(route=route, dest='Ilford', towards='Aldgate',
+                           reg='LX1', eta=datetime(2026, 1, 1,
+                                                   tzinfo=timezone.utc))
+
+
+def client(arrivals, watch=None):
+    server = flask.Flask(__name__)
+    server.register_blueprint(api.create_blueprint(Feed(), Feed(), arrivals,
+                                                   watch=watch))
+    return server.test_client()
+
+
+def test_arrivals_answer_from_memory_and_watch_the_rest():
+    arrivals = Feed({'490001180E': {'v1': bus('25')}})
+    watched = []
+    r = client(arrivals, lambda stop, fetched: watched.append(
+        (stop, fetched))).get('/api/arrivals?stops=490001180E,490000266G')
+    assert r.status_code == 200
+    body = r.get_json()
+    assert [b['route'] for b in body['stops']['490001180E']] == ['25']
+    assert body['pending'] == ['490000266G']
+    assert watched == [('490001180E', True), ('490000266G', False)]
+    # Nothing was fetched during the request
+    assert arrivals.fetched == []
+
+
+def test_arrivals_without_a_poller_fetch():
+    arrivals = Feed({'490001180E': {'v1': bus('25')}})
+    body = client(arrivals).get(
+        '/api/arrivals?stops=490001180E,490000266G').get_json()
+    assert list(body['stops']) == ['490001180E']
+    assert list(body['errors']) == ['490000266G']
+    assert body['pending'] == []
+
+
+def test_arrivals_reject_malformed_stop_ids():
+    arrivals = Feed()
+    watched = []
+    r = client(arrivals, lambda stop, fetched: watched.append(stop)).get(
+        '/api/arrivals?stops=490001180E,../BikePoint')
+    assert r.status_code == 400
+    assert watched == [] and arrivals.fetched == []
+
+
+def test_tube_batch_lists_missing_lines():
+    tube = Feed({None: {'Central': 'Good Service', 'DLR': 'Minor Delays'}})
+    server = flask.Flask(__name__)
+    server.register_blueprint(api.create_blueprint(tube, Feed(), Feed()))
+    body = server.test_client().get(
+        '/api/tube?lines=DLR,Nowhere').get_json()
+    assert body == {'lines': [{'line': 'DLR', 'status': 'Minor Delays'}],
+                    'missing': ['Nowhere']}
+
+
+def test_etag_answers_not_modified():
+    tube = Feed({None: {'Central': 'Good Service'}})
+    server = flask.Flask(__name__)
+    server.register_blueprint(api.create_blueprint(tube, Feed(), Feed()))
+    c = server.test_client()
+    r = c.get('/api/tube')
+    assert r.status_code == 200 and r.headers['X-Snapshot-Stale'] == '0'
+    etag = r.headers['ETag']
+    r = c.get('/api/tube', headers={'If-None-Match': etag})
+    assert r.status_code == 304 and r.data == b''
+    r = c.get('/api/tube', headers={'If-None-Match': '"other"'})
+    assert r.status_code == 200
+
+
+def test_failing_feed_is_503():
+    server = flask.Flask(__name__)
+    server.register_blueprint(api.create_blueprint(Feed(), Feed(), Feed()))
+    assert server.test_client().get('/api/docks').status_code == 503
+
+
+def test_too_many_ids_are_refused():
+    server = flask.Flask(__name__)
+    server.register_blueprint(api.create_blueprint(Feed(), Feed(), Feed()))
+    ids = ','.join('BikePoints_{}'.format(i) for i in range(api.MAX_IDS + 1))
+    assert server.test_client().get('/api/docks?ids=' + ids).status_code \
+        == 400
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import csv
+import os
+
+import pytest
+
+import loadtest
+import upstream
+from conftest import ROOT
+from snapshots import Snapshot
+
+
+@pytest.fixture(scope='module')
+def app():
+    cwd = os.getcwd()
+    os.chdir(ROOT)
+    try:
+        with open('stations_static.csv') as f:
+            docks = {row['ID']: row['Name'] for row in csv.DictReader(f)}
+        upstream.client.transport = loadtest.SyntheticTfL(docks, period=3600)
+        upstream.client.limiter = None
+        import app
+    finally:
+        os.chdir(cwd)
+    return app
+
+
+def update(app, outputs, inputs, changed, state=()):
+    return app.server.test_client().post(
+        '/_dash-update-component',
+        json=loadtest.dash_request(outputs, inputs, changed, state))
+
+
+def test_tube_store_etag_follows_content_not_version(app):
+    data = {'Central': 'Good Service', 'Jubilee': 'Minor Delays'}
+    first = app.tube_store_data(Snapshot(data, 1, 1.0))
+    assert first['rows'] == [{'Line': 'Central', 'Status': 'Good Service'},
+                             {'Line': 'Jubilee', 'Status': 'Minor Delays'}]
+    # Another worker's version of the same statuses
+    assert app.tube_store_data(Snapshot(dict(data), 7, 2.0))['etag'] \
+        == first['etag']
+    changed = app.tube_store_data(
+        Snapshot(dict(data, Central='Severe Delays'), 8, 3.0))
+    assert changed['etag'] != first['etag']
+
+
+def test_tube_store_is_only_sent_when_it_changed(app):
+    inputs = [('refresh_line.n_clicks', 1), ('tube-interval.n_intervals', 1)]
+    r = update(app, ['tube-store.data'], inputs, ['refresh_line.n_clicks'],
+               [('tube-store.data', None)])
+    assert r.status_code == 200
+    stored = r.get_json()['response']['tube-store']['data']
+    assert len(stored['rows']) == len(loadtest.SyntheticTfL.LINES)
+    r = update(app, ['tube-store.data'], inputs, ['refresh_line.n_clicks'],
+               [('tube-store.data', stored)])
+    assert r.status_code == 204
+
+
+def test_bus_store_holds_etas_for_the_browser_countdown(app):
+    stop = '490001180E'
+    inputs = [('refresh_buses.n_clicks', None),
+              ('bus-interval.n_intervals', None), ('busstop.value', stop)]
+    r = update(app, ['bus-store.data'], inputs, ['busstop.value'],
+               [('bus-store.data', None)])
+    assert r.status_code == 200
+    stored = r.get_json()['response']['bus-store']['data']
+    assert stored['stop'] == stop and stored['now'] > 0
+    etas = [row['ETA'] for row in stored['rows']]
+    assert etas == sorted(etas) and all(eta > 0 for eta in etas)
+    # Nothing new within the synthetic feed's period: nothing is sent
+    r = update(app, ['bus-store.data'], inputs, ['bus-interval.n_intervals'],
+               [('bus-store.data', stored)])
+    assert r.status_code == 204
+
+
+def test_no_stop_clears_the_bus_store(app):
+    r = update(app, ['bus-store.data'],
+               [('refresh_buses.n_clicks', None),
+                ('bus-interval.n_intervals', None), ('busstop.value', None)],
+               ['busstop.value'], [('bus-store.data', None)])
+    assert r.get_json()['response']['bus-store']['data'] is None
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import history
+import loadtest
+import replay
+from upstream import BIKE_URL, BUS_URL, TUBE_URL
+
+pytest.importorskip('pyarrow')
+
+DOCKS = {'BikePoints_1': 'A St, Soho', 'BikePoints_2': 'B Rd, Bank'}
+
+
+def record(path):
+    tfl = loadtest.SyntheticTfL(DOCKS, period=3600)
+
+    def inner(url, timeout):
+        if url.endswith('/BROKEN/arrivals'):
+            return 200, b'[{"naptanId": '
+        return tfl(url, timeout)
+
+    recorder = replay.Recorder(inner, path)
+    for _ in range(3):
+        recorder(BIKE_URL, None)
+    recorder(TUBE_URL, None)
+    recorder(BUS_URL.format(stopid='490001180E'), None)
+    recorder(BUS_URL.format(stopid='BROKEN'), None)
+    recorder('https://api.tfl.gov.uk/Unrelated', None)
+    recorder.close()
+    return tfl
+
+
+def test_classify():
+    assert history.classify(TUBE_URL)[0] == 'tube'
+    assert history.classify(BIKE_URL + 'BikePoints_1')[0] == 'docks'
+    assert history.classify(BUS_URL.format(stopid='1'))[0] == 'arrivals'
+    assert history.classify('https://api.tfl.gov.uk/Line/25/Arrivals') \
+        is None
+
+
+def test_export_then_query(tmp_path):
+    archive = str(tmp_path / 'tfl.zip')
+    tfl = record(archive)
+    root = str(tmp_path / 'history')
+    written = history.export(root, [archive])
+    assert written['docks'] == 3 * len(DOCKS)
+    assert written['tube'] == len(tfl.LINES)
+    # The broken response is skipped, not the archive
+    assert written['arrivals'] > 0
+    # Exporting again replaces the archive's files
+    assert history.export(root, [archive]) == written
+
+    table = history.query(root, 'docks', ids=['BikePoints_1'])
+    assert table.column('ident').to_pylist() == ['BikePoints_1'] * 3
+    stops = history.query(root, 'arrivals', columns=['stop'])
+    assert set(stops.column('stop').to_pylist()) == {'490001180E'}
+
+
+def test_time_ranges_prune(tmp_path):
+    archive = str(tmp_path / 'tfl.zip')
+    record(archive)
+    root = str(tmp_path / 'history')
+    history.export(root, [archive])
+    now = datetime.now(timezone.utc)
+    hour = timedelta(hours=1)
+    assert history.query(root, 'tube', start=now - hour,
+                         end=now + hour).num_rows > 0
+    assert history.query(root, 'tube', start=now + hour).num_rows == 0
+    assert history.query(root, 'tube', end=now - hour).num_rows == 0
+    # Naive datetimes are UTC
+    naive = now.replace(tzinfo=None)
+    assert history.query(root, 'tube', start=naive - hour).num_rows > 0
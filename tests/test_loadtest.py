@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import itertools
+import json
+import random
+
+import loadtest
+import upstream
+
+DOCKS = {'BikePoints_{}'.format(i): 'Street {}, Soho'.format(i)
+         for i in range(1, 11)}
+STOPS = [('490001180E', 'HIGHBURY CORNER'), ('490000266G', 'WESTMINSTER')]
+
+
+def test_dash_request_matches_the_renderer():
+    body = loadtest.dash_request(
+        ['a.data', 'b.data'], [('c.value', 1)], ['c.value'],
+        [('a.data', None)])
+    assert body['output'] == '..a.data...b.data..'
+    assert body['outputs'] == [{'id': 'a', 'property': 'data'},
+                               {'id': 'b', 'property': 'data'}]
+    assert body['inputs'] == [{'id': 'c', 'property': 'value', 'value': 1}]
+    assert body['state'] == [{'id': 'a', 'property': 'data', 'value': None}]
+    single = loadtest.dash_request(['a.data'], [], ['c.value'])
+    assert single['output'] == 'a.data'
+    assert single['outputs'] == {'id': 'a', 'property': 'data'}
+
+
+def test_synthetic_tfl_is_stable_within_a_period():
+    tfl = loadtest.SyntheticTfL(DOCKS, period=3600.0)
+    status, body = tfl(upstream.BIKE_URL, None)
+    assert status == 200
+    assert {d['id'] for d in json.loads(body)} == set(DOCKS)
+    assert tfl(upstream.BIKE_URL, None) == (status, body)
+    status, body = tfl(upstream.BIKE_URL + 'BikePoints_1', None)
+    assert status == 200 and json.loads(body)['id'] == 'BikePoints_1'
+    assert tfl(upstream.BIKE_URL + 'BikePoints_99', None)[0] == 404
+    status, body = tfl(upstream.BUS_URL.format(stopid='490001180E'), None)
+    assert status == 200
+    assert {b['naptanId'] for b in json.loads(body)} == {'490001180E'}
+    assert tfl(upstream.TUBE_URL, None)[1].count(b'<LineStatus ') == \
+        len(tfl.LINES)
+
+
+def test_session_loads_the_page_then_acts():
+    session = loadtest.Session(random.Random(1), DOCKS, STOPS)
+    kinds = [kind for kind, _ in itertools.islice(session.actions(), 200)]
+    assert kinds[:4] == ['tube', 'docks', 'totals', 'busstop']
+    assert set(kinds) == {'tube', 'docks', 'totals', 'busstop', 'search'}
+
+
+def test_typing_searches_then_picks_the_stop():
+    session = loadtest.Session(random.Random(2), DOCKS, STOPS)
+    steps = list(session.typing())
+    assert [kind for kind, _ in steps[:-1]] == ['search'] * (len(steps) - 1)
+    values = [body['inputs'][0]['value'] for _, body in steps[:-1]]
+    assert all(len(a) + 1 == len(b) for a, b in zip(values, values[1:]))
+    kind, body = steps[-1]
+    assert kind == 'busstop'
+    assert body['inputs'][-1]['value'] in dict(STOPS)
+
+
+def test_percentile():
+    values = [1, 2, 3, 4, 5]
+    assert loadtest.percentile(values, 0.5) == 3
+    assert loadtest.percentile(values, 0.99) == 5
+    assert loadtest.percentile([], 0.5) != loadtest.percentile([], 0.5)
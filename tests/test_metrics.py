@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+import metrics
+
+
+def test_counter_and_histogram_render():
+    registry = metrics.Registry()
+    calls = metrics.Counter('t_calls_total', 'Calls.', ['kind'],
+                            registry=registry)
+    latency = metrics.Histogram('t_seconds', 'Latency.', buckets=(1, 5),
+                                registry=registry)
+    calls.labels('a').inc()
+    calls.labels('a').inc(2)
+    latency.labels().observe(0.5)
+    latency.labels().observe(3)
+    text = registry.render()
+    assert '# TYPE t_calls_total counter' in text
+    assert 't_calls_total{kind="a"} 3' in text
+    assert 't_seconds_bucket{le="1"} 1' in text
+    assert 't_seconds_bucket{le="5"} 2' in text
+    assert 't_seconds_bucket{le="+Inf"} 2' in text
+    assert 't_seconds_count 2' in text
+
+
+def test_gauge_function_and_labels_checked():
+    registry = metrics.Registry()
+    gauge = metrics.Gauge('t_size', 'Size.', ['name'], registry=registry)
+    gauge.labels('x').set_function(lambda: 7)
+    assert 't_size{name="x"} 7' in registry.render()
+    try:
+        gauge.labels()
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('missing label accepted')
+
+
+def test_shared_render_merges_workers(tmp_path):
+    registry = metrics.Registry()
+    calls = metrics.Counter('t_calls_total', 'Calls.', ['kind'],
+                            registry=registry)
+    depth = metrics.Gauge('t_depth', 'Depth.', registry=registry)
+    calls.labels('a').inc(2)
+    depth.labels().set(1)
+    registry.share(str(tmp_path), start=False)
+    # Another worker's samples, one live and one long gone
+    other = {'time': 9e18, 'metrics': {
+        't_calls_total': [['t_calls_total{kind="a"}', 3],
+                          ['t_calls_total{kind="b"}', 1]],
+        't_depth': [['t_depth', 5]]}}
+    gone = {'time': 0, 'metrics': {
+        't_calls_total': [['t_calls_total{kind="a"}', 10]],
+        't_depth': [['t_depth', 99]]}}
+    for pid, data in (('1', other), ('2', gone)):
+        with open(os.path.join(tmp_path, 'metrics-%s.json' % pid), 'w') as f:
+            json.dump(data, f)
+    text = registry.render()
+    assert 't_calls_total{kind="a"} 15' in text
+    assert 't_calls_total{kind="b"} 1' in text
+    assert 't_depth{worker="1"} 5' in text
+    assert 't_depth{worker="%d"} 1' % os.getpid() in text
+    assert 't_depth{worker="2"}' not in text
+
+
+def test_retired_workers_keep_counters_and_drop_gauges(tmp_path):
+    directory = str(tmp_path)
+
+    def worker(pid, calls, depth):
+        registry = metrics.Registry()
+        counter = metrics.Counter('t_calls_total', 'Calls.',
+                                  registry=registry)
+        gauge = metrics.Gauge('t_depth', 'Depth.', registry=registry)
+        counter.labels().inc(calls)
+        gauge.labels().set(depth)
+        registry.share(directory, start=False)
+        registry._path = os.path.join(directory, 'metrics-%d.json' % pid)
+        registry.dump()
+        return registry
+
+    observer = worker(1, 0, 0)
+    worker(7, 5, 3)
+    assert 't_calls_total 5' in observer.render()
+    assert 't_depth{worker="7"} 3' in observer.render()
+    metrics.retire(directory, 7)
+    text = observer.render()
+    assert 't_calls_total 5' in text
+    assert 'worker="7"' not in text
+    # A new worker reusing the PID starts from zero; the total holds
+    worker(7, 1, 2)
+    text = observer.render()
+    assert 't_calls_total 6' in text
+    assert 't_depth{worker="7"} 2' in text
+
+
+def test_share_retires_a_dead_worker_with_the_same_pid(tmp_path):
+    with open(os.path.join(tmp_path, 'metrics-%d.json' % os.getpid()),
+              'w') as f:
+        json.dump({'time': 0, 'gauges': [], 'metrics': {
+            't_calls_total': [['t_calls_total', 4]]}}, f)
+    registry = metrics.Registry()
+    metrics.Counter('t_calls_total', 'Calls.',
+                    registry=registry).labels().inc()
+    registry.share(str(tmp_path), start=False)
+    assert 't_calls_total 5' in registry.render()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import flask
+import pytest
+
+import planner
+from aggregates import Dock
+from snapshots import EMPTY, Snapshot
+
+NOW = datetime(2022, 6, 8, 8, 0, tzinfo=timezone.utc).timestamp()
+
+
+class Feed:
+    def __init__(self, data):
+        self.data = data
+
+    def latest(self, key=None):
+        data = self.data if key is None else self.data.get(key)
+        return EMPTY if data is None else Snapshot(data, 1, NOW)
+
+
+def dock(ident, bikes, spaces):
+    return Dock(ident, 'Dock ' + ident, 51.5, -0.1, bikes, 0, spaces,
+                bikes + spaces, '2022-06-08T07:59:00.000Z')
+
+
+def bus(route, minutes):
+    return SimpleNamespace(route=route, eta=datetime.fromtimestamp(
+        NOW + 60 * minutes, timezone.utc))
+
+
+def make_planner(**kwargs):
+    tube = Feed({'Central': 'Good Service', 'Jubilee': 'Severe Delays',
+                 'DLR': 'Part Suspended'})
+    bikes = Feed({'BikePoints_1': dock('BikePoints_1', 5, 3),
+                  'BikePoints_2': dock('BikePoints_2', 0, 10),
+                  'BikePoints_3': dock('BikePoints_3', 4, 1)})
+    arrivals = Feed({'S': {'v1': bus('25', 3), 'v2': bus('25', 12),
+                           'v3': bus('8', 1)}})
+    return planner.Planner(tube, bikes, arrivals, **kwargs)
+
+
+def option(name, *legs):
+    return planner.parse_option({'name': name, 'legs': list(legs)})
+
+
+def test_legs_add_up():
+    p = make_planner()
+    plan = p.plan(option('Bus', {'mode': 'walk', 'minutes': 5},
+                         {'mode': 'bus', 'stop': 'S', 'route': '25',
+                          'minutes': 10}), NOW)
+    # Misses the 25 due in 3 minutes, takes the one in 12
+    assert plan['feasible'] and plan['minutes'] == 22
+    assert plan['legs'][1]['note'] == '7 min wait'
+    plan = p.plan(option('Tube', {'mode': 'tube', 'line': 'Jubilee',
+                                  'minutes': 10}), NOW)
+    assert plan['minutes'] == 25 and plan['legs'][0]['note'] == \
+        'Severe Delays'
+    plan = p.plan(option('Bike', {'mode': 'bike', 'start': 'BikePoints_1',
+                                  'end': 'BikePoints_2', 'minutes': 10}),
+                  NOW)
+    assert plan['minutes'] == 11
+
+
+def test_rank_puts_feasible_options_first_soonest_first():
+    p = make_planner(exclude=lambda d: d.ident == 'BikePoints_1')
+    plans = p.rank([
+        option('Suspended', {'mode': 'tube', 'line': 'DLR', 'minutes': 5}),
+        option('Slow', {'mode': 'walk', 'minutes': 30}),
+        option('Flagged dock', {'mode': 'bike', 'start': 'BikePoints_1',
+                                'end': 'BikePoints_2', 'minutes': 5}),
+        option('Fast', {'mode': 'tube', 'line': 'Central', 'minutes': 10}),
+        option('No spaces', {'mode': 'bike', 'start': 'BikePoints_3',
+                             'end': 'BikePoints_3', 'minutes': 5}),
+        option('No bikes', {'mode': 'bike', 'start': 'BikePoints_2',
+                            'end': 'BikePoints_3', 'minutes': 5}),
+        ], now=NOW)
+    assert [(p['name'], p['feasible']) for p in plans[:2]] == [
+        ('Fast', True), ('Slow', True)]
+    assert {p['name']: p['reason'] for p in plans[2:]} == {
+        'Suspended': 'DLR: Part Suspended',
+        'Flagged dock': 'no reliable counts for BikePoints_1',
+        'No spaces': 'no spaces at Dock BikePoints_3',
+        'No bikes': 'no bikes at Dock BikePoints_2'}
+
+
+def test_walks_between_named_points_use_the_graph():
+    p = make_planner(walking=lambda a, b: 300.0
+                     if (a, b) == ('BikePoints_1', 'S') else None)
+    walk = {'mode': 'walk', 'minutes': 0, 'start': 'BikePoints_1',
+            'end': 'S'}
+    assert p.plan(option('Walk', walk), NOW)['minutes'] == 5
+    walk['end'] = 'T'
+    assert not p.plan(option('Walk', walk), NOW)['feasible']
+
+
+def test_posted_options_are_warmed():
+    watched = []
+    server = flask.Flask(__name__)
+    server.register_blueprint(planner.create_blueprint(
+        make_planner(), None, lambda kind, key: watched.append((kind, key))))
+    r = server.test_client().post('/api/commute', json={'options': [
+        {'name': 'Mixed', 'legs': [
+            {'mode': 'bike', 'start': 'BikePoints_1', 'end': 'BikePoints_2',
+             'minutes': 5},
+            {'mode': 'tube', 'line': 'Central', 'minutes': 5},
+            {'mode': 'bus', 'stop': 'S', 'route': '25', 'minutes': 5}]}]})
+    assert r.status_code == 200
+    assert sorted(watched) == [('docks', 'BikePoints_1'),
+                               ('docks', 'BikePoints_2'),
+                               ('lines', 'Central'), ('stops', 'S')]
+
+
+def test_legs_naming_junk_are_refused_and_unknown_docks_not_watched():
+    for leg in ({'mode': 'bus', 'stop': '../x', 'route': '25'},
+                {'mode': 'bike', 'start': 'BikePoints_1', 'end': 'x'},
+                {'mode': 'walk', 'start': 'a b', 'end': 'S'}):
+        leg['minutes'] = 5
+        with pytest.raises(ValueError):
+            option('Junk', leg)
+    watched = []
+    server = flask.Flask(__name__)
+    server.register_blueprint(planner.create_blueprint(
+        make_planner(), None, lambda kind, key: watched.append((kind, key))))
+    r = server.test_client().post('/api/commute', json={'options': [
+        {'name': 'Junk', 'legs': [{'mode': 'bus', 'stop': '?', 'route': '25',
+                                   'minutes': 5}]}]})
+    assert r.status_code == 400
+    r = server.test_client().post('/api/commute', json={'options': [
+        {'name': 'Gone', 'legs': [{'mode': 'bike', 'start': 'BikePoints_1',
+                                   'end': 'BikePoints_99', 'minutes': 5}]}]})
+    assert r.status_code == 200
+    assert watched == [('docks', 'BikePoints_1')]
+
+
+def test_bodies_that_are_not_objects_are_refused():
+    server = flask.Flask(__name__)
+    server.register_blueprint(planner.create_blueprint(make_planner(), None))
+    client = server.test_client()
+    for body in ([1], 'x', 3):
+        assert client.post('/api/commute', json=body).status_code == 400
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import pytest
+
+import poller
+from snapshots import Snapshot
+
+
+class Feed:
+    """Snapshots counting up from 1, and an optional shared one"""
+
+    name = 'f'
+
+    def __init__(self):
+        self.polls = 0
+        self.shared = None
+
+    def refresh(self, key=None):
+        self.polls += 1
+        return Snapshot({'n': self.polls}, self.polls, time.time())
+
+    def adopt(self, key=None):
+        return self.shared
+
+
+def job(feed, key=None):
+    return poller.FeedJob(feed, key, lambda *args: 0, bounds=(10, 100))
+
+
+def test_interval_follows_changes_within_bounds():
+    j = job(Feed())
+    j.observe(0, 60)
+    assert j.interval == 100
+    j.rate = None
+    j.observe(100, 10)
+    assert j.interval == 10
+    j.rate = None
+    j.observe(1, 30)
+    assert j.interval == 30
+
+
+def test_concurrent_watches_make_one_job():
+    scheduler = poller.Scheduler()
+    scheduler.keyed(Feed(), lambda *args: 0, bounds=(10, 100))
+    start = threading.Barrier(8)
+
+    def watch():
+        start.wait()
+        scheduler.watch('f', 'stop')
+
+    threads = [threading.Thread(target=watch) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert list(scheduler.jobs) == [('f', 'stop')]
+    assert len(scheduler._heap) == 1
+
+
+def test_unwatched_keys_expire_unless_pinned():
+    scheduler = poller.Scheduler(idle_ttl=60)
+    scheduler.keyed(Feed(), lambda *args: 0, bounds=(10, 100))
+    scheduler.watch('f', 'a')
+    scheduler.pin('f', ['b'])
+    for j in scheduler.jobs.values():
+        j.last_wanted -= 120
+    assert scheduler._expired(scheduler.jobs[('f', 'a')])
+    assert not scheduler._expired(scheduler.jobs[('f', 'b')])
+    scheduler.pin('f', [])
+    assert scheduler._expired(scheduler.jobs[('f', 'b')])
+
+
+def test_failing_job_backs_off_and_recovers():
+    outcomes = [ValueError('boom'), ValueError('boom'), None]
+
+    def func():
+        outcome = outcomes.pop(0)
+        if outcome is not None:
+            raise outcome
+
+    scheduler = poller.Scheduler()
+    task = poller.Task('t', func, 10)
+    assert scheduler.run_once(task) == 20
+    assert scheduler.run_once(task) == 40
+    assert scheduler.run_once(task) == 10
+    assert scheduler._failures == {}
+
+
+def test_backoff_is_capped():
+    def func():
+        raise ValueError('boom')
+
+    scheduler = poller.Scheduler()
+    task = poller.Task('t', func, 600)
+    assert scheduler.run_once(task) == poller.MAX_BACKOFF
+
+
+def test_one_scheduler_holds_the_poller_lock(tmp_path):
+    if poller.fcntl is None:
+        pytest.skip('needs fcntl')
+    path = str(tmp_path / 'lock')
+    first = poller.Scheduler(lock_path=path)
+    second = poller.Scheduler(lock_path=path)
+    assert first.elect()
+    assert not second.elect()
+    assert first.elect()
+    # The lock goes with the process (here, the file descriptor)
+    import os
+    os.close(first._lock_fd)
+    assert second.elect()
+
+
+def test_followers_take_newer_shared_responses():
+    feed = Feed()
+    j = job(feed)
+    j.run(leading=False)
+    assert feed.polls == 1
+    feed.shared = Snapshot({'n': 'shared'}, 7, time.time() + 1)
+    j.run(leading=False)
+    assert feed.polls == 1 and j.seen is feed.shared
+    # Nothing newer than what it saw: poll TfL itself
+    j.run(leading=False)
+    assert feed.polls == 2
+    # Too old to trust
+    feed.shared = Snapshot({'n': 'old'}, 8, time.time() - 1000)
+    j.seen = None
+    j.run(leading=False)
+    assert feed.polls == 3
+    # The poller never takes them
+    feed.shared = Snapshot({'n': 'shared'}, 9, time.time() + 5)
+    j.run(leading=True)
+    assert feed.polls == 4
+
+
+def test_only_the_poller_keeps_pins(tmp_path):
+    if poller.fcntl is None:
+        pytest.skip('needs fcntl')
+    path = str(tmp_path / 'lock')
+    schedulers = [poller.Scheduler(lock_path=path) for _ in range(2)]
+    for scheduler in schedulers:
+        scheduler.keyed(Feed(), lambda *args: 0, bounds=(10, 100))
+        scheduler.pin('f', ['a'])
+        assert scheduler.jobs == {}
+    leader, follower = schedulers
+    assert leader.elect() and not follower.elect()
+    assert list(leader.jobs) == [('f', 'a')]
+    assert follower.jobs == {}
+    # A follower's own watch of a pinned key still expires
+    follower.watch('f', 'a')
+    follower.jobs[('f', 'a')].last_wanted -= 2 * follower.idle_ttl
+    assert follower._expired(follower.jobs[('f', 'a')])
+    leader.jobs[('f', 'a')].last_wanted -= 2 * leader.idle_ttl
+    assert not leader._expired(leader.jobs[('f', 'a')])
+
+
+def test_pins_are_capped(monkeypatch):
+    monkeypatch.setattr(poller, 'MAX_PINNED', 2)
+    scheduler = poller.Scheduler()
+    scheduler.keyed(Feed(), lambda *args: 0, bounds=(10, 100))
+    scheduler.pin('f', ['c', 'b', 'a'])
+    assert scheduler._pinned['f'] == {'a', 'b'}
+
+
+def test_scheduler_runs_reschedules_and_drops_jobs():
+    runs = []
+    scheduler = poller.Scheduler(idle_ttl=0.2)
+    scheduler.add(poller.Task('t', lambda: runs.append(time.monotonic()),
+                              0.05))
+    feed = Feed()
+    scheduler.keyed(feed, lambda *args: 0, bounds=(0.05, 0.05))
+    scheduler.watch('f', 'stop', fetched=False)
+    scheduler.start()
+    deadline = time.monotonic() + 5
+    while (('f', 'stop') in scheduler.jobs or len(runs) < 5) \
+            and time.monotonic() < deadline:
+        time.sleep(0.02)
+    # The task keeps its interval; the unwatched stop was polled, then
+    # dropped once idle
+    assert len(runs) >= 5
+    assert all(b - a >= 0.04 for a, b in zip(runs, runs[1:]))
+    assert feed.polls >= 1
+    assert ('f', 'stop') not in scheduler.jobs
+    assert 't' in scheduler.jobs
+    polls = feed.polls
+    time.sleep(0.2)
+    assert feed.polls == polls
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import json
+
+import flask
+import pytest
+
+import profiles
+
+BIKE_TO_BANK = {'name': 'Bike to Bank', 'legs': [
+    {'mode': 'bike', 'start': 'BikePoints_1', 'end': 'BikePoints_2',
+     'minutes': 14},
+    {'mode': 'tube', 'line': 'Central', 'minutes': 6}]}
+
+
+def store(tmp_path, **kwargs):
+    return profiles.ProfileStore(str(tmp_path / 'profiles.jsonl'), **kwargs)
+
+
+def test_plan_counts_shared_entities_once(tmp_path):
+    s = store(tmp_path)
+    plans = []
+    s.subscribe(plans.append)
+    a = s.save('A', ['Jubilee'], ['BikePoints_1'], ['490001180E'],
+               [BIKE_TO_BANK])
+    s.save('B', [], ['BikePoints_1'], [])
+    assert s.plan == profiles.Plan(
+        frozenset({'Jubilee', 'Central'}),
+        frozenset({'BikePoints_1', 'BikePoints_2'}),
+        frozenset({'490001180E'}))
+    assert len(plans) == 1
+    # A goes idle: the dock B shows stays
+    s.opened[a.ident] -= 2 * s.active_ttl
+    s.sync()
+    assert s.plan.docks == {'BikePoints_1'}
+    assert s.plan.lines == set() and s.plan.stops == set()
+
+
+def test_profiles_are_shared_through_the_file(tmp_path):
+    saved = store(tmp_path).save('Work', 'Central', [], [])
+    other = store(tmp_path)
+    assert other.get(saved.ident) == saved
+    assert other.plan.lines == {'Central'}
+
+
+def test_invalid_profiles_are_refused(tmp_path):
+    s = store(tmp_path)
+    with pytest.raises(ValueError):
+        s.save(' ', [], [], [])
+    with pytest.raises(ValueError):
+        s.save('Many', [], ['d{}'.format(i) for i in range(30)], [])
+
+
+def test_unreadable_lines_are_skipped(tmp_path):
+    path = tmp_path / 'profiles.jsonl'
+    with open(str(path), 'w') as f:
+        f.write('{"op": "save", "id": "x", "na\n')
+        f.write(json.dumps({'op': 'save', 'id': 'y'}) + '\n')
+        f.write(json.dumps({'op': 'open', 'id': 'z', 'time': 'soon'}) + '\n')
+    s = store(tmp_path)
+    saved = s.save('Work', ['Central'], [], [])
+    assert list(s.profiles) == [saved.ident]
+
+
+def test_only_known_docks_and_stops_are_pinned(tmp_path):
+    s = store(tmp_path, docks=lambda: {'BikePoints_1': None})
+    with pytest.raises(ValueError, match='unknown docks'):
+        s.save('Typo', [], ['BikePoints_9'], [])
+    with pytest.raises(ValueError, match='unknown docks'):
+        s.save('Junk', [], [], [], [
+            {'name': 'Bike', 'legs': [
+                {'mode': 'bike', 'start': 'BikePoints_1',
+                 'end': 'BikePoints_7', 'minutes': 5}]}])
+    with pytest.raises(ValueError, match='invalid stops'):
+        s.save('Junk', [], [], ['../status'])
+    assert s.save('Home', [], ['BikePoints_1'], ['490001180E'])
+    assert not s.plan.docks - {'BikePoints_1'}
+
+
+def test_full_plans_refuse_new_profiles(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiles, 'MAX_PINNED', 2)
+    s = store(tmp_path)
+    server = flask.Flask(__name__)
+    server.register_blueprint(profiles.create_blueprint(s))
+    client = server.test_client()
+    saved = client.post('/api/profiles', json={
+        'name': 'A', 'stops': ['490001180E', '490000266G']})
+    assert saved.status_code == 201
+    # Sharing what is already pinned costs nothing
+    assert client.post('/api/profiles', json={
+        'name': 'B', 'stops': ['490001180E']}).status_code == 201
+    assert client.post('/api/profiles', json={
+        'name': 'C', 'stops': ['490000001A']}).status_code == 409
+    assert s.plan.stops == {'490001180E', '490000266G'}
+
+
+def test_bodies_that_are_not_objects_are_refused(tmp_path):
+    server = flask.Flask(__name__)
+    server.register_blueprint(profiles.create_blueprint(store(tmp_path)))
+    client = server.test_client()
+    for body in ([1], 'x', 3):
+        assert client.post('/api/profiles', json=body).status_code == 400
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import json
+
+import flask
+
+import push
+from snapshots import EMPTY, Snapshot
+
+
+class Feed:
+    def __init__(self, data=None):
+        self.snapshot = Snapshot(data or {}, 1, 1.0)
+        self.listeners = []
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def get(self, key=None):
+        return self.snapshot if key is None else EMPTY
+
+    latest = get
+
+    def publish(self, data):
+        previous, self.snapshot = self.snapshot, Snapshot(
+            data, self.snapshot.version + 1, self.snapshot.fetched + 1)
+        changed = {k for k in data.keys() | previous.data.keys()
+                   if data.get(k) != previous.data.get(k)}
+        for listener in self.listeners:
+            listener(None, self.snapshot, previous, changed)
+
+
+class Dock(dict):
+    def _asdict(self):
+        return dict(self)
+
+
+def events(sub):
+    out = []
+    for chunk in sub.take(0):
+        lines = chunk.decode().splitlines()
+        kind = lines[0].split(': ', 1)[1]
+        out.append((kind, json.loads(lines[2].split(': ', 1)[1])))
+    return out
+
+
+def hub(totals=None):
+    docks = Feed({'a': Dock(bikes=1), 'b': Dock(bikes=2)})
+    return push.Hub(Feed({'Central': 'Good Service'}), docks, Feed(),
+                    totals=totals), docks
+
+
+def test_selected_docks_get_their_changes_only():
+    h, docks = hub()
+    sub = push.Subscriber([], ['a'], [])
+    assert h.subscribe(sub)
+    assert events(sub) == [('docks', {'version': 1, 'removed': [],
+                                      'changed': {'a': {'bikes': 1}}})]
+    docks.publish({'a': Dock(bikes=1), 'b': Dock(bikes=5)})
+    assert events(sub) == []
+    docks.publish({'a': Dock(bikes=0), 'b': Dock(bikes=5)})
+    assert events(sub) == [('docks', {'version': 3, 'removed': [],
+                                      'changed': {'a': {'bikes': 0}}})]
+
+
+def test_totals_are_pushed_when_they_change():
+    state = {'ebikes': 3}
+    h, docks = hub(totals=lambda: dict(state))
+    sub = push.Subscriber([], [], [], totals=True)
+    assert h.subscribe(sub)
+    assert events(sub) == [('totals', {'version': 1,
+                                       'totals': {'ebikes': 3}})]
+    state['ebikes'] = 4
+    docks.publish({'a': Dock(bikes=9)})
+    assert events(sub)[-1] == ('totals', {'version': 2,
+                                          'totals': {'ebikes': 4}})
+    docks.publish({'a': Dock(bikes=8)})
+    assert events(sub) == []
+
+
+def test_full_worker_refuses_streams_with_retry_after(monkeypatch):
+    monkeypatch.setattr(push, 'MAX_STREAMS', 1)
+    h, _ = hub()
+    server = flask.Flask(__name__)
+    server.register_blueprint(push.create_blueprint(h))
+    client = server.test_client()
+    first = client.get('/api/stream?lines=Central', buffered=False)
+    assert first.status_code == 200
+    second = client.get('/api/stream?totals=1')
+    assert second.status_code == 503
+    assert second.headers['Retry-After'] == str(push.RETRY_AFTER)
+    # Closing the first stream frees its place
+    next(iter(first.response))
+    first.close()
+    assert not h.subscribers
+
+
+def test_stops_are_validated_and_never_fetched_on_subscribe():
+    watched = []
+
+    class Arrivals(Feed):
+        def get(self, key=None):
+            raise AssertionError('fetched {} in the request'.format(key))
+
+        def latest(self, key=None):
+            return EMPTY
+
+    h = push.Hub(Feed(), Feed(), Arrivals(),
+                 watch=lambda stop, fetched: watched.append((stop, fetched)))
+    server = flask.Flask(__name__)
+    server.register_blueprint(push.create_blueprint(h))
+    client = server.test_client()
+    assert client.get('/api/stream?stops=../x').status_code == 400
+    assert not watched
+    response = client.get('/api/stream?stops=490001180E', buffered=False)
+    assert response.status_code == 200
+    assert watched == [('490001180E', False)]
+    chunks = iter(response.response)
+    next(chunks)
+    event = next(chunks).decode().splitlines()
+    assert json.loads(event[2].split(': ', 1)[1]) == {
+        'stop': '490001180E', 'version': 0, 'changed': {}, 'removed': []}
+    response.close()
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+import ratelimit
+
+
+def test_bucket_is_shared_through_the_file(tmp_path):
+    path = str(tmp_path / 'bucket')
+    a = ratelimit.FileBucket(rate=0.001, burst=3, path=path)
+    b = ratelimit.FileBucket(rate=0.001, burst=3, path=path)
+    assert a.try_take() == 0
+    assert b.try_take() == 0
+    assert a.try_take() == 0
+    # Three tokens between both, and the refill is far off
+    assert b.try_take() > 100
+
+
+def test_background_keeps_off_the_reserve(tmp_path):
+    bucket = ratelimit.FileBucket(rate=0.001, burst=4,
+                                  path=str(tmp_path / 'bucket'))
+    limiter = ratelimit.Limiter(bucket, reserve=0.5)
+    with ratelimit.background():
+        assert ratelimit.current_priority() == ratelimit.BACKGROUND
+        assert limiter.acquire(timeout=0)
+        assert limiter.acquire(timeout=0)
+        # Two of four tokens are held back for interactive callers
+        assert not limiter.acquire(timeout=0)
+    assert limiter.acquire(timeout=0)
+    assert limiter.acquire(timeout=0)
+    assert not limiter.acquire(timeout=0)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import os
+import zipfile
+
+import replay
+
+
+def inner(url, timeout):
+    return 200, url.encode()
+
+
+def child(func):
+    """Run `func` in a forked child; its exit status"""
+    pid = os.fork()
+    if pid == 0:
+        try:
+            func()
+        except BaseException:
+            os._exit(1)
+        os._exit(0)
+    return os.waitpid(pid, 0)[1]
+
+
+def test_record_then_replay(tmp_path):
+    path = str(tmp_path / 'tfl.zip')
+    recorder = replay.Recorder(inner, path)
+    recorder('a', None)
+    recorder('b', None)
+    recorder('a', None)
+    recorder.close()
+    player = replay.Replayer(path, speed=0)
+    assert player('a', None) == (200, b'a')
+    assert player('b', None) == (200, b'b')
+    assert player('c', None)[0] == 404
+
+
+def test_forked_workers_record_their_own_archives(tmp_path):
+    path = str(tmp_path / 'tfl.zip')
+    recorder = replay.Recorder(inner, path)
+    recorder('master', None)
+
+    def work():
+        recorder.reset()
+        recorder('worker', None)
+        recorder.close()
+
+    assert child(work) == 0
+    recorder.close()
+    names = sorted(os.listdir(str(tmp_path)))
+    assert len(names) == 2 and 'tfl.zip' in names
+    archives = {name: replay.Replayer(str(tmp_path / name), speed=0)
+                for name in names}
+    assert set(archives['tfl.zip'].index) == {'master'}
+    names.remove('tfl.zip')
+    assert set(archives[names[0]].index) == {'worker'}
+    for name in archives:
+        assert zipfile.ZipFile(str(tmp_path / name)).testzip() is None
+
+
+def test_forked_replayer_opens_its_own_file(tmp_path):
+    path = str(tmp_path / 'tfl.zip')
+    recorder = replay.Recorder(inner, path)
+    for url in ('a', 'b', 'c'):
+        recorder(url, None)
+    recorder.close()
+    player = replay.Replayer(path, speed=0)
+    assert player('a', None) == (200, b'a')
+
+    def work():
+        player.reset()
+        for url in ('b', 'c'):
+            assert player(url, None) == (200, url.encode())
+
+    assert child(work) == 0
+    assert player._pid == os.getpid()
+    assert player('c', None) == (200, b'c')
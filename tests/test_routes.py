@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import json
+
+import flask
+
+import routes
+from snapshots import Snapshot
+
+
+class Response:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def json(self):
+        return self.rows
+
+
+def row(vehicle, stop, minute, destination='Ilford', towards='Bow'):
+    return {'vehicleId': vehicle, 'naptanId': stop,
+            'stationName': 'Stop ' + stop, 'lineId': '25',
+            'destinationName': destination, 'towards': towards,
+            'direction': 'outbound',
+            'expectedArrival': '2022-06-08T09:{:02d}:00Z'.format(minute)}
+
+
+# v1 is two stops from C, v2 one stop, and v3 heads the other way
+ARRIVALS = routes.parse_route(Response([
+    row('v1', 'C', 9), row('v1', 'A', 1), row('v1', 'B', 5),
+    row('v2', 'B', 2), row('v2', 'C', 6),
+    row('v3', 'C', 3, destination='Oxford Circus', towards='Holborn')]))
+
+
+def test_calls_are_sorted_and_indexed_by_stop():
+    assert [c.stop for c in ARRIVALS['v1'].calls] == ['A', 'B', 'C']
+    assert [(ident, position) for _, ident, position
+            in ARRIVALS.stops['C']] == [('v3', 0), ('v2', 1), ('v1', 2)]
+
+
+def test_next_at_soonest_first_and_heading():
+    buses = routes.next_at(ARRIVALS, 'C', towards='ilford')
+    assert [(b['vehicle'], b['stops_away'], b['next_stop_id'])
+            for b in buses] == [('v2', 1, 'B'), ('v1', 2, 'A')]
+    assert [b['vehicle'] for b in routes.next_at(ARRIVALS, 'C', 'holborn')] \
+        == ['v3']
+    assert len(routes.next_at(ARRIVALS, 'C', count=2)) == 2
+    assert routes.next_at(ARRIVALS, 'Z') == []
+
+
+class Feed:
+    def __init__(self):
+        self.asked = []
+
+    def get(self, route):
+        self.asked.append(route)
+        return Snapshot(ARRIVALS, 1, 1e9)
+
+
+def client(feed, watched):
+    server = flask.Flask(__name__)
+    server.register_blueprint(routes.create_blueprint(feed, watched.append))
+    return server.test_client()
+
+
+def test_route_names_are_validated():
+    feed, watched = Feed(), []
+    c = client(feed, watched)
+    r = c.get('/api/routes/N25?stop=C&towards=Ilford')
+    assert r.status_code == 200
+    assert [b['vehicle'] for b in json.loads(r.data)['buses']] == ['v2', 'v1']
+    for bad in ('25%3Fapp_key=x', 'Central', '25-', '1234'):
+        assert c.get('/api/routes/' + bad).status_code == 400
+    assert feed.asked == watched == ['n25']
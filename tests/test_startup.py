@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import bench_startup
+
+IMPORTTIME = """\
+import time: self [us] | cumulative | imported package
+import time:       120 |        120 |   _csv
+import time:       300 |        420 | csv
+import time:        50 |         50 |     timeutil
+import time:       200 |        250 |   aggregates
+import time:      1000 |       1670 | app
+"""
+
+
+def test_parse_importtime():
+    entries = bench_startup.parse_importtime(IMPORTTIME)
+    assert [(e.module, e.depth) for e in entries] == [
+        ('_csv', 1), ('csv', 0), ('timeutil', 2), ('aggregates', 1),
+        ('app', 0)]
+    assert entries[-1].self_us == 1000
+    assert entries[-1].cumulative_us == 1670
+
+
+def test_app_imports_no_heavy_modules():
+    # In a fresh interpreter, as a worker would
+    wall_us, entries = bench_startup.measure()
+    loaded = {e.module for e in entries}
+    assert 'app' in loaded
+    assert not loaded & set(bench_startup.FORBIDDEN)
+    assert wall_us > 0
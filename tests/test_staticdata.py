@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from staticdata import (PackedStrings, StopIndex, TrigramIndex, normalize,
+                        trigrams)
+
+STOPS = StopIndex(['1', '2', '3', '4'],
+                  ['ALBANY STREET', 'HIGHBURY CORNER', 'LIBERTY AVENUE',
+                   'HIGHBURY & ISLINGTON STATION <> #_B'])
+
+
+def labels(options):
+    return [o['label'] for o in options]
+
+
+def test_short_query_matches_inside_names():
+    # Shorter than a trigram: matched as a substring, as before the index
+    assert labels(STOPS.search('LB')) == ['ALBANY STREET']
+    assert labels(STOPS.search('y')) == [
+        'ALBANY STREET', 'HIGHBURY CORNER', 'LIBERTY AVENUE',
+        'HIGHBURY & ISLINGTON STATION <> #_B']
+
+
+def test_typo_finds_the_stop():
+    assert labels(STOPS.search('hiberry corner'))[0] == 'HIGHBURY CORNER'
+
+
+def test_exact_words_rank_first():
+    assert labels(STOPS.search('highbury'))[:2] == [
+        'HIGHBURY CORNER', 'HIGHBURY & ISLINGTON STATION <> #_B']
+    assert labels(STOPS.search('highbury isl'))[0] == \
+        'HIGHBURY & ISLINGTON STATION <> #_B'
+
+
+def test_packed_strings_behave_like_a_list():
+    values = ['ALBANY STREET', '', 'BANK', 'ALBANY ROAD']
+    packed = PackedStrings(values)
+    assert len(packed) == 4
+    assert list(packed) == values
+    assert [packed[i] for i in range(4)] == values
+    assert packed[-1] == 'ALBANY ROAD'
+    assert packed.row_at(packed.starts[2] + 1) == 2
+    assert packed.find_all('ALBANY') == [0, 3]
+    assert packed.find_all('ALBANY', limit=1) == [0]
+    # A needle never spans two strings
+    assert packed.find_all('STREET\n') == []
+    assert packed.find_all('EETB') == []
+    assert list(PackedStrings([])) == [] and len(PackedStrings([])) == 0
+
+
+def test_trigram_index_counts_shared_trigrams():
+    texts = ['highbury corner', 'bank', 'highbury islington station']
+    index = TrigramIndex(texts)
+    codes = trigrams('highbury')
+    shared = index.shared(codes)
+    assert shared[0] == shared[2] == len(codes)
+    assert 1 not in shared
+    assert list(index.sizes) == [len(trigrams(t)) for t in texts]
+
+
+def test_normalize_and_prefix_trigrams():
+    assert normalize('HIGHBURY & ISLINGTON STATION <> #_B') == \
+        'highbury islington station'
+    assert normalize("KING'S CROSS") == 'kings cross'
+    assert trigrams('westm', prefix=True) <= trigrams('westminster')
+    assert not trigrams('westm') <= trigrams('westminster')
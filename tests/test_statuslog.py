@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import json
+
+import statuslog
+from snapshots import EMPTY, Snapshot
+
+
+class Feed:
+    """Publishes snapshots to its listeners, as snapshots.Feed does"""
+
+    def __init__(self):
+        self.snapshot = EMPTY
+        self.listeners = []
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def latest(self, key=None):
+        return self.snapshot
+
+    def publish(self, data, at):
+        previous = self.snapshot
+        self.snapshot = Snapshot(data, previous.version + 1, at)
+        changed = {k for k in data if data[k] != previous.data.get(k)}
+        for listener in self.listeners:
+            listener(None, self.snapshot, previous, changed)
+
+
+def test_changes_are_written_once(tmp_path):
+    path = str(tmp_path / 'tube.jsonl')
+    feeds = [Feed(), Feed()]
+    logs = [statuslog.StatusLog(feed, path) for feed in feeds]
+    for feed in feeds:
+        feed.publish({'Central': 'Good Service'}, 1000.0)
+        feed.publish({'Central': 'Minor Delays'}, 1600.0)
+    with open(path) as f:
+        assert [json.loads(line) for line in f] == [
+            [1000.0, 'Central', 'Good Service'],
+            [1600.0, 'Central', 'Minor Delays']]
+    assert logs[0].timeline('Central', 0, 2000) == [
+        ('Good Service', 1000.0, 1600.0), ('Minor Delays', 1600.0, None)]
+
+
+def test_disruption_minutes(tmp_path):
+    feed = Feed()
+    log = statuslog.StatusLog(feed, str(tmp_path / 'tube.jsonl'))
+    feed.publish({'Jubilee': 'Severe Delays'}, 1000.0)
+    feed.publish({'Jubilee': 'Good Service'}, 1600.0)
+    feed.publish({'Jubilee': 'Part Suspended'}, 2200.0)
+    assert log.disruption('Jubilee', 0, 2500) == 15.0
+    assert log.disruption('Jubilee', 1300, 1900) == 5.0
+
+
+def test_unreadable_lines_are_skipped(tmp_path):
+    path = tmp_path / 'tube.jsonl'
+    path.write_text('[1000.0, "Central", "Good Service"]\n'
+                    '[1300.0, "Cent\n'
+                    '["soon", "Central", "Minor Delays"]\n'
+                    '[1600.0, "Central"]\n'
+                    '[1900.0, "Central", "Severe Delays"]\n')
+    log = statuslog.StatusLog(Feed(), str(path))
+    assert [status for status, _, _ in log.timeline('Central', 0, 2000)] \
+        == ['Good Service', 'Severe Delays']
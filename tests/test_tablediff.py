@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from dash import Patch, no_update
+
+import tablediff
+
+
+def apply(data, patch):
+    """Apply a Patch to a list, as the Dash renderer does"""
+    data = list(data)
+    for op in patch.to_plotly_json()['operations']:
+        if op['operation'] == 'Delete':
+            del data[op['location'][0]]
+        elif op['operation'] == 'Assign':
+            data[op['location'][0]] = op['params']['value']
+        elif op['operation'] == 'Append':
+            data.append(op['params']['value'])
+        else:
+            raise AssertionError(op)
+    return data
+
+
+def rows(*pairs):
+    return [{'ID': ident, 'Bikes': bikes} for ident, bikes in pairs]
+
+
+def show(new, shown=None, data=None):
+    """The table's data and store after a refresh to `new`"""
+    patch, sigs = tablediff.patch_rows(shown, new, 'ID')
+    if patch is no_update:
+        return data, shown, patch
+    if isinstance(patch, Patch):
+        return apply(data, patch), sigs, patch
+    return patch, sigs, patch
+
+
+def test_new_table_gets_every_row():
+    data, shown, sent = show(rows(('a', 1), ('b', 2)))
+    assert sent == data == rows(('a', 1), ('b', 2))
+    assert [k for k, _ in shown] == ['a', 'b']
+
+
+def test_unchanged_table_sends_nothing():
+    data, shown, _ = show(rows(('a', 1), ('b', 2)))
+    assert tablediff.patch_rows(shown, rows(('a', 1), ('b', 2)), 'ID') \
+        == (no_update, no_update)
+
+
+def test_changed_removed_and_added_rows_are_patched():
+    data, shown, _ = show(rows(('a', 1), ('b', 2), ('c', 3), ('d', 4)))
+    new = rows(('a', 1), ('c', 9), ('d', 4), ('e', 5))
+    data, shown, sent = show(new, shown, data)
+    assert isinstance(sent, Patch)
+    ops = [op['operation'] for op in sent.to_plotly_json()['operations']]
+    # b deleted, c replaced, e appended; a and d not sent
+    assert ops == ['Delete', 'Assign', 'Append']
+    assert data == new
+    assert shown == tablediff.patch_rows(None, new, 'ID')[1]
+
+
+def test_reordered_rows_are_sent_whole():
+    data, shown, _ = show(rows(('a', 1), ('b', 2)))
+    data, shown, sent = show(rows(('b', 2), ('a', 1)), shown, data)
+    assert sent == rows(('b', 2), ('a', 1))
+    data, shown, sent = show(rows(('b', 2), ('c', 3), ('a', 1)), shown, data)
+    assert sent == data == rows(('b', 2), ('c', 3), ('a', 1))
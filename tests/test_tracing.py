@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+import flask
+import pytest
+
+import tracing
+
+
+@pytest.fixture
+def trace_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(tracing, 'TRACE_DIR', str(tmp_path))
+    monkeypatch.setattr(tracing, 'FLAG_FILE', str(tmp_path / 'enabled'))
+    yield tmp_path
+    tracing.disable()
+
+
+def test_validate_rejects_bad_settings():
+    assert tracing.validate({'slow_ms': 200})['slow_ms'] == 200
+    for bad in ({'slow_ms': '500'}, {'profile_rate': 2},
+                {'profile_rate': True}, {'profiler': 'perf'},
+                {'colour': 'red'}):
+        with pytest.raises(ValueError):
+            tracing.validate(bad)
+
+
+def test_traced_callback_survives_hand_written_settings(trace_dir):
+    (trace_dir / 'enabled').write_text(json.dumps({'slow_ms': 'slow'}))
+    tracing._state['checked'] = float('-inf')
+    assert tracing.settings()['slow_ms'] == 500
+
+    @tracing.traced
+    def callback(x):
+        return x + 1
+
+    assert callback(1) == 2
+
+
+def test_admin_endpoint_returns_400(trace_dir, monkeypatch):
+    monkeypatch.setenv('COMMUTE_ADMIN_TOKEN', 'secret')
+    server = flask.Flask(__name__)
+    tracing.install(server)
+    client = server.test_client()
+    auth = {'Authorization': 'Bearer secret'}
+    r = client.post('/debug/tracing', json={'slow_ms': 'fast'},
+                    headers=auth)
+    assert r.status_code == 400
+    assert not os.path.exists(tracing.FLAG_FILE)
+    r = client.post('/debug/tracing', json={'slow_ms': 50}, headers=auth)
+    assert r.status_code == 200 and r.get_json()['slow_ms'] == 50
+    r = client.post('/debug/tracing', json={'on': False}, headers=auth)
+    assert r.get_json() is None
+
+
+def test_trace_file_rotates(trace_dir, monkeypatch):
+    monkeypatch.setattr(tracing, 'MAX_TRACE_BYTES', 2000)
+    tracing.enable()
+    for i in range(50):
+        with tracing.span('poll', feed='tube'):
+            pass
+    path = trace_dir / 'trace-{}.json'.format(os.getpid())
+    rotated = trace_dir / 'trace-{}.1.json'.format(os.getpid())
+    assert path.stat().st_size <= 2000
+    assert rotated.stat().st_size <= 2000
+    assert path.read_text().startswith('[\n')
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+import pytest
+import requests
+
+import ratelimit
+import upstream
+from upstream import Policy, Upstream, UpstreamError
+
+
+class Transport:
+    """Answers from a list of (status, body) or exceptions, in order"""
+
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.calls = 0
+
+    def __call__(self, url, timeout):
+        self.calls += 1
+        answer = self.answers.pop(0) if self.answers else (200, b'ok')
+        if isinstance(answer, BaseException):
+            raise answer
+        return answer
+
+
+class Limiter:
+    def __init__(self, *grants):
+        self.grants = list(grants)
+        self.timeouts = []
+
+    def acquire(self, timeout=None):
+        self.timeouts.append(timeout)
+        return self.grants.pop(0) if self.grants else True
+
+
+def client(transport, limiter=None, **policy):
+    policy = dict(dict(retries=0, backoff=0.0, failure_threshold=1,
+                       reset_timeout=0.0), **policy)
+    return Upstream(transport, {'t': Policy(**policy)}, limiter=limiter)
+
+
+def test_rate_limited_trial_leaves_circuit_usable():
+    limiter = Limiter()
+    c = client(Transport(requests.ConnectionError()), limiter)
+    with pytest.raises(UpstreamError):
+        c.refresh('t', 'u')
+    assert c.endpoint('t').breaker.opened_at is not None
+    # The half-open call is refused by the limiter ...
+    limiter.grants = [False]
+    with pytest.raises(UpstreamError, match='rate limited'):
+        c.refresh('t', 'u')
+    # ... which must not leave the circuit stuck open
+    assert c.refresh('t', 'u').content == b'ok'
+    assert c.endpoint('t').breaker.opened_at is None
+
+
+def test_unexpected_transport_error_releases_trial():
+    c = client(Transport(requests.ConnectionError(), KeyError('x')))
+    with pytest.raises(UpstreamError):
+        c.refresh('t', 'u')
+    with pytest.raises(KeyError):
+        c.refresh('t', 'u')
+    assert c.refresh('t', 'u').content == b'ok'
+
+
+def test_open_circuit_spends_no_tokens():
+    limiter = Limiter()
+    c = client(Transport(requests.ConnectionError()), limiter,
+               reset_timeout=60.0)
+    with pytest.raises(UpstreamError):
+        c.refresh('t', 'u')
+    limiter.grants = [False]
+    with pytest.raises(UpstreamError, match='circuit open'):
+        c.refresh('t', 'u')
+    assert limiter.grants == [False]
+
+
+def test_breaker_opens_after_threshold_and_closes_on_trial():
+    breaker = upstream.CircuitBreaker('t', threshold=2, reset_timeout=0.0)
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.opened_at is None
+    breaker.failure()
+    assert breaker.opened_at is not None
+    # Half-open: one trial at a time
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.failure()
+    assert breaker.opened_at is not None and not breaker.trial
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.opened_at is None and breaker.failures == 0
+
+
+def test_breaker_waits_for_reset_timeout():
+    breaker = upstream.CircuitBreaker('t', threshold=1, reset_timeout=60.0)
+    breaker.failure()
+    assert breaker.blocked()
+    assert not breaker.allow()
+
+
+def test_retries_then_succeeds():
+    transport = Transport((503, b''), requests.Timeout(), (200, b'ok'))
+    c = client(transport, retries=2, failure_threshold=5)
+    assert c.refresh('t', 'u').content == b'ok'
+    assert transport.calls == 3
+
+
+def test_client_errors_are_not_retried():
+    transport = Transport((404, b''))
+    c = client(transport, retries=2, failure_threshold=5)
+    with pytest.raises(UpstreamError, match='404'):
+        c.refresh('t', 'u')
+    assert transport.calls == 1
+
+
+def test_fresh_responses_come_from_memory():
+    transport = Transport((200, b'one'), (200, b'two'))
+    c = client(transport, fresh=60.0)
+    assert c.fetch('t', 'u').content == b'one'
+    assert c.fetch('t', 'u').content == b'one'
+    assert transport.calls == 1
+
+
+def test_last_good_response_served_stale_when_tfl_fails():
+    transport = Transport((200, b'one'), (500, b''))
+    c = client(transport, fresh=0.0, max_stale=0.0, failure_threshold=5)
+    assert not c.fetch('t', 'u').stale
+    response = c.fetch('t', 'u')
+    assert response.content == b'one' and response.stale
+
+
+def test_interactive_calls_wait_briefly_for_tokens_then_serve_stale():
+    limiter = Limiter()
+    c = client(Transport(), limiter, fresh=0.0, max_stale=0.0,
+               deadline=10.0)
+    assert not c.fetch('t', 'u').stale
+    assert limiter.timeouts == [ratelimit.TIMEOUTS[ratelimit.INTERACTIVE]]
+    limiter.grants = [False]
+    response = c.fetch('t', 'u')
+    assert response.content == b'ok' and response.stale
+    with ratelimit.background():
+        c.refresh('t', 'u')
+    assert 9.0 < limiter.timeouts[-1] <= 10.0
+
+
+def test_no_response_and_failure_raises():
+    c = client(Transport((500, b'')), failure_threshold=5)
+    with pytest.raises(UpstreamError):
+        c.fetch('t', 'u')
+
+
+def test_workers_share_responses(tmp_path):
+    polling = client(Transport((200, b'first')))
+    other = client(Transport((200, b'own')))
+    polling.share(str(tmp_path))
+    other.share(str(tmp_path))
+    assert other.adopt('u') is None
+    response = polling.refresh('t', 'u')
+    adopted = other.adopt('u')
+    assert adopted == response
+    # Kept in memory, so fetches are answered without TfL
+    assert other.fetch('t', 'u').content == b'first'
+    assert other.transport.calls == 0
+
+
+def test_fetch_reads_shared_responses_first(tmp_path):
+    polling = client(Transport((200, b'first')), fresh=60.0)
+    other = client(Transport((200, b'own')), fresh=60.0)
+    polling.share(str(tmp_path))
+    other.share(str(tmp_path))
+    polling.refresh('t', 'u')
+    assert other.fetch('t', 'u').content == b'first'
+    assert other.transport.calls == 0
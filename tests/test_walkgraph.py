@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import walkgraph
+
+# About 100 m apart along a street in the City, and one far away
+POINTS = [('BikePoints_1', 51.5130, -0.0890),
+          ('940GZZLUBNK', 51.5133, -0.0880),
+          ('490001180E', 51.5136, -0.0870),
+          ('BikePoints_2', 51.4500, -0.2000)]
+
+
+@pytest.fixture
+def graph(tmp_path):
+    pytest.importorskip('numpy')
+    path = str(tmp_path / 'walkgraph.bin')
+    walkgraph.write(path, *walkgraph.build(POINTS))
+    return walkgraph.WalkGraph(path)
+
+
+def test_round_trip(graph):
+    assert len(graph) == 4
+    near = graph.nearby('BikePoints_1')
+    assert [ident for ident, _ in near] == ['940GZZLUBNK', '490001180E']
+    assert near[0][1] < near[1][1]
+    assert graph.nearby('BikePoints_2') == []
+    assert graph.nearby('nowhere') == []
+
+
+def test_kinds(graph):
+    assert walkgraph.kind_of('940GZZLUBNK') == 'stations'
+    assert [ident for ident, _ in graph.nearby(
+        'BikePoints_1', 'stations')] == ['940GZZLUBNK']
+    assert [ident for ident, _ in graph.nearby(
+        '940GZZLUBNK', 'docks')] == ['BikePoints_1']
+
+
+def test_seconds_between(graph):
+    seconds = graph.seconds_between('BikePoints_1', '940GZZLUBNK')
+    assert seconds == graph.seconds_between('940GZZLUBNK', 'BikePoints_1')
+    # Straight line, times the detour, at walking speed
+    assert 60 < seconds < 90
+    assert graph.seconds_between('BikePoints_1', 'BikePoints_1') == 0.0
+    assert graph.seconds_between('BikePoints_1', 'BikePoints_2') is None
+
+
+def test_missing_graph_finds_nothing(tmp_path):
+    graph = walkgraph.WalkGraph(str(tmp_path / 'none.bin'))
+    assert not graph.prepare()
+    assert graph.nearby('BikePoints_1') == []
+
+
+@pytest.mark.parametrize('damage', ['empty', 'short', 'truncated',
+                                    'version'])
+def test_unreadable_graph_finds_nothing(graph, damage):
+    with open(graph.path, 'rb') as f:
+        data = f.read()
+    if damage == 'empty':
+        data = b''
+    elif damage == 'short':
+        data = data[:10]
+    elif damage == 'truncated':
+        data = data[:len(data) // 2]
+    else:
+        data = data[:4] + b'\xff' + data[5:]
+    with open(graph.path, 'wb') as f:
+        f.write(data)
+    assert not graph.prepare()
+    assert graph.nearby('BikePoints_1') == []
+    assert graph.seconds_between('BikePoints_1', '940GZZLUBNK') is None
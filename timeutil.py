@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+TfL timestamp parsing without pandas.
+
+TfL sends ISO 8601 UTC timestamps with a 'Z' suffix and anything from no
+to seven fractional digits, which `datetime.fromisoformat` on Python 3.9
+rejects, so they are normalised first.
+
+@author: VK
+"""
+
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+
+
+LONDON = ZoneInfo('Europe/London')
+
+
+def parse_iso(ts: str) -> datetime:
+    """
+    Parse a TfL timestamp into an aware UTC datetime
+
+    '2022-06-08T13:33:57.047Z' -> datetime(2022, 6, 8, 13, 33, 57, 47000,
+    tzinfo=timezone.utc)
+    """
+    ts = ts.strip()
+    zone = '+00:00'
+    if ts.endswith('Z'):
+        ts = ts[:-1]
+    elif len(ts) > 6 and ts[-6] in '+-' and ts[-3] == ':':
+        ts, zone = ts[:-6], ts[-6:]
+    head, _, frac = ts.partition('.')
+    if frac:
+        head += '.' + frac[:6].ljust(6, '0')
+    return datetime.fromisoformat(head + zone).astimezone(timezone.utc)
+
+
+def epoch(ts: str) -> float:
+    """TfL timestamp as seconds since the epoch"""
+    return parse_iso(ts).timestamp()
+
+
+def london(ts: str) -> datetime:
+    """TfL timestamp in London local time"""
+    return parse_iso(ts).astimezone(LONDON)
@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Opt-in request tracing and slow-path profiling.
+
+While tracing is on, every Dash request, callback and upstream call is
+broken into spans (fetch, decode, parse, transform, serialize) which are
+appended to `trace-<pid>.json` in the trace directory as Chrome trace events.
+The files open directly in Perfetto (ui.perfetto.dev) or chrome://tracing.
+
+Tracing is switched on and off at runtime by the presence of an `enabled`
+file in the trace directory, so all workers pick up the change within a
+second and no redeploy is needed:
+
+    python tracing.py on --profile-rate 0.05 --slow-ms 500
+    python tracing.py off
+
+On hosts where a shell on the dyno is not available, set
+COMMUTE_ADMIN_TOKEN and POST the same settings as JSON (plus `"on": false`
+to switch off) to `/debug/tracing` with an `Authorization: Bearer` header.
+
+The `enabled` file holds the settings as JSON. When `profile_rate` is
+non-zero that fraction of callbacks runs under cProfile (or pyinstrument,
+if installed and selected) and the profile is kept only if the callback
+took longer than `slow_ms`.
+
+A trace file is rotated to `trace-<pid>.1.json` when it reaches
+MAX_TRACE_BYTES, so a worker keeps at most two, and no more than
+MAX_PROFILES profiles are kept in the directory.
+
+@author: VK
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from functools import wraps
+
+
+TRACE_DIR = os.environ.get(
+    'COMMUTE_TRACE_DIR',
+    os.path.join(tempfile.gettempdir(), 'vk-commute-trace'))
+FLAG_FILE = os.path.join(TRACE_DIR, 'enabled')
+DEFAULT_SETTINGS = {'profile_rate': 0.0, 'slow_ms': 500,
+                    'profiler': 'cprofile'}
+PROFILERS = ('cprofile', 'pyinstrument')
+CHECK_INTERVAL = 1.0
+MAX_TRACE_BYTES = 64 * 1024 * 1024
+MAX_PROFILES = 200
+
+_local = threading.local()
+_write_lock = threading.Lock()
+_state = {'checked': float('-inf'), 'settings': None}
+
+
+def _number(options: dict, name: str, low: float, high: float):
+    value = options[name]
+    if isinstance(value, bool) or not isinstance(value, (int, float)) \
+            or not low <= value <= high:
+        raise ValueError('{} must be a number from {} to {}'.format(
+            name, low, high))
+
+
+def validate(options: dict) -> dict:
+    """
+    Complete tracing settings from DEFAULT_SETTINGS
+
+    Raises
+    ------
+    ValueError
+        If a setting is unknown or not valid.
+
+    """
+    if not isinstance(options, dict):
+        raise ValueError('settings are a JSON object')
+    unknown = set(options) - set(DEFAULT_SETTINGS)
+    if unknown:
+        raise ValueError('unknown settings: ' + ', '.join(sorted(unknown)))
+    current = dict(DEFAULT_SETTINGS)
+    current.update({k: v for k, v in options.items() if v is not None})
+    _number(current, 'profile_rate', 0, 1)
+    _number(current, 'slow_ms', 0, 3600 * 1000)
+    if current['profiler'] not in PROFILERS:
+        raise ValueError('profiler must be one of ' + ', '.join(PROFILERS))
+    return current
+
+
+def settings():
+    """
+    Current tracing settings, or None when tracing is off
+
+    The flag file is looked at no more than once per CHECK_INTERVAL.
+    """
+    now = time.monotonic()
+    if now - _state['checked'] < CHECK_INTERVAL:
+        return _state['settings']
+    _state['checked'] = now
+    try:
+        with open(FLAG_FILE) as f:
+            text = f.read()
+    except OSError:
+        _state['settings'] = None
+        return None
+    try:
+        current = validate(json.loads(text or '{}'))
+    except ValueError:
+        # Written by hand, say; trace with the defaults rather than fail
+        current = dict(DEFAULT_SETTINGS)
+    _state['settings'] = current
+    return current
+
+
+def enable(**options):
+    """
+    Turn tracing on for every process sharing TRACE_DIR
+
+    Raises
+    ------
+    ValueError
+        If a setting is not valid.
+
+    """
+    current = validate(options)
+    os.makedirs(TRACE_DIR, exist_ok=True)
+    with open(FLAG_FILE, 'w') as f:
+        json.dump(current, f)
+    _state['checked'] = float('-inf')
+    return current
+
+
+def disable():
+    try:
+        os.remove(FLAG_FILE)
+    except FileNotFoundError:
+        pass
+    _state['checked'] = float('-inf')
+
+
+def _now_us() -> float:
+    return time.perf_counter() * 1e6
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('name', 'cat', 'args', 'start', 'root')
+
+    def __init__(self, name, cat, args, root):
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.root = root
+
+    def __enter__(self):
+        if self.root:
+            _local.events = []
+        self.start = _now_us()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = _now_us()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        _local.events.append(_event(self.name, self.cat, self.start,
+                                    end - self.start, self.args))
+        if self.root:
+            events, _local.events = _local.events, None
+            _flush(events)
+        return False
+
+
+def _event(name, cat, start, duration, args):
+    return {'name': name, 'cat': cat, 'ph': 'X', 'ts': round(start, 1),
+            'dur': round(duration, 1), 'pid': os.getpid(),
+            'tid': threading.get_ident(), 'args': args}
+
+
+def _flush(events):
+    # JSON array format without the closing bracket, which trace viewers
+    # accept; it lets every worker append without rewriting the file.
+    path = os.path.join(TRACE_DIR, 'trace-{}.json'.format(os.getpid()))
+    lines = ''.join(json.dumps(e, default=str) + ',\n' for e in events)
+    with _write_lock:
+        try:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = None
+            if size is not None and size + len(lines) > MAX_TRACE_BYTES:
+                os.replace(path, path[:-len('.json')] + '.1.json')
+                size = None
+            new = size is None
+            with open(path, 'a') as f:
+                if new:
+                    f.write('[\n')
+                f.write(lines)
+        except OSError:
+            pass
+
+
+def span(name: str, cat: str = 'app', **args):
+    """
+    Context manager recording one span
+
+    Outside a traced request a span becomes its own root and is written
+    out on exit. When tracing is off this returns a shared no-op object.
+    """
+    if getattr(_local, 'events', None) is not None:
+        return _Span(name, cat, args, root=False)
+    if settings() is None:
+        return _NULL
+    return _Span(name, cat, args, root=True)
+
+
+def _profiled(func, name, options, args, kwargs):
+    start = time.perf_counter()
+    if options.get('profiler') == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            Profiler = None
+        if Profiler is not None:
+            profiler = Profiler()
+            profiler.start()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.stop()
+                if _slow(start, options):
+                    _save(name, 'html', profiler.output_html())
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        if _slow(start, options):
+            path = _profile_path(name, 'prof')
+            try:
+                profiler.dump_stats(path)
+            except OSError:
+                pass
+
+
+def _slow(start, options):
+    if (time.perf_counter() - start) * 1000 < options['slow_ms']:
+        return False
+    try:
+        kept = sum(name.startswith('profile-')
+                   for name in os.listdir(TRACE_DIR))
+    except OSError:
+        return False
+    return kept < MAX_PROFILES
+
+
+def _profile_path(name, ext):
+    return os.path.join(TRACE_DIR, 'profile-{}-{}-{}.{}'.format(
+        name, os.getpid(), int(time.time() * 1000), ext))
+
+
+def _save(name, ext, text):
+    try:
+        with open(_profile_path(name, ext), 'w') as f:
+            f.write(text)
+    except OSError:
+        pass
+
+
+def traced(func):
+    """
+    Decorator tracing a Dash callback, and sampling it into the profiler
+
+    Apply it below `@app.callback(...)`.
+    """
+    name = func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        options = settings()
+        if options is None:
+            return func(*args, **kwargs)
+        try:
+            with span(name, cat='callback'):
+                if random.random() < options['profile_rate']:
+                    return _profiled(func, name, options, args, kwargs)
+                return func(*args, **kwargs)
+        finally:
+            _local.callback_end = _now_us()
+
+    return wrapper
+
+
+def install(server, paths=('/_dash-update-component',)):
+    """
+    Trace whole requests to `paths` on a Flask server
+
+    The time between the end of the callback and the end of the request is
+    recorded as the 'serialize' span (Dash's JSON encoding and dispatch).
+    """
+    import flask
+
+    @server.before_request
+    def _begin_trace():
+        if flask.request.path in paths:
+            root = span(flask.request.path, cat='request')
+            if root is not _NULL:
+                root.__enter__()
+                _local.callback_end = None
+                flask.g.trace_root = root
+
+    @server.teardown_request
+    def _end_trace(exc):
+        root = flask.g.pop('trace_root', None)
+        if root is None:
+            return
+        callback_end = getattr(_local, 'callback_end', None)
+        if callback_end is not None and _local.events is not None:
+            _local.events.append(_event('serialize', 'app', callback_end,
+                                        _now_us() - callback_end, {}))
+        root.__exit__(None if exc is None else type(exc), exc, None)
+
+    token = os.environ.get('COMMUTE_ADMIN_TOKEN')
+    if not token:
+        return
+
+    @server.route('/debug/tracing', methods=['GET', 'POST'])
+    def _toggle_tracing():
+        if flask.request.headers.get('Authorization') != 'Bearer ' + token:
+            flask.abort(403)
+        if flask.request.method == 'POST':
+            body = flask.request.get_json(silent=True)
+            if not isinstance(body, dict):
+                flask.abort(400, 'settings are a JSON object')
+            if body.pop('on', True):
+                try:
+                    enable(**body)
+                except ValueError as e:
+                    flask.abort(400, str(e))
+            else:
+                disable()
+        return flask.jsonify(settings())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('action', choices=['on', 'off', 'status'])
+    parser.add_argument('--profile-rate', type=float)
+    parser.add_argument('--slow-ms', type=float)
+    parser.add_argument('--profiler', choices=['cprofile', 'pyinstrument'])
+    opts = parser.parse_args()
+    if opts.action == 'on':
+        print(enable(profile_rate=opts.profile_rate, slow_ms=opts.slow_ms,
+                     profiler=opts.profiler))
+    elif opts.action == 'off':
+        disable()
+    else:
+        print(settings() or 'off')
+    print('trace directory:', TRACE_DIR)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Resilient client for the TfL endpoints.
+
+Every call goes through `client.fetch(endpoint, url)`, which applies the
+endpoint's `Policy`:
+
+* connect/read timeouts and an overall deadline, so a hung TfL endpoint
+  can't hold a gunicorn worker,
+* bounded retries with full-jitter exponential backoff,
+* a circuit breaker per endpoint, which fails fast while TfL is down,
+* the host-wide TfL rate limit (see ratelimit.py), waited on for at most
+  the priority's `ratelimit.TIMEOUTS`, so an interactive call that finds
+  the bucket empty fails over to the stale response within seconds,
+* stale-while-revalidate: a response younger than `fresh` is served from
+  memory; one younger than `max_stale` is served immediately while a
+  background thread refreshes it; and if TfL fails the last good response
+  is served (flagged `stale`) rather than an error.
+
+Under gunicorn, `share()` also leaves every response in a directory the
+other workers on the host read, so one worker's poll serves them all (see
+poller.py); `fetch` looks there before calling TfL when its own copy is
+missing or no longer fresh.
+
+@author: VK
+"""
+
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, NamedTuple, Optional, Tuple
+
+import requests
+
+import metrics
+import ratelimit
+import replay
+import tracing
+
+
+BIKE_URL = "https://api.tfl.gov.uk/BikePoint/"
+TUBE_URL = "http://cloud.tfl.gov.uk/TrackerNet/LineStatus"
+BUS_URL = "https://api.tfl.gov.uk/StopPoint/{stopid}/arrivals"
+ROUTE_URL = "https://api.tfl.gov.uk/Line/{route}/Arrivals"
+
+
+class UpstreamError(Exception):
+    """Raised when an endpoint fails and there is no snapshot to fall back on"""
+
+
+@dataclass(frozen=True)
+class Policy:
+    """
+    Per-endpoint timeouts, retry and caching policy
+
+    Times are in seconds.
+    """
+    connect_timeout: float = 3.05
+    read_timeout: float = 5.0
+    deadline: float = 8.0
+    retries: int = 2
+    backoff: float = 0.25
+    fresh: float = 30.0
+    max_stale: float = 600.0
+    failure_threshold: int = 5
+    reset_timeout: float = 30.0
+
+
+POLICIES = {
+    'tube': Policy(fresh=30.0, max_stale=900.0),
+    'bikepoint': Policy(read_timeout=10.0, deadline=12.0, fresh=30.0,
+                        max_stale=600.0),
+    'arrivals': Policy(fresh=15.0, max_stale=120.0),
+    # A whole route's predictions; larger and slower than one stop's
+    'routes': Policy(read_timeout=8.0, deadline=10.0, fresh=15.0,
+                     max_stale=120.0),
+    }
+
+MAX_ENTRIES = 4096
+
+BREAKER_STATE = metrics.Gauge(
+    'commute_upstream_circuit_open',
+    'Whether the circuit breaker for an endpoint is open (1) or closed (0).',
+    ['endpoint'])
+CACHE_HITS = metrics.Counter(
+    'commute_upstream_cache_hits_total',
+    'Upstream fetches answered from memory, by freshness.',
+    ['endpoint', 'freshness'])
+RETRIES = metrics.Counter(
+    'commute_upstream_retries_total',
+    'Upstream requests retried after a failure.',
+    ['endpoint'])
+
+
+class Response(NamedTuple):
+    content: bytes
+    status: int
+    fetched: float
+    stale: bool = False
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.content)
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.fetched
+
+
+Transport = Callable[[str, Tuple[float, float]], Tuple[int, bytes]]
+
+
+class HTTPTransport:
+    """Default transport, a GET through a pooled `requests` session"""
+
+    def __init__(self):
+        self.session = requests.Session()
+
+    def __call__(self, url, timeout):
+        r = self.session.get(url, timeout=timeout)
+        return r.status_code, r.content
+
+    def reset(self):
+        """Drop pooled connections, eg those inherited across a fork"""
+        self.session = requests.Session()
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker
+
+    After `threshold` failures in a row the circuit opens and calls fail
+    fast for `reset_timeout` seconds; then a single trial call is let
+    through (half-open) and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, endpoint: str, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self._lock = threading.Lock()
+        self._gauge = BREAKER_STATE.labels(endpoint)
+
+    def blocked(self) -> bool:
+        """Whether `allow` would refuse, without starting a trial"""
+        with self._lock:
+            return self.opened_at is not None and (
+                self.trial
+                or time.monotonic() - self.opened_at < self.reset_timeout)
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if (time.monotonic() - self.opened_at >= self.reset_timeout
+                    and not self.trial):
+                self.trial = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+            self._gauge.set(0)
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                self._gauge.set(1)
+            self.trial = False
+
+    def release(self):
+        """End a call let through by `allow` that has no outcome to report"""
+        with self._lock:
+            self.trial = False
+
+
+class _Endpoint:
+    def __init__(self, name: str, policy: Policy):
+        self.name = name
+        self.policy = policy
+        self.probe = metrics.UpstreamProbe(name)
+        self.breaker = CircuitBreaker(name, policy.failure_threshold,
+                                      policy.reset_timeout)
+        self.fresh_hits = CACHE_HITS.labels(name, 'fresh')
+        self.stale_hits = CACHE_HITS.labels(name, 'stale')
+        self.retries = RETRIES.labels(name)
+
+
+class SharedResponses:
+    """
+    Latest response per URL, in files every worker on the host can read
+
+    Each file holds a JSON header line (status, fetch time) and the body,
+    and is replaced atomically.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, url: str) -> str:
+        name = hashlib.blake2b(url.encode('utf-8'), digest_size=16)
+        return os.path.join(self.directory, name.hexdigest())
+
+    def put(self, url: str, response: Response):
+        path = self._path(url)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        header = json.dumps({'status': response.status,
+                             'fetched': response.fetched})
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(header.encode('utf-8') + b'\n')
+                f.write(response.content)
+            os.replace(tmp, path)
+        except OSError:
+            pass
+
+    def get(self, url: str) -> Optional[Response]:
+        try:
+            with open(self._path(url), 'rb') as f:
+                header = json.loads(f.readline())
+                content = f.read()
+        except (OSError, ValueError):
+            return None
+        return Response(content, header['status'], header['fetched'])
+
+
+class Upstream:
+    """
+    Caching, retrying HTTP client for the TfL endpoints
+
+    Parameters
+    ----------
+    transport : callable, optional
+        `transport(url, (connect, read)) -> (status, body)`. Defaults to a
+        pooled `requests` session; record/replay and load tests swap it.
+    policies : dict, optional
+        Endpoint name -> Policy. Unknown endpoints get the default Policy.
+    limiter : ratelimit.Limiter, optional
+        Rate limiter to take a token from before each request. Defaults
+        to the shared one; None disables limiting (eg for replays).
+
+    """
+
+    def __init__(self, transport: Optional[Transport] = None,
+                 policies: Optional[dict] = None,
+                 limiter=ratelimit.limiter):
+        self.transport = transport or HTTPTransport()
+        self.limiter = limiter
+        self.policies = dict(POLICIES if policies is None else policies)
+        self.shared = None
+        self._endpoints = {}
+        self._cache = OrderedDict()
+        self._revalidating = set()
+        self._lock = threading.Lock()
+
+    def after_fork(self):
+        """
+        Make the client safe to use in a forked worker
+
+        Pooled sockets opened by the parent would otherwise be shared
+        with it, and locks may have been copied in a held state.
+        """
+        self._lock = threading.Lock()
+        self._revalidating = set()
+        if self.limiter is not None:
+            self.limiter.after_fork()
+        transport = self.transport
+        while transport is not None:
+            reset = getattr(transport, 'reset', None)
+            if reset is not None:
+                reset()
+            transport = getattr(transport, 'inner', None)
+
+    def share(self, directory: str):
+        """Share every response with the other workers through `directory`"""
+        self.shared = SharedResponses(directory)
+
+    def adopt(self, url: str) -> Optional[Response]:
+        """
+        The response for `url` another worker shared, if any; it is kept
+        in memory when newer than the one held
+        """
+        if self.shared is None:
+            return None
+        response = self.shared.get(url)
+        if response is None:
+            return None
+        entry = self._cache.get(url)
+        if entry is not None and entry.fetched >= response.fetched:
+            return entry
+        self._store(url, response)
+        return response
+
+    def endpoint(self, name: str) -> _Endpoint:
+        ep = self._endpoints.get(name)
+        if ep is None:
+            with self._lock:
+                ep = self._endpoints.get(name)
+                if ep is None:
+                    ep = _Endpoint(name, self.policies.get(name, Policy()))
+                    self._endpoints[name] = ep
+        return ep
+
+    def probe(self, name: str) -> metrics.UpstreamProbe:
+        return self.endpoint(name).probe
+
+    def cached(self, url: str) -> Optional[Response]:
+        """Last good response for `url`, however old, without fetching"""
+        return self._cache.get(url)
+
+    def fetch(self, endpoint: str, url: str) -> Response:
+        """
+        Return the response for `url`, from memory where the policy allows
+
+        Raises
+        ------
+        UpstreamError
+            If TfL fails and no earlier response is held for `url`.
+
+        """
+        ep = self.endpoint(endpoint)
+        entry = self._cache.get(url)
+        if entry is None or entry.age >= ep.policy.fresh:
+            # The polling worker may have a newer one (see share())
+            entry = self.adopt(url) or entry
+        if entry is not None:
+            age = entry.age
+            if age < ep.policy.fresh:
+                ep.fresh_hits.inc()
+                return entry
+            if age < ep.policy.max_stale:
+                ep.stale_hits.inc()
+                self._revalidate(ep, url)
+                return entry._replace(stale=True)
+        try:
+            return self._request(ep, url)
+        except UpstreamError:
+            if entry is None:
+                raise
+            ep.stale_hits.inc()
+            return entry._replace(stale=True)
+
+    def refresh(self, endpoint: str, url: str) -> Response:
+        """
+        Fetch `url` from TfL now, whatever the cache holds
+
+        Used by background pollers, which want the new response rather
+        than a stale one with a revalidation behind it. Falls back to the
+        cached response (marked stale) if TfL fails.
+        """
+        ep = self.endpoint(endpoint)
+        try:
+            return self._request(ep, url)
+        except UpstreamError:
+            entry = self._cache.get(url)
+            if entry is None:
+                raise
+            return entry._replace(stale=True)
+
+    def _store(self, url: str, response: Response):
+        with self._lock:
+            self._cache[url] = response
+            self._cache.move_to_end(url)
+            while len(self._cache) > MAX_ENTRIES:
+                self._cache.popitem(last=False)
+
+    def _revalidate(self, ep: _Endpoint, url: str):
+        with self._lock:
+            if url in self._revalidating:
+                return
+            self._revalidating.add(url)
+
+        def run():
+            try:
+                with ratelimit.background():
+                    self._request(ep, url)
+            except UpstreamError:
+                pass
+            finally:
+                with self._lock:
+                    self._revalidating.discard(url)
+
+        threading.Thread(target=run, name='revalidate', daemon=True).start()
+
+    def _request(self, ep: _Endpoint, url: str) -> Response:
+        policy = ep.policy
+        deadline = time.monotonic() + policy.deadline
+        last_error = None
+        for attempt in range(policy.retries + 1):
+            # Fail fast without spending a token while the circuit is open
+            if ep.breaker.blocked():
+                raise UpstreamError('{}: circuit open'.format(ep.name))
+            # Interactive calls give up on the bucket early, and are
+            # answered stale instead
+            if self.limiter is not None and not self.limiter.acquire(
+                    timeout=min(ratelimit.TIMEOUTS[
+                        ratelimit.current_priority()],
+                        max(0.0, deadline - time.monotonic()))):
+                raise UpstreamError('{}: rate limited'.format(ep.name))
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # Only now may this call be the half-open trial: every way out
+            # from here reports an outcome or releases the trial
+            if not ep.breaker.allow():
+                raise UpstreamError('{}: circuit open'.format(ep.name))
+            timeout = (min(policy.connect_timeout, remaining),
+                       min(policy.read_timeout, remaining))
+            try:
+                with ep.probe.fetch(), tracing.span(
+                        'fetch', endpoint=ep.name, attempt=attempt):
+                    status, content = self.transport(url, timeout)
+                    if status >= 500 or status == 429:
+                        raise UpstreamError('{}: HTTP {}'.format(
+                            ep.name, status))
+            except (requests.RequestException, UpstreamError) as e:
+                ep.breaker.failure()
+                last_error = e
+            except BaseException:
+                ep.breaker.release()
+                raise
+            else:
+                ep.breaker.success()
+                if status >= 400:
+                    # Not retryable (eg an unknown stop id)
+                    raise UpstreamError('{}: HTTP {}'.format(ep.name, status))
+                ep.probe.success(len(content))
+                response = Response(content, status, time.time())
+                self._store(url, response)
+                if self.shared is not None:
+                    self.shared.put(url, response)
+                return response
+            if attempt < policy.retries:
+                ep.retries.inc()
+                # Full jitter, capped so the deadline is not overrun
+                pause = random.uniform(0, policy.backoff * 2 ** attempt)
+                time.sleep(max(0.0, min(pause,
+                                        deadline - time.monotonic())))
+        raise UpstreamError('{}: {!r}'.format(
+            ep.name, last_error or 'deadline exceeded'))
+
+
+client = Upstream()
+replay.configure(client)
+
+
+def fetch(endpoint: str, url: str) -> Response:
+    """`client.fetch`, for callers that don't need their own client"""
+    return client.fetch(endpoint, url)
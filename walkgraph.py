@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Precomputed walking times between bike docks, bus stops and tube
+stations.
+
+An offline step links every BikePoint, bus stop and tube station to its
+K nearest neighbours within MAX_METRES, with the walking time: the
+haversine distance, times DETOUR for streets not being straight, at
+WALK_SPEED. Stations are their NaPTAN station IDs ('940GZZLUBNK'), as
+they are the ends of tube legs (see planner.py).
+
+    python walkgraph.py build                   # coordinates from TfL
+    python walkgraph.py build --coords points.csv   # ID,lat,lon rows
+    python walkgraph.py nearby 490001180E
+
+and served as
+
+    GET /api/nearby/490001180E?kind=docks
+
+Deploys build it with the app: `bin/post_compile` on Heroku, which keeps
+it in the slug, and a `RUN` step in the Dockerfile. If TfL can't be
+reached then, the app runs without it (see `WalkGraph`).
+
+The graph is written in CSR form to one file (WALKGRAPH_FILE):
+
+    header      magic, version, nodes, edges, size of the IDs
+    offsets     int32 x (nodes + 1); node i's edges are offsets[i:i + 1]
+    targets     int32 x edges, neighbours nearest first
+    seconds     float32 x edges, walking time to each
+    ids         node IDs, newline-separated, sorted
+
+`WalkGraph` maps the file and reads the arrays in place through
+`memoryview`s, so nothing is computed at startup, workers share the pages,
+and `nearby` and `seconds` touch K entries. numpy is only used by the
+build.
+
+@author: VK
+"""
+
+import argparse
+import csv
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+from array import array
+from collections import defaultdict
+
+import flask
+
+
+WALKGRAPH_FILE = os.environ.get(
+    'COMMUTE_WALKGRAPH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'walkgraph.bin'))
+K = 8
+MAX_METRES = 1000.0
+WALK_SPEED = 1.3    # m/s, about 4.7 km/h
+DETOUR = 1.3        # walking distance over straight-line distance
+
+log = logging.getLogger(__name__)
+EARTH_RADIUS = 6371008.8
+
+MAGIC = b'VKWG'
+VERSION = 1
+HEADER = struct.Struct('<4sIIII')
+STOPS_URL = "https://api.tfl.gov.uk/StopPoint/Mode/bus?page={page}"
+STATIONS_URL = "https://api.tfl.gov.uk/StopPoint/Mode/tube"
+KINDS = ('docks', 'stops', 'stations')
+
+
+def _aligned(n: int) -> int:
+    return (n + 7) // 8 * 8
+
+
+def kind_of(ident: str) -> str:
+    """'docks', 'stations' (NaPTAN 940G...) or 'stops', from a node ID"""
+    if ident.startswith('BikePoints_'):
+        return 'docks'
+    return 'stations' if ident.startswith('940G') else 'stops'
+
+
+def build(points, k: int = K, max_metres: float = MAX_METRES) -> tuple:
+    """
+    The K-nearest-neighbour walking graph of `points`
+
+    Parameters
+    ----------
+    points : iterable of (str, float, float)
+        Node ID, latitude and longitude.
+
+    Returns
+    -------
+    (ids, offsets, targets, seconds)
+        Sorted IDs and the CSR arrays.
+
+    """
+    import numpy as np
+
+    points = sorted(dict((p[0], p) for p in points).values())
+    ids = [p[0] for p in points]
+    lat = np.radians([p[1] for p in points])
+    lon = np.radians([p[2] for p in points])
+    # Grid of cells at least max_metres wide, even at the northern edge,
+    # so neighbours are in the 3 x 3 around
+    y = lat * EARTH_RADIUS // max_metres
+    x = lon * EARTH_RADIUS * np.cos(np.abs(lat).max()) // max_metres
+    cells = defaultdict(list)
+    for i, cell in enumerate(zip(y.astype(int), x.astype(int))):
+        cells[cell].append(i)
+
+    nearest = [None] * len(ids)
+    for (cy, cx), members in cells.items():
+        members = np.array(members)
+        near = np.array([j for dy in (-1, 0, 1) for dx in (-1, 0, 1)
+                         for j in cells.get((cy + dy, cx + dx), ())])
+        a = np.sin((lat[near] - lat[members, None]) / 2) ** 2 \
+            + np.cos(lat[members, None]) * np.cos(lat[near]) \
+            * np.sin((lon[near] - lon[members, None]) / 2) ** 2
+        metres = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+        metres[members[:, None] == near] = np.inf
+        metres[metres > max_metres] = np.inf
+        order = np.argsort(metres, axis=1, kind='stable')[:, :k]
+        for row, i in enumerate(members):
+            found = metres[row, order[row]]
+            keep = np.isfinite(found)
+            nearest[i] = (near[order[row][keep]], found[keep])
+
+    offsets = array('i', [0])
+    targets = array('i')
+    seconds = array('f')
+    for near, metres in nearest:
+        targets.extend(near.tolist())
+        seconds.extend((metres * DETOUR / WALK_SPEED).tolist())
+        offsets.append(len(targets))
+    return ids, offsets, targets, seconds
+
+
+def write(path: str, ids, offsets: array, targets: array, seconds: array):
+    """Write a graph from `build` to `path`, replacing it atomically"""
+    blob = '\n'.join(ids).encode('utf-8')
+    sections = [offsets.tobytes(), targets.tobytes(), seconds.tobytes(),
+                blob]
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(ids), len(targets),
+                            len(blob)))
+        f.write(bytes(_aligned(HEADER.size) - HEADER.size))
+        for data in sections:
+            f.write(data)
+            f.write(bytes(_aligned(len(data)) - len(data)))
+    os.replace(tmp, path)
+
+
+class WalkGraph:
+    """
+    Memory-mapped walking graph written by `build` and `write`
+
+    The file is opened on first use (or by `prepare`). Without one, or
+    with one that can't be read (truncated, or from another version),
+    every query finds nothing.
+
+    Parameters
+    ----------
+    path : str
+
+    """
+
+    def __init__(self, path: str = WALKGRAPH_FILE):
+        self.path = path
+        self.ids = None
+        self._index = None
+        self._lock = threading.Lock()
+
+    def prepare(self) -> bool:
+        """Map the file, unless done already; whether there is a graph"""
+        with self._lock:
+            if self._index is None:
+                self._index = {}
+                try:
+                    self._load()
+                except FileNotFoundError:
+                    pass
+                except (OSError, ValueError, struct.error) as e:
+                    log.warning('no walking graph: %s', e)
+                    self._index = {}
+        return bool(self._index)
+
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n, nnz, size = HEADER.unpack_from(mm)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{} is not a walking graph'.format(self.path))
+        start = _aligned(HEADER.size)
+        sections = []
+        for code, length in (('i', n + 1), ('i', nnz), ('f', nnz)):
+            end = start + 4 * length
+            sections.append((code, start, end))
+            start = _aligned(end)
+        if len(mm) < start + size:
+            raise ValueError('{} is truncated'.format(self.path))
+        view = memoryview(mm)
+        arrays = [view[begin:end].cast(code)
+                  for code, begin, end in sections]
+        self.offsets, self.targets, self.seconds = arrays
+        ids = bytes(view[start:start + size]).decode('utf-8')
+        self.ids = ids.split('\n') if n else []
+        self._index = {ident: i for i, ident in enumerate(self.ids)}
+
+    def __len__(self):
+        self.prepare()
+        return len(self._index)
+
+    def __contains__(self, ident):
+        self.prepare()
+        return ident in self._index
+
+    def nearby(self, ident: str, kind: str = None) -> list:
+        """
+        [(ID, walking seconds)] of the nearest nodes, nearest first; only
+        those of `kind` (see KINDS) if given
+        """
+        self.prepare()
+        i = self._index.get(ident)
+        if i is None:
+            return []
+        found = []
+        for e in range(self.offsets[i], self.offsets[i + 1]):
+            other = self.ids[self.targets[e]]
+            if kind is None or kind_of(other) == kind:
+                found.append((other, self.seconds[e]))
+        return found
+
+    def seconds_between(self, a: str, b: str):
+        """Walking seconds between two nodes, or None if not neighbours"""
+        self.prepare()
+        i, j = self._index.get(a), self._index.get(b)
+        if i is None or j is None:
+            return None
+        if i == j:
+            return 0.0
+        for x, y in ((i, j), (j, i)):
+            for e in range(self.offsets[x], self.offsets[x + 1]):
+                if self.targets[e] == y:
+                    return self.seconds[e]
+        return None
+
+
+def create_blueprint(graph: WalkGraph, bike_feed) -> flask.Blueprint:
+    """
+    Blueprint serving `/api/nearby/<ID>?kind=docks|stops|stations`
+
+    Lists the nearest docks, stops and stations with their walking time,
+    and for docks their last known bikes and spaces, eg to change from a
+    bus to a bike.
+    """
+    from api import dumps
+
+    bp = flask.Blueprint('walkgraph', __name__, url_prefix='/api/nearby')
+
+    @bp.route('/<ident>')
+    def nearby(ident):
+        if not graph.prepare():
+            flask.abort(503, 'the walking graph has not been built')
+        if ident not in graph:
+            flask.abort(404)
+        kind = flask.request.args.get('kind')
+        if kind is not None and kind not in KINDS:
+            flask.abort(400, 'kind is one of ' + ', '.join(KINDS))
+        docks = bike_feed.latest().data
+        found = []
+        for other, seconds in graph.nearby(ident, kind):
+            row = {'id': other, 'kind': kind_of(other),
+                   'seconds': round(seconds)}
+            dock = docks.get(other)
+            if dock is not None:
+                row.update(name=dock.name, bikes=dock.bikes,
+                           spaces=dock.spaces)
+            found.append(row)
+        return flask.Response(dumps({'id': ident, 'nearby': found}),
+                              mimetype='application/json')
+
+    return bp
+
+
+def fetch_points(stops_csv: str = 'BusStops.csv') -> list:
+    """
+    (ID, lat, lon) of every BikePoint and tube station, and every bus stop
+    in the CSV
+    """
+    import upstream
+
+    transport = upstream.HTTPTransport()
+
+    def get(url):
+        status, body = transport(url, (5.0, 60.0))
+        if status != 200:
+            raise upstream.UpstreamError('{} from {}'.format(status, url))
+        return json.loads(body)
+
+    points = [(place['id'], place['lat'], place['lon'])
+              for place in get(upstream.BIKE_URL)]
+    # Stations, not their entrances, platforms or interchange hubs
+    points += [(stop['naptanId'], stop['lat'], stop['lon'])
+               for stop in get(STATIONS_URL).get('stopPoints', [])
+               if stop.get('stopType') == 'NaptanMetroStation']
+    with open(stops_csv, newline='') as f:
+        wanted = {row['Naptan_Atco'] for row in csv.DictReader(f)}
+    page = 1
+    while True:
+        stops = get(STOPS_URL.format(page=page)).get('stopPoints', [])
+        if not stops:
+            break
+        points += [(stop['naptanId'], stop['lat'], stop['lon'])
+                   for stop in stops if stop['naptanId'] in wanted]
+        page += 1
+    return points
+
+
+def read_points(fname: str) -> list:
+    """(ID, lat, lon) rows of a headerless CSV"""
+    with open(fname, newline='') as f:
+        return [(row[0], float(row[1]), float(row[2]))
+                for row in csv.reader(f) if row]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+    make = sub.add_parser('build', help='build the graph')
+    make.add_argument('--out', default=WALKGRAPH_FILE)
+    make.add_argument('--coords', help='ID,lat,lon CSV instead of TfL')
+    make.add_argument('--k', type=int, default=K)
+    make.add_argument('--max-metres', type=float, default=MAX_METRES)
+    near = sub.add_parser('nearby', help='list the neighbours of a node')
+    near.add_argument('ident')
+    near.add_argument('--graph', default=WALKGRAPH_FILE)
+    opts = parser.parse_args()
+
+    if opts.command == 'build':
+        points = (read_points(opts.coords) if opts.coords
+                  else fetch_points())
+        ids, offsets, targets, seconds = build(points, opts.k,
+                                               opts.max_metres)
+        write(opts.out, ids, offsets, targets, seconds)
+        print('{} nodes, {} edges -> {}'.format(len(ids), len(targets),
+                                                opts.out))
+    else:
+        for ident, seconds in WalkGraph(opts.graph).nearby(opts.ident):
+            print('{:>6.0f}s  {}'.format(seconds, ident))
+
+
+if __name__ == "__main__":
+    main()